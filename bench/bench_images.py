@@ -0,0 +1,118 @@
+"""Measure what image preprocessing saves before the base64 data: URL goes upstream.
+
+    python bench/bench_images.py                        # synthetic 12 MP photo + scan
+    python bench/bench_images.py photo.jpg scan.png     # your own files
+    python bench/bench_images.py --fake-url http://127.0.0.1:9000
+
+For each image it reports the original vs processed size, the request body size,
+the preprocessing time and the upload time: measured against the fake upstream
+when --fake-url is given, otherwise estimated at --mbps.
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+import server  # noqa: E402
+
+
+def synthetic_images(directory):
+    rng = np.random.default_rng(0)
+    # Phone photo of a worksheet: smooth lighting gradient plus sensor noise, with EXIF
+    h, w = 3024, 4032
+    y, x = np.mgrid[0:h, 0:w]
+    base = (180 + 50 * np.sin(x / 700.0) * np.cos(y / 900.0))[..., None]
+    photo = np.clip(base + rng.normal(0, 12, (h, w, 3)), 0, 255).astype(np.uint8)
+    photo[::120, :, :] = 40  # ruled lines
+    exif = Image.Exif()
+    exif[0x010F] = "BenchPhone"  # Make
+    exif[0x0112] = 1  # Orientation
+    photo_path = os.path.join(directory, "photo_12mp.jpg")
+    Image.fromarray(photo).save(photo_path, "JPEG", quality=95, exif=exif)
+
+    # Flatbed scan saved as PNG: off-white paper grain with dark text-like strokes
+    scan = rng.normal(245, 4, (3300, 2550))
+    for row in range(200, 3100, 60):
+        for col in range(200, 2350, 40):
+            if rng.random() < 0.8:
+                scan[row:row + 18, col:col + 26] = rng.integers(0, 80)
+    scan = np.clip(scan, 0, 255).astype(np.uint8)
+    scan_path = os.path.join(directory, "scan_300dpi.png")
+    Image.fromarray(scan).save(scan_path, "PNG")
+    return [(photo_path, "image/jpeg"), (scan_path, "image/png")]
+
+
+def request_body(data, mime):
+    b64 = base64.b64encode(data).decode("utf-8")
+    document = {"kind": "image", "url": f"data:{mime};base64,{b64}"}
+    messages = server.build_messages("worksheet", 10, document)
+    return json.dumps({"model": server.MODEL, "messages": messages}).encode("utf-8")
+
+
+def upload_seconds(body, fake_url, mbps):
+    if not fake_url:
+        return len(body) * 8 / (mbps * 1_000_000)
+    import httpx
+    started = time.perf_counter()
+    httpx.post(
+        f"{fake_url}/api/v1/chat/completions",
+        content=body,
+        headers={"Content-Type": "application/json"},
+        timeout=120,
+    ).raise_for_status()
+    return time.perf_counter() - started
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("images", nargs="*")
+    ap.add_argument("--fake-url", default="", help="measure uploads against bench/fake_openrouter.py (use --latency 0)")
+    ap.add_argument("--mbps", type=float, default=20.0, help="uplink speed for estimated upload time")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.images:
+            images = [(p, Image.MIME.get(Image.open(p).format, "image/jpeg")) for p in args.images]
+        else:
+            images = synthetic_images(tmp)
+
+        mode = "measured" if args.fake_url else f"est. @ {args.mbps:g} Mbps"
+        print(f"max_edge={server.IMAGE_MAX_EDGE}  format={server.IMAGE_FORMAT}  quality={server.IMAGE_QUALITY}  upload {mode}")
+        for path, mime in images:
+            with open(path, "rb") as f:
+                original = f.read()
+            raw_body = request_body(original, mime)
+            raw_upload = upload_seconds(raw_body, args.fake_url, args.mbps)
+
+            started = time.perf_counter()
+            data, out_mime = server.prepare_image(path, mime)
+            prep = time.perf_counter() - started
+            body = request_body(data, out_mime)
+            upload = upload_seconds(body, args.fake_url, args.mbps)
+
+            with Image.open(path) as img:
+                size = img.size
+            with Image.open(server.io.BytesIO(data)) as img:
+                out_size = img.size
+            saved = 1 - len(body) / len(raw_body)
+            print(
+                f"{os.path.basename(path)}: {size[0]}x{size[1]} -> {out_size[0]}x{out_size[1]} {out_mime}\n"
+                f"  file {len(original) / 1e6:.2f} MB -> {len(data) / 1e6:.2f} MB   "
+                f"body {len(raw_body) / 1e6:.2f} MB -> {len(body) / 1e6:.2f} MB ({saved:.0%} saved)\n"
+                f"  prepare {prep * 1000:.0f} ms   upload {raw_upload * 1000:.0f} ms -> {upload * 1000:.0f} ms   "
+                f"total {raw_upload * 1000:.0f} ms -> {(prep + upload) * 1000:.0f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
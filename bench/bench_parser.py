@@ -0,0 +1,73 @@
+"""Compare the old regex + json.loads parse step with the salvage parser.
+
+    python bench/bench_parser.py            # counts per corpus file
+    python bench/bench_parser.py --repeat 2000
+
+The corpus in bench/corpus/completions holds representative messy model outputs
+(fences, prose, truncation, stray brackets, bad escapes); expected.json lists how
+many valid questions each one contains.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+import server  # noqa: E402
+
+
+def legacy_parse(content_str):
+    # The pre-salvage parse step: greedy regex, then all-or-nothing json.loads
+    json_match = re.search(r'\[.*\]', content_str, flags=re.DOTALL)
+    if json_match:
+        clean = json_match.group(0)
+    else:
+        clean = content_str.replace("```json", "").replace("```", "").strip()
+    try:
+        data = json.loads(clean)
+    except ValueError:
+        return []
+    if isinstance(data, dict) and "questions" in data:
+        data = data["questions"]
+    return [q for q in (server.shuffle_question(q) for q in data) if q is not None]
+
+
+def timed(fn, text, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(text)
+    return result, (time.perf_counter() - started) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    corpus = os.path.join(HERE, "corpus", "completions")
+    with open(os.path.join(HERE, "corpus", "expected.json")) as f:
+        expected = json.load(f)
+
+    totals = {"expected": 0, "legacy": 0, "salvage": 0}
+    print(f"{'file':<30} {'expected':>8} {'legacy':>7} {'salvage':>8} {'legacy us':>10} {'salvage us':>11}")
+    for name in sorted(expected):
+        with open(os.path.join(corpus, name)) as f:
+            text = f.read()
+        legacy, legacy_us = timed(legacy_parse, text, args.repeat)
+        salvaged, salvage_us = timed(server.parse_quiz, text, args.repeat)
+        totals["expected"] += expected[name]
+        totals["legacy"] += len(legacy)
+        totals["salvage"] += len(salvaged)
+        print(f"{name:<30} {expected[name]:>8} {len(legacy):>7} {len(salvaged):>8} {legacy_us:>10.1f} {salvage_us:>11.1f}")
+    print(f"{'TOTAL':<30} {totals['expected']:>8} {totals['legacy']:>7} {totals['salvage']:>8}")
+    if totals["salvage"] < totals["expected"]:
+        sys.exit("salvage parser recovered fewer questions than expected")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Local stand-in for the OpenRouter chat completions endpoint.
+
+Run it, then point the server at it:
+
+    python bench/fake_openrouter.py --port 9000 --latency 2.0
+    OPENROUTER_URL=http://127.0.0.1:9000/api/v1/chat/completions python server.py
+
+Fault injection for the retry/hedge/fallback policy:
+
+    --error-rate 0.3 --error-status 503    # fail 30% of calls
+    --slow-rate 0.05 --slow-latency 30     # 5% of calls are stuck on a slow replica
+    --fail-models qwen/qwen2.5-vl-72b-instruct   # this model always fails
+
+Output shaping for benchmarks:
+
+    --token-rate 60         # decode speed in tokens/s (4 chars per token); 0 = use --chunk-delay
+    --malformed-rate 0.2    # wrap in prose/fences, truncate, or corrupt one object
+
+The same settings can be changed at runtime with POST /config (JSON body).
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI()
+CONFIG = {
+    "latency": 1.0,
+    "chunk_chars": 40,
+    "chunk_delay": 0.01,
+    "error_rate": 0.0,
+    "error_status": 503,
+    "slow_rate": 0.0,
+    "slow_latency": 30.0,
+    "fail_models": [],
+    "token_rate": 0.0,
+    "malformed_rate": 0.0,
+}
+STATS = {"calls": 0, "in_flight": 0, "max_in_flight": 0, "errors": 0, "slow": 0, "malformed": 0, "models": {}}
+
+
+def fake_questions(n, call):
+    # The c<call>n<i> token keeps every question distinct for the server's de-duplication
+    return [
+        {
+            "text": f"Sample question c{call}n{i + 1}: which answer is right?",
+            "options": [f"Answer {i + 1}", "Wrong A", "Wrong B", "Wrong C"],
+            "correct": 0,
+            "rationale": f"Answer {i + 1} is correct.",
+        }
+        for i in range(n)
+    ]
+
+
+def requested_count(messages):
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, list):
+            content = " ".join(p.get("text", "") for p in content if isinstance(p, dict))
+        match = re.search(r"Generate (\d+) questions", content or "")
+        if match:
+            return int(match.group(1))
+    return 10
+
+
+def fake_usage(body, content):
+    # Rough chars/4 token counts, enough for the server's token counters
+    return {"prompt_tokens": len(json.dumps(body.get("messages", []))) // 4, "completion_tokens": len(content) // 4}
+
+
+def mangle(content):
+    # The kinds of damage real completions show; the server should salvage the rest
+    STATS["malformed"] += 1
+    kind = random.choice(["prose", "truncate", "corrupt"])
+    if kind == "prose":
+        return f"Sure! Here is your quiz:\n```json\n{content}\n```\nLet me know if you want more."
+    if kind == "truncate":
+        return content[: int(len(content) * 0.7)]
+    cut = content.find('"options"', len(content) // 2)
+    return content[:cut] + content[cut + 1:] if cut > 0 else content
+
+
+def decode_seconds(chars):
+    return chars / 4 / CONFIG["token_rate"] if CONFIG["token_rate"] > 0 else 0.0
+
+
+def call_latency():
+    if random.random() < CONFIG["slow_rate"]:
+        STATS["slow"] += 1
+        return CONFIG["slow_latency"]
+    return CONFIG["latency"]
+
+
+async def sse_chunks(content, usage, latency):
+    # Time-to-first-token is the configured latency; the body then trickles out.
+    try:
+        await asyncio.sleep(latency)
+        yield ": OPENROUTER PROCESSING\n\n"
+        step = CONFIG["chunk_chars"]
+        delay = decode_seconds(step) if CONFIG["token_rate"] > 0 else CONFIG["chunk_delay"]
+        for i in range(0, len(content), step):
+            chunk = {"choices": [{"delta": {"content": content[i:i + step]}}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(delay)
+        yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n"
+        yield "data: [DONE]\n\n"
+    finally:
+        STATS["in_flight"] -= 1
+
+
+@app.post("/api/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    STATS["calls"] += 1
+    model = body.get("model", "")
+    STATS["models"][model] = STATS["models"].get(model, 0) + 1
+    if model in CONFIG["fail_models"] or random.random() < CONFIG["error_rate"]:
+        STATS["errors"] += 1
+        status = CONFIG["error_status"]
+        headers = {"Retry-After": "1"} if status == 429 else None
+        return JSONResponse({"error": {"code": status, "message": "injected failure"}}, status, headers)
+
+    STATS["in_flight"] += 1
+    STATS["max_in_flight"] = max(STATS["max_in_flight"], STATS["in_flight"])
+    content = json.dumps(fake_questions(requested_count(body.get("messages", [])), STATS["calls"]))
+    if random.random() < CONFIG["malformed_rate"]:
+        content = mangle(content)
+
+    if body.get("stream"):
+        return StreamingResponse(sse_chunks(content, fake_usage(body, content), call_latency()), media_type="text/event-stream")
+
+    try:
+        await asyncio.sleep(call_latency() + decode_seconds(len(content)))
+        return {
+            "choices": [{"message": {"role": "assistant", "content": content}}],
+            "usage": fake_usage(body, content),
+        }
+    finally:
+        STATS["in_flight"] -= 1
+
+
+@app.get("/stats")
+async def stats():
+    return STATS
+
+
+@app.post("/stats/reset")
+async def reset_stats():
+    STATS.update(calls=0, in_flight=0, max_in_flight=0, errors=0, slow=0, malformed=0, models={})
+    return STATS
+
+
+@app.post("/config")
+async def update_config(request: Request):
+    CONFIG.update(await request.json())
+    return CONFIG
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds per completion")
+    parser.add_argument("--chunk-chars", type=int, default=40, help="characters per streamed chunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls that fail")
+    parser.add_argument("--error-status", type=int, default=503, help="status code for injected failures")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of calls that take --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=30.0, help="seconds for a slow call")
+    parser.add_argument("--fail-models", default="", help="comma-separated models that always fail")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="decode tokens/s (0: use --chunk-delay)")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="fraction of completions to damage")
+    args = parser.parse_args()
+    CONFIG.update(
+        latency=args.latency,
+        chunk_chars=args.chunk_chars,
+        chunk_delay=args.chunk_delay,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        fail_models=[m for m in args.fail_models.split(",") if m],
+        token_rate=args.token_rate,
+        malformed_rate=args.malformed_rate,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
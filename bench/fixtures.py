@@ -0,0 +1,220 @@
+"""Generate the benchmark fixture corpus: PDFs (text and scanned), DOCX files, images and text in increasing sizes.
+
+    python bench/fixtures.py                  # writes bench/fixtures/
+    python bench/fixtures.py --out /tmp/corpus
+
+Everything is generated from a fixed seed, so the corpus is identical on every
+machine and doesn't need to be checked in. The PDF and DOCX writers are minimal
+but valid (PyPDF2 and the server's DOCX parser read them like real files).
+"""
+import argparse
+import json
+import os
+import random
+from zipfile import ZIP_DEFLATED, ZipFile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (pages / paragraphs / pixels / characters) per size
+SIZES = {
+    "small": {"pdf_pages": 2, "scan_pages": 1, "docx_paragraphs": 20, "image": (640, 480), "text_chars": 4_000},
+    "medium": {"pdf_pages": 40, "scan_pages": 8, "docx_paragraphs": 800, "image": (2000, 1500), "text_chars": 200_000},
+    "large": {"pdf_pages": 400, "scan_pages": 40, "docx_paragraphs": 8000, "image": (4032, 3024), "text_chars": 2_000_000},
+}
+
+SUBJECTS = ["cell", "enzyme", "membrane", "protein", "nucleus", "glucose", "mitosis", "ribosome",
+            "photosynthesis", "chlorophyll", "respiration", "osmosis", "gene", "allele", "mutation"]
+VERBS = ["regulates", "converts", "transports", "stores", "releases", "binds", "divides", "encodes"]
+OBJECTS = ["energy", "water", "oxygen", "carbon dioxide", "amino acids", "signals", "ions", "information"]
+
+
+def sentences(rng):
+    while True:
+        yield (
+            f"The {rng.choice(SUBJECTS)} {rng.choice(VERBS)} {rng.choice(OBJECTS)} "
+            f"when the {rng.choice(SUBJECTS)} is {rng.choice(['active', 'inhibited', 'saturated', 'exposed'])}."
+        )
+
+
+def paragraph(rng, gen, count=5):
+    return " ".join(next(gen) for _ in range(count))
+
+
+def pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages):
+    # One Helvetica text object per line; a running header and page number on
+    # each page like real course notes
+    objs = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(len(pages)))
+    objs.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode())
+    objs.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for i, lines in enumerate(pages):
+        objs.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>".encode()
+        )
+        ops = ["BT /F1 10 Tf 14 TL 50 760 Td (Biology 101 - Lecture Notes) Tj T*"]
+        ops += [f"({pdf_escape(line)}) Tj T*" for line in lines]
+        ops.append(f"(Page {i + 1}) Tj ET")
+        stream = "\n".join(ops).encode("latin-1")
+        objs.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+
+    buf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objs):
+        offsets.append(len(buf))
+        buf += f"{i + 1} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(buf)
+    buf += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        buf += f"{offset:010d} 00000 n \n".encode()
+    buf += f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(buf)
+
+
+def write_scanned_pdf(path, jpegs):
+    # What a scanner produces: one full-page JPEG per page and no text layer
+    objs = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 3 * i} 0 R" for i in range(len(jpegs)))
+    objs.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(jpegs)} >>".encode())
+    for i, (jpeg, (w, h)) in enumerate(jpegs):
+        objs.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /XObject << /Im0 {4 + 3 * i} 0 R >> >> /Contents {5 + 3 * i} 0 R >>".encode()
+        )
+        objs.append(
+            f"<< /Type /XObject /Subtype /Image /Width {w} /Height {h} /ColorSpace /DeviceRGB "
+            f"/BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg)} >>\nstream\n".encode() + jpeg + b"\nendstream"
+        )
+        ops = b"q 612 0 0 792 0 0 cm /Im0 Do Q"
+        objs.append(b"<< /Length %d >>\nstream\n" % len(ops) + ops + b"\nendstream")
+
+    buf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objs):
+        offsets.append(len(buf))
+        buf += f"{i + 1} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(buf)
+    buf += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        buf += f"{offset:010d} 00000 n \n".encode()
+    buf += f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(buf)
+
+
+def page_scan(rng):
+    # A 150 dpi letter page: paper grain with dark text-like strokes, as a JPEG
+    import io
+
+    import numpy as np
+    from PIL import Image
+
+    noise = np.random.default_rng(rng.randrange(1 << 30))
+    page = noise.normal(240, 6, (1650, 1275))
+    for row in range(120, 1550, 36):
+        for col in range(100, 1150, 28):
+            if noise.random() < 0.8:
+                page[row:row + 12, col:col + 20] = noise.integers(0, 80)
+    out = io.BytesIO()
+    Image.fromarray(np.clip(page, 0, 255).astype(np.uint8)).convert("RGB").save(out, "JPEG", quality=75)
+    return out.getvalue(), (1275, 1650)
+
+
+def write_docx(path, paragraphs):
+    w = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+    with ZipFile(path, "w", ZIP_DEFLATED) as z:
+        z.writestr(
+            "[Content_Types].xml",
+            '<?xml version="1.0"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-'
+            'officedocument.wordprocessingml.document.main+xml"/></Types>',
+        )
+        with z.open("word/document.xml", "w") as f:
+            f.write(f'<?xml version="1.0" encoding="UTF-8"?><w:document xmlns:w="{w}"><w:body>'.encode())
+            for text in paragraphs:
+                f.write(f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>".encode())
+            f.write(b"</w:body></w:document>")
+
+
+def write_image(path, size, rng):
+    # Photo-like: lighting gradient plus sensor noise, which is what makes phone
+    # photos large; needs NumPy and Pillow (as does the server's image pipeline)
+    import numpy as np
+    from PIL import Image
+
+    w, h = size
+    noise = np.random.default_rng(rng.randrange(1 << 30))
+    y, x = np.mgrid[0:h, 0:w]
+    base = (180 + 50 * np.sin(x / (w / 6)) * np.cos(y / (h / 4)))[..., None]
+    pixels = np.clip(base + noise.normal(0, 12, (h, w, 3)), 0, 255).astype(np.uint8)
+    pixels[:: max(h // 25, 1), :, :] = 40  # ruled lines
+    Image.fromarray(pixels).save(path, "JPEG", quality=92)
+
+
+def build(out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = []
+    for size, spec in SIZES.items():
+        rng = random.Random(f"quizgen-{size}")
+        gen = sentences(rng)
+
+        path = os.path.join(out_dir, f"{size}.pdf")
+        write_pdf(path, [[next(gen) for _ in range(45)] for _ in range(spec["pdf_pages"])])
+        manifest.append({"name": f"{size}.pdf", "kind": "pdf", "size": size, "mime": "application/pdf"})
+
+        path = os.path.join(out_dir, f"{size}-scan.pdf")
+        write_scanned_pdf(path, [page_scan(rng) for _ in range(spec["scan_pages"])])
+        manifest.append({"name": f"{size}-scan.pdf", "kind": "scan", "size": size, "mime": "application/pdf"})
+
+        path = os.path.join(out_dir, f"{size}.docx")
+        write_docx(path, [paragraph(rng, gen) for _ in range(spec["docx_paragraphs"])])
+        manifest.append({
+            "name": f"{size}.docx", "kind": "docx", "size": size,
+            "mime": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        })
+
+        path = os.path.join(out_dir, f"{size}.jpg")
+        write_image(path, spec["image"], rng)
+        manifest.append({"name": f"{size}.jpg", "kind": "image", "size": size, "mime": "image/jpeg"})
+
+        path = os.path.join(out_dir, f"{size}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            written = 0
+            while written < spec["text_chars"]:
+                chunk = paragraph(rng, gen) + "\n\n"
+                f.write(chunk)
+                written += len(chunk)
+        manifest.append({"name": f"{size}.txt", "kind": "text", "size": size, "mime": "text/plain"})
+
+    for entry in manifest:
+        entry["bytes"] = os.path.getsize(os.path.join(out_dir, entry["name"]))
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def ensure(out_dir):
+    # Build the corpus unless it's already there
+    path = os.path.join(out_dir, "manifest.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return build(out_dir)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--out", default=os.path.join(HERE, "fixtures"))
+    args = ap.parse_args()
+    for entry in build(args.out):
+        print(f"{entry['name']:<14} {entry['kind']:<6} {entry['bytes'] / 1e6:8.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Fire concurrent /generate-quiz requests and report throughput per concurrency level.
+
+Start the fake upstream and the server first (see bench/fake_openrouter.py), with
+RATE_LIMIT_PER_MIN=0 so the per-client rate limit doesn't reject the burst, then:
+
+    python bench/load_test.py --url http://127.0.0.1:8000 --levels 1,4,16
+
+--burst N instead sends N identical requests at once and checks (via the fake's
+/stats) that they were coalesced into exactly one upstream call, and (via the
+server's /stats) that the other N-1 joined it or, arriving after it finished,
+were answered from its cache entry. Question pools count distinct
+clients, so a burst from one machine never warms a pool behind the check's back.
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import httpx
+
+
+async def one_request(client, url, topic, num_questions, no_cache=False):
+    started = time.perf_counter()
+    response = await client.post(
+        f"{url}/generate-quiz",
+        data={"topic": topic, "num_questions": str(num_questions), "no_cache": str(no_cache).lower()},
+    )
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+
+async def run_level(url, concurrency, total, num_questions):
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=600, limits=limits) as client:
+        sem = asyncio.Semaphore(concurrency)
+
+        async def worker(i):
+            async with sem:
+                return await one_request(client, url, f"load test topic {i}", num_questions, no_cache=True)
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(worker(i) for i in range(total)))
+        elapsed = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2),
+        "mean_latency_s": round(sum(latencies) / len(latencies), 3),
+    }
+
+
+async def shared_requests(client, url):
+    # Requests answered by someone else's upstream call: joined in flight, or from the cache
+    stats = (await client.get(f"{url}/stats")).json()
+    return stats.get("coalesced_requests", 0) + stats.get("cache_hits", 0)
+
+
+async def run_burst(url, fake_url, count, num_questions):
+    async with httpx.AsyncClient(timeout=600, limits=httpx.Limits(max_connections=count)) as client:
+        await client.post(f"{fake_url}/stats/reset")
+        before = await shared_requests(client, url)
+        topic = f"burst topic {time.time()}"  # unique so earlier runs can't answer from cache
+        started = time.perf_counter()
+        await asyncio.gather(*(one_request(client, url, topic, num_questions) for _ in range(count)))
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(1)  # anything started in the background (a pool refill) shows up too
+        upstream_calls = (await client.get(f"{fake_url}/stats")).json()["calls"]
+        shared = await shared_requests(client, url) - before
+    print(f"burst={count}  elapsed={elapsed:.3f}s  upstream_calls={upstream_calls}  shared={shared}")
+    return upstream_calls == 1 and shared == count - 1
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--levels", default="1,2,4,8,16")
+    parser.add_argument("--requests-per-level", type=int, default=16)
+    parser.add_argument("--num-questions", type=int, default=5)
+    parser.add_argument("--burst", type=int, default=0, help="identical requests to coalesce")
+    parser.add_argument("--fake-url", default="http://127.0.0.1:9000")
+    args = parser.parse_args()
+
+    if args.burst:
+        if not await run_burst(args.url, args.fake_url, args.burst, args.num_questions):
+            sys.exit("FAIL: identical requests were not coalesced into one upstream call")
+        return
+
+    for level in (int(x) for x in args.levels.split(",")):
+        row = await run_level(args.url, level, args.requests_per_level, args.num_questions)
+        print(
+            f"concurrency={row['concurrency']:>3}  requests={row['requests']:>3}  "
+            f"elapsed={row['elapsed_s']:>7}s  throughput={row['throughput_rps']:>6} req/s  "
+            f"mean_latency={row['mean_latency_s']}s"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""Exercise the upstream retry/hedge/fallback policy against the fake upstream.
+
+    python bench/fake_openrouter.py --latency 0.3
+    RATE_LIMIT_PER_MIN=0 HEDGE_MIN_DELAY=0.5 FALLBACK_MODELS=fake/fallback \\
+        OPENROUTER_URL=http://127.0.0.1:9000/api/v1/chat/completions python server.py
+    python bench/policy_test.py --url http://127.0.0.1:8000 --fake-url http://127.0.0.1:9000
+
+Each scenario reconfigures the fake through POST /config, fires a batch of
+uncached requests and checks the outcome: transient errors are retried away,
+slow replicas are hedged around, rate limiting doesn't open the circuit, and a
+failing model falls back.
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import httpx
+
+PRIMARY = "qwen/qwen2.5-vl-72b-instruct"
+
+
+async def fire(client, url, count, tag):
+    async def one(i):
+        started = time.perf_counter()
+        response = await client.post(
+            f"{url}/generate-quiz",
+            data={"topic": f"policy {tag} {time.time()} {i}", "num_questions": "3", "no_cache": "true"},
+        )
+        return response.status_code, time.perf_counter() - started
+
+    return await asyncio.gather(*(one(i) for i in range(count)))
+
+
+async def scenario(client, url, fake_url, name, config, count):
+    base = {"error_rate": 0.0, "error_status": 503, "slow_rate": 0.0, "fail_models": []}
+    await client.post(f"{fake_url}/config", json={**base, **config})
+    await client.post(f"{fake_url}/stats/reset")
+    results = await fire(client, url, count, name)
+    fake = (await client.get(f"{fake_url}/stats")).json()
+    ok = sum(1 for status, _ in results if status == 200)
+    latencies = sorted(t for _, t in results)
+    print(
+        f"{name:<10} ok={ok}/{count}  max={latencies[-1]:.2f}s  upstream_calls={fake['calls']}  "
+        f"errors={fake['errors']}  slow={fake['slow']}  models={fake['models']}"
+    )
+    return ok, latencies, fake
+
+
+async def main_async(args):
+    async with httpx.AsyncClient(timeout=120) as client:
+        checks = []
+        ok, _, _ = await scenario(client, args.url, args.fake_url, "baseline", {}, args.count)
+        checks.append(("baseline all succeed", ok == args.count))
+
+        ok, _, fake = await scenario(client, args.url, args.fake_url, "errors", {"error_rate": 0.3}, args.count)
+        # Without retries about 70% would succeed
+        checks.append(("transient errors retried", ok >= 0.95 * args.count and fake["errors"] > 0))
+
+        # Warm the latency window so hedging uses a real p95, then make some replicas slow
+        await scenario(client, args.url, args.fake_url, "warmup", {}, 25)
+        ok, latencies, fake = await scenario(
+            client, args.url, args.fake_url, "slow", {"slow_rate": 0.2, "slow_latency": 20}, args.count
+        )
+        # A request only stays slow if its hedge landed on a slow replica too
+        stuck = sum(1 for t in latencies if t > 10)
+        checks.append(("slow replicas hedged", ok == args.count and stuck < max(fake["slow"], 1)))
+
+        # Rate limiting is retried (and failed over) but must not open the circuit:
+        # once upstream stops throttling, the primary model takes the calls again
+        ok, _, fake = await scenario(
+            client, args.url, args.fake_url, "throttled", {"fail_models": [PRIMARY], "error_status": 429}, args.count
+        )
+        ok, _, fake = await scenario(client, args.url, args.fake_url, "recovered", {}, args.count)
+        checks.append(("429s don't open the circuit", ok == args.count and list(fake["models"]) == [PRIMARY]))
+
+        ok, _, fake = await scenario(client, args.url, args.fake_url, "fallback", {"fail_models": [PRIMARY]}, args.count)
+        checks.append(("failing model falls back", ok == args.count and len(fake["models"]) > 1))
+
+        await client.post(f"{args.fake_url}/config", json={"fail_models": []})
+    for name, passed in checks:
+        print(f"{'PASS' if passed else 'FAIL'}  {name}")
+    return all(passed for _, passed in checks)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--fake-url", default="http://127.0.0.1:9000")
+    ap.add_argument("--count", type=int, default=20)
+    args = ap.parse_args()
+    sys.exit(0 if asyncio.run(main_async(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
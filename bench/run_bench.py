@@ -0,0 +1,408 @@
+"""Scripted load scenarios against the server and the fake upstream, reported as JSON.
+
+    python bench/run_bench.py                                    # everything, default settings
+    python bench/run_bench.py --scenarios topics,stream --out results.json
+    python bench/run_bench.py --latency 2 --token-rate 40        # slower, more realistic upstream
+
+By default it starts bench/fake_openrouter.py and the server (uvicorn, pointed at
+the fake via OPENROUTER_URL, with rate limiting and question pools off so every
+request does real work), builds the fixture corpus (bench/fixtures.py) and runs
+each scenario in turn. Pass --url/--fake-url/--server-pid to use processes you
+started yourself.
+
+Every scenario reports p50/p95/p99 latency, throughput, errors, peak RSS and CPU
+seconds of the server process tree (extraction workers included), and the time
+spent per pipeline stage taken from the server's /metrics histograms. Compare
+the JSON between releases to catch regressions.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+import fixtures
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+SCENARIOS = ["topics", "stream", "documents", "documents_generate", "malformed"]
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))], 4)
+
+
+def latency_summary(latencies, elapsed, errors):
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+    }
+
+
+# --- server process tree sampling (Linux /proc) ---
+def process_tree(pid):
+    # pid and all its descendants: extraction workers are grandchildren
+    # (server -> forkserver -> worker)
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue  # exited while we were looking
+        children.setdefault(int(fields[1]), []).append(int(entry))  # ppid -> pids
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, ()))
+    return pids
+
+
+def rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])  # utime + stime
+        except OSError:
+            pass
+    return total / CLK_TCK
+
+
+class TreeSampler(threading.Thread):
+    # Polls RSS of the server and its children so short peaks aren't missed
+    def __init__(self, pid, interval=0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, sum(rss_bytes(p) for p in process_tree(self.pid)))
+            time.sleep(self.interval)
+
+    def reset(self):
+        self.peak = sum(rss_bytes(p) for p in process_tree(self.pid))
+
+
+# --- server /metrics ---
+STAGE_LINE = re.compile(r'^quizgen_stage_seconds_(sum|count)\{([^}]*)\} ([0-9.e+-]+)$')
+
+
+async def stage_totals(client, url):
+    totals = {}
+    text = (await client.get(f"{url}/metrics")).text
+    for line in text.splitlines():
+        match = STAGE_LINE.match(line)
+        if match:
+            kind, labels, value = match.groups()
+            labels = dict(re.findall(r'(\w+)="([^"]*)"', labels))
+            name = labels["stage"] + (f":{labels['kind']}" if "kind" in labels else "")
+            totals.setdefault(name, {"sum": 0.0, "count": 0})[kind] += float(value)
+    return totals
+
+
+def stage_delta(before, after):
+    stages = {}
+    for name, now in after.items():
+        then = before.get(name, {"sum": 0.0, "count": 0})
+        count = now["count"] - then["count"]
+        if count:
+            total = now["sum"] - then["sum"]
+            stages[name] = {"count": int(count), "total_s": round(total, 4), "mean_s": round(total / count, 4)}
+    return stages
+
+
+# --- scenarios ---
+async def post_quiz(client, url, data, files=None):
+    started = time.perf_counter()
+    response = await client.post(f"{url}/generate-quiz", data=data, files=files)
+    response.raise_for_status()
+    return time.perf_counter() - started, len(response.json())
+
+
+async def run_concurrent(count, concurrency, make_call):
+    sem = asyncio.Semaphore(concurrency)
+    latencies, results, errors = [], [], 0
+
+    async def one(i):
+        nonlocal errors
+        async with sem:
+            try:
+                latency, result = await make_call(i)
+                latencies.append(latency)
+                results.append(result)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return latencies, results, errors, time.perf_counter() - started
+
+
+async def scenario_topics(ctx):
+    # Uncached topic-only quizzes at increasing concurrency
+    levels = {}
+    for level in ctx.args.levels:
+        def call(i, level=level):
+            data = {"topic": f"bench topic {level}-{i} {time.time()}", "num_questions": "5", "no_cache": "true"}
+            return post_quiz(ctx.client, ctx.url, data)
+
+        latencies, _, errors, elapsed = await run_concurrent(level * 4, level, call)
+        levels[str(level)] = latency_summary(latencies, elapsed, errors)
+    return {"levels": levels}
+
+
+async def scenario_stream(ctx):
+    # Time to the first streamed question vs the whole quiz
+    async def call(i):
+        started = time.perf_counter()
+        first = None
+        data = {"topic": f"bench stream {i} {time.time()}", "num_questions": "10", "no_cache": "true"}
+        async with ctx.client.stream("POST", f"{ctx.url}/generate-quiz/stream", data=data) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.strip() and first is None:
+                    first = time.perf_counter() - started
+        return time.perf_counter() - started, first
+
+    latencies, ttfts, errors, elapsed = await run_concurrent(16, 16, call)
+    summary = latency_summary(latencies, elapsed, errors)
+    summary["ttft_p50_s"] = percentile([t for t in ttfts if t is not None], 50)
+    summary["ttft_p95_s"] = percentile([t for t in ttfts if t is not None], 95)
+    return summary
+
+
+async def upload(ctx, entry):
+    path = os.path.join(ctx.fixtures_dir, entry["name"])
+    with open(path, "rb") as f:
+        files = {"file": (entry["name"], f.read(), entry["mime"])}
+    started = time.perf_counter()
+    response = await ctx.client.post(f"{ctx.url}/documents", files=files)
+    response.raise_for_status()
+    return time.perf_counter() - started, response.json()
+
+
+async def scenario_documents(ctx):
+    # Extraction cost per fixture: the first upload is a cache miss, the second a hit
+    per_file = {}
+    for entry in ctx.manifest:
+        cold, info = await upload(ctx, entry)
+        warm, _ = await upload(ctx, entry)
+        per_file[entry["name"]] = {
+            "bytes": entry["bytes"],
+            "cold_s": round(cold, 4),
+            "warm_s": round(warm, 4),
+            "chars": info.get("chars"),
+            "context_tokens": info.get("context_tokens"),
+        }
+    return {"files": per_file}
+
+
+async def scenario_documents_generate(ctx):
+    # Concurrent quizzes from uploaded documents (extraction cached after the first)
+    entries = [e for e in ctx.manifest if e["size"] == "medium"]
+
+    def call(i):
+        entry = entries[i % len(entries)]
+        with open(os.path.join(ctx.fixtures_dir, entry["name"]), "rb") as f:
+            files = {"file": (entry["name"], f.read(), entry["mime"])}
+        data = {"topic": "", "num_questions": "5", "no_cache": "true"}
+        return post_quiz(ctx.client, ctx.url, data, files)
+
+    latencies, _, errors, elapsed = await run_concurrent(32, 8, call)
+    return latency_summary(latencies, elapsed, errors)
+
+
+async def scenario_malformed(ctx):
+    # A third of completions come back damaged; how many questions still arrive?
+    await ctx.client.post(f"{ctx.fake_url}/config", json={"malformed_rate": 0.3})
+    try:
+        def call(i):
+            data = {"topic": f"bench malformed {i} {time.time()}", "num_questions": "10", "no_cache": "true"}
+            return post_quiz(ctx.client, ctx.url, data)
+
+        latencies, counts, errors, elapsed = await run_concurrent(32, 8, call)
+    finally:
+        await ctx.client.post(f"{ctx.fake_url}/config", json={"malformed_rate": 0.0})
+    summary = latency_summary(latencies, elapsed, errors)
+    fake = (await ctx.client.get(f"{ctx.fake_url}/stats")).json()
+    summary["malformed_completions"] = fake["malformed"]
+    summary["questions_returned"] = sum(counts)
+    summary["questions_requested"] = 10 * (len(counts) + errors)
+    return summary
+
+
+class Context:
+    pass
+
+
+async def run_scenarios(args, server_pid):
+    ctx = Context()
+    ctx.args = args
+    ctx.url = args.url
+    ctx.fake_url = args.fake_url
+    ctx.fixtures_dir = args.fixtures
+    ctx.manifest = fixtures.ensure(args.fixtures)
+
+    sampler = TreeSampler(server_pid) if server_pid else None
+    if sampler:
+        sampler.start()
+
+    results = {}
+    async with httpx.AsyncClient(timeout=300, limits=httpx.Limits(max_connections=200)) as client:
+        ctx.client = client
+        for name in args.scenarios:
+            await client.post(f"{args.fake_url}/stats/reset")
+            before = await stage_totals(client, args.url)
+            pids = process_tree(server_pid) if server_pid else []
+            cpu_before = cpu_seconds(pids)
+            if sampler:
+                sampler.reset()
+
+            result = await globals()[f"scenario_{name}"](ctx)
+
+            if server_pid:
+                result["cpu_s"] = round(cpu_seconds(process_tree(server_pid)) - cpu_before, 3)
+                result["peak_rss_mb"] = round(sampler.peak / 1e6, 1)
+            result["stages"] = stage_delta(before, await stage_totals(client, args.url))
+            result["upstream_calls"] = (await client.get(f"{args.fake_url}/stats")).json()["calls"]
+            results[name] = result
+            print(f"{name}: {json.dumps({k: v for k, v in result.items() if k not in ('stages', 'files', 'levels')})}")
+            for level, summary in result.get("levels", {}).items():
+                print(f"  concurrency {level}: {json.dumps(summary)}")
+    if sampler:
+        sampler.running = False
+    return results
+
+
+def wait_ready(url, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            sys.exit(f"process for {url} exited with {proc.returncode}")
+        try:
+            httpx.get(f"{url}/stats", timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    sys.exit(f"{url} did not come up")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--levels", default="1,8,32", help="concurrency levels for the topics scenario")
+    ap.add_argument("--out", default="bench_results.json")
+    ap.add_argument("--fixtures", default=os.path.join(HERE, "fixtures"))
+    ap.add_argument("--latency", type=float, default=0.5, help="fake upstream time to first token")
+    ap.add_argument("--token-rate", type=float, default=200.0, help="fake upstream decode tokens/s")
+    ap.add_argument("--port", type=int, default=8123)
+    ap.add_argument("--fake-port", type=int, default=9123)
+    ap.add_argument("--url", default="", help="use an already running server")
+    ap.add_argument("--fake-url", default="", help="use an already running fake upstream")
+    ap.add_argument("--server-pid", type=int, default=0, help="pid of that server, for RSS/CPU")
+    args = ap.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    args.levels = [int(x) for x in args.levels.split(",")]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    procs = []
+    server_pid = args.server_pid
+    try:
+        if not args.fake_url:
+            args.fake_url = f"http://127.0.0.1:{args.fake_port}"
+            fake = subprocess.Popen([
+                sys.executable, os.path.join(HERE, "fake_openrouter.py"), "--port", str(args.fake_port),
+                "--latency", str(args.latency), "--token-rate", str(args.token_rate),
+            ])
+            procs.append(fake)
+            wait_ready(args.fake_url, fake)
+        if not args.url:
+            args.url = f"http://127.0.0.1:{args.port}"
+            env = dict(
+                os.environ,
+                OPENROUTER_API_KEY="bench",
+                OPENROUTER_URL=f"{args.fake_url}/api/v1/chat/completions",
+                RATE_LIMIT_PER_MIN="0",
+                POOL_HOT_REQUESTS="0",
+                BATCH_DIR=tempfile.mkdtemp(prefix="quizgen-bench-"),
+            )
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+                 "--port", str(args.port), "--log-level", "warning"],
+                cwd=ROOT, env=env,
+            )
+            procs.append(server)
+            server_pid = server.pid
+            wait_ready(args.url, server)
+
+        started = time.time()
+        results = asyncio.run(run_scenarios(args, server_pid))
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(started)),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "fake_latency_s": args.latency,
+            "fake_token_rate": args.token_rate,
+        },
+        "scenarios": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Build the production frontend into static/.
+
+    python build_frontend.py
+
+Needs Node.js; npx fetches esbuild and tailwindcss on first run. The App is taken
+from server.html_content, transpiled and minified with esbuild, and only the
+Tailwind classes it uses are compiled into a static stylesheet. Output files are
+content-hashed, so server.py can serve them with long-lived cache headers. When
+static/ doesn't exist the server falls back to the in-browser Babel page.
+"""
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+os.environ.setdefault("OPENROUTER_API_KEY", "build")
+
+import server  # noqa: E402
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT, "static")
+ESBUILD = "esbuild@0.23.1"
+TAILWIND = "tailwindcss@3.4.17"
+
+DEV_SCRIPTS = [
+    '<script src="https://unpkg.com/react@18/umd/react.development.js"></script>',
+    '<script src="https://unpkg.com/react-dom@18/umd/react-dom.development.js"></script>',
+    '<script src="https://unpkg.com/@babel/standalone/babel.min.js"></script>',
+    '<script src="https://cdn.tailwindcss.com"></script>',
+]
+PROD_SCRIPTS = [
+    '<script src="https://unpkg.com/react@18/umd/react.production.min.js" crossorigin></script>',
+    '<script src="https://unpkg.com/react-dom@18/umd/react-dom.production.min.js" crossorigin></script>',
+]
+
+
+def run(*args, cwd):
+    subprocess.run(["npx", "--yes", *args], cwd=cwd, check=True)
+
+
+def hashed_name(prefix, data, ext):
+    return f"{prefix}.{hashlib.sha256(data).hexdigest()[:10]}.{ext}"
+
+
+def main():
+    html = server.html_content
+    jsx = re.search(r'<script type="text/babel">(.*?)</script>', html, re.S).group(1)
+    style = re.search(r"<style>(.*?)</style>", html, re.S).group(1)
+
+    # @import must stay first; the page's own rules go after Tailwind like they did with the CDN
+    import_rule = r"@import\s+url\([^)]*\)[^;]*;"
+    imports = "\n".join(re.findall(import_rule, style))
+    rules = re.sub(import_rule, "", style)
+
+    with tempfile.TemporaryDirectory() as work:
+        with open(os.path.join(work, "app.jsx"), "w", encoding="utf-8") as f:
+            f.write(jsx)
+        with open(os.path.join(work, "input.css"), "w", encoding="utf-8") as f:
+            f.write(f"{imports}\n@tailwind base;\n@tailwind components;\n@tailwind utilities;\n{rules}")
+
+        run(ESBUILD, "app.jsx", "--loader:.jsx=jsx", "--minify", "--target=es2018",
+            "--define:process.env.NODE_ENV=\"production\"", "--outfile=app.js", cwd=work)
+        run(TAILWIND, "-i", "input.css", "-o", "app.css", "--content", "app.jsx", "--minify", cwd=work)
+
+        with open(os.path.join(work, "app.js"), "rb") as f:
+            js = f.read()
+        with open(os.path.join(work, "app.css"), "rb") as f:
+            css = f.read()
+
+    js_name = hashed_name("app", js, "js")
+    css_name = hashed_name("app", css, "css")
+
+    page = html
+    for dev, prod in zip(DEV_SCRIPTS, PROD_SCRIPTS + [""] * len(DEV_SCRIPTS)):
+        page = page.replace(dev, prod)
+    page = re.sub(r"\s*<style>.*?</style>", f'\n    <link rel="stylesheet" href="/static/{css_name}">', page, flags=re.S)
+    page = re.sub(r'<script type="text/babel">.*?</script>', f'<script src="/static/{js_name}"></script>', page, flags=re.S)
+
+    shutil.rmtree(STATIC_DIR, ignore_errors=True)
+    os.makedirs(STATIC_DIR)
+    for name, data in ((js_name, js), (css_name, css), ("index.html", page.encode("utf-8"))):
+        with open(os.path.join(STATIC_DIR, name), "wb") as f:
+            f.write(data)
+    print(f"Wrote static/index.html, static/{js_name} ({len(js)} bytes), static/{css_name} ({len(css)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,826 +1,4021 @@
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
-import requests
-import json
-import base64
-import uvicorn
-import random
-import re
-from io import BytesIO
-from PyPDF2 import PdfReader
-from zipfile import ZipFile
-from lxml import etree
-
-# --- ENV VAR CHECK ---
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-if not OPENROUTER_API_KEY:
-    raise RuntimeError(
-        "OPENROUTER_API_KEY is not set. Please define it as an environment variable."
-    )
-
-app = FastAPI()
-
-# --- CORS MIDDLEWARE ---
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# --- FRONTEND (React Single File) ---
-html_content = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>QuizGen</title>
-    
-    <script src="https://unpkg.com/react@18/umd/react.development.js"></script>
-    <script src="https://unpkg.com/react-dom@18/umd/react-dom.development.js"></script>
-    <script src="https://unpkg.com/@babel/standalone/babel.min.js"></script>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
-    <link rel="icon" type="image/svg+xml" href="data:image/svg+xml,%3Csvg width='64' height='64' viewBox='0 0 64 64' xmlns='http://www.w3.org/2000/svg'%3E%3Crect x='8' y='8' width='48' height='48' rx='12' ry='12' fill='%23111827'/%3E%3Cpath d='M34 14L22 32h8l-2 18 12-18h-8z' fill='%23ffffff'/%3E%3C/svg%3E">
-
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600&display=swap');
-
-        body {
-            margin: 0;
-            font-family: 'Inter', sans-serif;
-            background: radial-gradient(circle at 50% -20%, #f3f4f6, #e5e7eb);
-            height: 100vh;
-            overflow: hidden;
-            color: #1f2937;
-        }
-
-        .glass-panel {
-            background: rgba(255, 255, 255, 0.65);
-            backdrop-filter: blur(20px);
-            -webkit-backdrop-filter: blur(20px);
-            border: 1px solid rgba(255, 255, 255, 0.8);
-            box-shadow: 0 10px 40px -10px rgba(0, 0, 0, 0.05);
-        }
-
-        .smooth-input {
-            transition: all 0.3s ease;
-            border: 1px solid transparent;
-            background: rgba(255, 255, 255, 0.6);
-        }
-        .smooth-input:focus {
-            background: rgba(255, 255, 255, 0.95);
-            box-shadow: 0 4px 20px rgba(0, 0, 0, 0.03);
-            outline: none;
-        }
-
-        /* --- MAXUIUX SLIDER CSS --- */
-        .slider-container {
-            position: relative;
-            width: 100%;
-            height: 10px;
-            background: #D6D6DA;
-            border-radius: 999px;
-            cursor: pointer;
-            margin: 15px 0;
-        }
-
-        .slider-progress {
-            position: absolute;
-            height: 100%;
-            background: linear-gradient(117deg, #1f2937 0%, #4b5563 100%);
-            border-radius: 999px;
-            width: 0%;
-            z-index: 1;
-            pointer-events: none;
-        }
-
-        .slider-thumb-glass {
-            position: absolute;
-            top: 50%;
-            transform: translate(-50%, -50%);
-            width: 30px;
-            height: 20px;
-            border-radius: 999px;
-            cursor: grab;
-            z-index: 2;
-            background-color: #fff;
-            box-shadow: 0 1px 8px 0 rgba(0, 30, 63, 0.1), 0 0 2px 0 rgba(0, 9, 20, 0.1);
-            overflow: hidden;
-            transition: transform 0.15s ease, height 0.15s ease;
-        }
-
-        .slider-thumb-glass-filter {
-            position: absolute;
-            inset: 0;
-            z-index: 0;
-            backdrop-filter: blur(0.6px);
-            -webkit-backdrop-filter: blur(0.6px);
-            filter: url(#mini-liquid-lens);
-        }
-
-        .slider-thumb-glass-overlay {
-            position: absolute;
-            inset: 0;
-            z-index: 1;
-            background-color: rgba(255, 255, 255, 0.1);
-        }
-
-        .slider-thumb-glass-specular {
-            position: absolute;
-            inset: 0;
-            z-index: 2;
-            border-radius: inherit;
-            box-shadow:
-                inset 1px 1px 0 rgba(69, 168, 243, 0.2),
-                inset 1px 3px 0 rgba(28, 63, 90, 0.05),
-                inset 0 0 22px rgb(255 255 255 / 60%),
-                inset -1px -1px 0 rgba(69, 168, 243, 0.12);
-        }
-
-        .slider-thumb-glass-filter,
-        .slider-thumb-glass-overlay,
-        .slider-thumb-glass-specular {
-            opacity: 0;
-            transition: opacity 0.2s ease;
-        }
-
-        /* Active State (Dragging) */
-        .slider-thumb-glass.active {
-            background-color: transparent;
-            box-shadow: none;
-            cursor: grabbing;
-        }
-
-        .slider-thumb-glass.active .slider-thumb-glass-filter,
-        .slider-thumb-glass.active .slider-thumb-glass-overlay,
-        .slider-thumb-glass.active .slider-thumb-glass-specular {
-            opacity: 1;
-        }
-
-        .slider-thumb-glass:active {
-            transform: translate(-50%, -50%) scaleY(0.98) scaleX(1.1);
-        }
-
-        /* Hover State */
-        .slider-container:hover .slider-thumb-glass-filter,
-        .slider-container:hover .slider-thumb-glass-overlay,
-        .slider-container:hover .slider-thumb-glass-specular {
-            opacity: 0.5;
-        }
-
-        /* --- BUTTONS --- */
-        .smooth-btn {
-            transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1);
-        }
-        .smooth-btn:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 10px 25px -5px rgba(0, 0, 0, 0.1);
-        }
-        .smooth-btn:active {
-            transform: translateY(0px);
-        }
-
-        .animate-fade-in {
-            animation: fadeIn 0.5s ease-out forwards;
-        }
-        @keyframes fadeIn {
-            from { opacity: 0; transform: translateY(10px); }
-            to { opacity: 1; transform: translateY(0); }
-        }
-    </style>
-</head>
-<body>
-    <svg width="0" height="0" style="position: absolute; z-index: -1;">
-        <filter id="mini-liquid-lens" x="-50%" y="-50%" width="200%" height="200%">
-            <feImage x="0" y="0" result="normalMap" xlink:href="data:image/svg+xml;utf8,
-            <svg xmlns='http://www.w3.org/2000/svg' width='300' height='300'>
-                <radialGradient id='invmap' cx='50%' cy='50%' r='75%'>
-                <stop offset='0%' stop-color='rgb(128,128,255)'/>
-                <stop offset='90%' stop-color='rgb(255,255,255)'/>
-                </radialGradient>
-                <rect width='100%' height='100%' fill='url(#invmap)'/>
-            </svg>" />
-            <feDisplacementMap in="SourceGraphic" in2="normalMap" scale="-252" xChannelSelector="R" yChannelSelector="G" result="displaced" />
-            <feMerge>
-                <feMergeNode in="displaced" />
-            </feMerge>
-        </filter>
-    </svg>
-
-    <div id="root"></div>
-
-    <script type="text/babel">
-        const { useState, useEffect, useRef } = React;
-
-        // --- CUSTOM REACT SLIDER COMPONENT ---
-        const GlassSlider = ({ min, max, value, onChange }) => {
-            const sliderRef = useRef(null);
-            const [isDragging, setIsDragging] = useState(false);
-
-            const calculateValue = (clientX) => {
-                if (!sliderRef.current) return;
-                const rect = sliderRef.current.getBoundingClientRect();
-                const offsetX = clientX - rect.left;
-                let percent = offsetX / rect.width;
-                percent = Math.max(0, Math.min(1, percent)); 
-                const newValue = min + percent * (max - min);
-                onChange(newValue);
-            };
-
-            const handleMouseDown = (e) => {
-                setIsDragging(true);
-                calculateValue(e.clientX);
-                document.addEventListener('mousemove', handleMouseMove);
-                document.addEventListener('mouseup', handleMouseUp);
-            };
-
-            const handleMouseMove = (e) => {
-                calculateValue(e.clientX);
-            };
-
-            const handleMouseUp = () => {
-                setIsDragging(false);
-                document.removeEventListener('mousemove', handleMouseMove);
-                document.removeEventListener('mouseup', handleMouseUp);
-            };
-
-            const handleTouchStart = (e) => {
-                setIsDragging(true);
-                calculateValue(e.touches[0].clientX);
-                document.addEventListener('touchmove', handleTouchMove, { passive: false });
-                document.addEventListener('touchend', handleTouchEnd);
-            };
-
-            const handleTouchMove = (e) => {
-                calculateValue(e.touches[0].clientX);
-            };
-
-            const handleTouchEnd = () => {
-                setIsDragging(false);
-                document.removeEventListener('touchmove', handleTouchMove);
-                document.removeEventListener('touchend', handleTouchEnd);
-            };
-
-            const percent = ((value - min) / (max - min)) * 100;
-
-            return (
-                <div 
-                    className="slider-container" 
-                    ref={sliderRef}
-                    onMouseDown={handleMouseDown}
-                    onTouchStart={handleTouchStart}
-                >
-                    <div className="slider-progress" style={{ width: `${percent}%` }}></div>
-                    <div 
-                        className={`slider-thumb-glass ${isDragging ? 'active' : ''}`} 
-                        id="thumb"
-                        style={{ left: `${percent}%` }}
-                    >
-                        <div className="slider-thumb-glass-filter"></div>
-                        <div className="slider-thumb-glass-overlay"></div>
-                        <div className="slider-thumb-glass-specular"></div>
-                    </div>
-                </div>
-            );
-        };
-
-        function App() {
-            const [view, setView] = useState('setup'); 
-            const [topic, setTopic] = useState('');
-            
-            // Slider Value 
-            const [numQuestions, setNumQuestions] = useState(10);
-            
-            const [file, setFile] = useState(null);
-            const [loading, setLoading] = useState(false);
-            
-            const [questions, setQuestions] = useState([]);
-            const [currentIdx, setCurrentIdx] = useState(0);
-            const [score, setScore] = useState(0);
-            const [userAnswers, setUserAnswers] = useState({});
-            const [showFeedback, setShowFeedback] = useState(false);
-
-            // Add More Logic
-            const [moreQuestions, setMoreQuestions] = useState(10);
-            const [addingMore, setAddingMore] = useState(false);
-
-            const handleGenerate = async () => {
-                if (!topic && !file) return alert("Please enter a topic or upload a file."); 
-                
-                setLoading(true);
-
-                const formData = new FormData();
-                formData.append('topic', topic || ""); 
-                formData.append('num_questions', Math.round(numQuestions)); 
-                if (file) formData.append('file', file);
-
-                try {
-                    const res = await fetch('/generate-quiz', { method: 'POST', body: formData });
-                    if (!res.ok) {
-                        const errText = await res.text();
-                        try {
-                            const errJson = JSON.parse(errText);
-                            if (errJson.detail) {
-                                if (Array.isArray(errJson.detail)) {
-                                    throw new Error(errJson.detail.map(e => e.msg).join(", "));
-                                }
-                                throw new Error(errJson.detail);
-                            }
-                        } catch (e) {
-                            throw new Error(errText);
-                        }
-                    }
-                    const data = await res.json();
-                    
-                    setQuestions(data);
-                    setScore(0);
-                    setCurrentIdx(0);
-                    setUserAnswers({});
-                    setShowFeedback(false);
-                    setView('quiz');
-                } catch (err) {
-                    alert("Error: " + err.message);
-                } finally {
-                    setLoading(false);
-                }
-            };
-
-            const handleAddMoreQuestions = async () => {
-                setAddingMore(true);
-
-                const formData = new FormData();
-                formData.append('topic', topic || "");
-                formData.append('num_questions', Math.round(moreQuestions));
-                if (file) formData.append('file', file);
-
-                try {
-                    const res = await fetch('/generate-quiz', { method: 'POST', body: formData });
-                    if (!res.ok) {
-                        const errText = await res.text();
-                        throw new Error(errText);
-                    }
-                    const data = await res.json();
-                    const startIndex = questions.length;
-                    setQuestions(prev => [...prev, ...data]);
-                    setShowFeedback(false);
-                    setCurrentIdx(startIndex);
-                    setView('quiz');
-                } catch (err) {
-                    alert("Error: " + err.message);
-                } finally {
-                    setAddingMore(false);
-                }
-            };
-
-            const handleAnswer = (index) => {
-                if (showFeedback) return;
-                setUserAnswers(prev => ({...prev, [currentIdx]: index}));
-                setShowFeedback(true);
-                if (index === questions[currentIdx].correct) setScore(s => s + 1);
-            };
-
-            const handleSkip = () => {
-                if (showFeedback) return;
-                setUserAnswers(prev => ({...prev, [currentIdx]: 'skipped'}));
-                moveToNext();
-            };
-
-            const moveToNext = () => {
-                if (currentIdx < questions.length - 1) {
-                    setCurrentIdx(c => c + 1);
-                    setShowFeedback(false);
-                } else {
-                    setView('results');
-                }
-            };
-
-            const startRetry = () => {
-                const questionsToRetry = questions.filter((q, i) => {
-                    const ans = userAnswers[i];
-                    return ans === 'skipped' || ans !== q.correct;
-                });
-                if (questionsToRetry.length === 0) return;
-                setQuestions(questionsToRetry);
-                setScore(0);
-                setCurrentIdx(0);
-                setUserAnswers({});
-                setShowFeedback(false);
-                setView('quiz');
-            };
-
-            if (view === 'setup') return (
-                <div className="h-screen w-full relative">
-                    <div className="absolute top-8 left-10 z-10">
-                        <div className="flex items-center gap-3">
-                            <div className="bg-gray-900 text-white w-8 h-8 flex items-center justify-center rounded-lg shadow-lg">
-                                <i className="fas fa-bolt text-sm"></i>
-                            </div>
-                            <h1 className="text-xl font-bold tracking-tight text-gray-800">QuizGen</h1>
-                        </div>
-                    </div>
-
-                    <div className="flex items-center justify-center h-full p-4">
-                        <div className="glass-panel w-full max-w-xl p-10 rounded-3xl animate-fade-in relative">
-                            
-                            <div className="mt-6 space-y-8">
-                                <div className="text-center">
-                                    <h2 className="text-2xl font-semibold text-gray-800">What are we learning?</h2>
-                                </div>
-
-                                <div className="relative">
-                                    <textarea 
-                                        className="smooth-input w-full rounded-2xl p-5 text-lg h-40 resize-none text-gray-800 placeholder-gray-400"
-                                        placeholder="Type a topic, subject, or paste notes..."
-                                        value={topic}
-                                        onChange={e => setTopic(e.target.value)}
-                                    ></textarea>
-                                    
-                                    <div className="absolute bottom-3 right-3">
-                                        <label className="cursor-pointer group flex items-center gap-2">
-                                            <input type="file" className="hidden" onChange={e => setFile(e.target.files[0])} />
-                                            <span className={`text-xs font-medium px-3 py-1.5 rounded-lg transition-all duration-300 ${file ? 'bg-green-100 text-green-700' : 'bg-white shadow-sm text-gray-400 hover:text-gray-700 hover:shadow-md'}`}>
-                                                {file ? file.name : <span><i className="fas fa-plus mr-1"></i> Context</span>}
-                                            </span>
-                                        </label>
-                                    </div>
-                                </div>
-
-                                <div className="px-2">
-                                    <div className="flex justify-between text-xs font-medium text-gray-400 mb-2 uppercase tracking-wide">
-                                        <span>Length</span>
-                                        <span>{Math.round(numQuestions)} Questions</span>
-                                    </div>
-                                    
-                                    {/* --- CUSTOM GLASS SLIDER --- */}
-                                    <GlassSlider 
-                                        min={5} 
-                                        max={50} 
-                                        value={numQuestions} 
-                                        onChange={setNumQuestions} 
-                                    />
-                                </div>
-
-                                <button 
-                                    onClick={handleGenerate}
-                                    disabled={loading}
-                                    className="smooth-btn w-full bg-gray-900 text-white h-14 rounded-2xl font-medium text-lg disabled:opacity-50 disabled:cursor-not-allowed"
-                                >
-                                    {loading ? <i className="fas fa-circle-notch fa-spin"></i> : "Generate Quiz"}
-                                </button>
-                            </div>
-                        </div>
-                    </div>
-                </div>
-            );
-
-            if (view === 'quiz') {
-                const q = questions[currentIdx];
-                const progress = ((currentIdx + 1) / questions.length) * 100;
-                const userAnswer = userAnswers[currentIdx];
-
-                return (
-                    <div className="h-screen flex flex-col items-center justify-center p-6">
-                        <div className="glass-panel w-full max-w-3xl h-[85vh] rounded-3xl flex flex-col overflow-hidden animate-fade-in border-0 shadow-2xl">
-                            
-                            <div className="px-10 py-6 border-b border-gray-100/50 flex justify-between items-center bg-white/40">
-                                <span className="font-mono text-xs font-semibold text-gray-400 uppercase tracking-widest">
-                                    Question {currentIdx + 1} / {questions.length}
-                                </span>
-                                <div className="bg-white/60 px-3 py-1 rounded-lg text-xs font-bold text-gray-700 shadow-sm">
-                                    Score: {score}
-                                </div>
-                            </div>
-                            
-                            <div className="w-full bg-gray-100/50 h-1">
-                                <div className="bg-gray-800 h-1 transition-all duration-700 ease-out" style={{width: `${progress}%`}}></div>
-                            </div>
-
-                            <div className="flex-1 overflow-y-auto p-10 md:p-14">
-                                <h2 className="text-2xl md:text-3xl font-bold text-gray-800 mb-12 leading-tight">{q.text}</h2>
-                                
-                                <div className="space-y-4">
-                                    {q.options.map((opt, i) => {
-                                        let btnClass = "smooth-btn w-full text-left p-5 rounded-2xl border flex items-center gap-5 group relative overflow-hidden ";
-                                        
-                                        if (showFeedback) {
-                                            if (i === q.correct) btnClass += "border-green-500 bg-green-50 text-green-900";
-                                            else if (i === userAnswer && userAnswer !== 'skipped') btnClass += "border-red-500 bg-red-50 text-red-900";
-                                            else btnClass += "border-transparent bg-gray-50/50 opacity-40";
-                                        } else {
-                                            btnClass += "border-transparent bg-white/60 hover:bg-white hover:border-gray-200 hover:shadow-lg text-gray-600";
-                                        }
-
-                                        return (
-                                            <button key={i} onClick={() => handleAnswer(i)} disabled={showFeedback} className={btnClass}>
-                                                <span className={`w-8 h-8 flex-none flex items-center justify-center rounded-lg text-xs font-bold transition-all duration-500 ${showFeedback && i === q.correct ? 'bg-green-200 text-green-800' : 'bg-gray-100 text-gray-400 group-hover:bg-gray-900 group-hover:text-white'}`}>
-                                                    {String.fromCharCode(65 + i)}
-                                                </span>
-                                                <span className="font-medium text-lg">{opt}</span>
-                                            </button>
-                                        );
-                                    })}
-                                </div>
-
-                                {showFeedback && (
-                                    <div className="mt-10 p-6 bg-white/60 rounded-2xl border border-gray-100 shadow-sm animate-fade-in backdrop-blur-md">
-                                        <div className="flex items-start gap-4">
-                                            <div>
-                                                <h4 className={`font-bold text-lg mb-1 ${userAnswer === q.correct ? 'text-green-700' : 'text-red-700'}`}>
-                                                    {userAnswer === q.correct ? 'Correct' : 'Incorrect'}
-                                                </h4>
-                                                <p className="text-gray-600 leading-relaxed">{q.rationale}</p>
-                                            </div>
-                                        </div>
-                                    </div>
-                                )}
-                                <div className="h-24"></div>
-                            </div>
-
-                            <div className="p-6 bg-white/60 border-t border-gray-100/50 absolute bottom-0 w-full flex justify-between items-center backdrop-blur-md">
-                                {!showFeedback ? (
-                                    <button 
-                                        onClick={handleSkip}
-                                        className="text-gray-400 hover:text-gray-600 text-sm font-medium px-4 py-2 transition-colors flex items-center gap-2"
-                                    >
-                                        Skip <i className="fas fa-forward text-xs"></i>
-                                    </button>
-                                ) : <div></div>}
-
-                                <button 
-                                    onClick={moveToNext}
-                                    className={`smooth-btn bg-gray-900 text-white font-medium py-3 px-10 rounded-full shadow-xl hover:shadow-2xl active:scale-95 ${!showFeedback ? 'invisible' : ''}`}
-                                >
-                                    Continue
-                                </button>
-                            </div>
-                        </div>
-                    </div>
-                );
-            }
-
-            if (view === 'results') {
-                const skippedCount = Object.values(userAnswers).filter(a => a === 'skipped').length;
-                const correctCount = score;
-                const wrongCount = questions.length - correctCount - skippedCount;
-                const hasMistakes = (skippedCount + wrongCount) > 0;
-
-                return (
-                    <div className="flex items-center justify-center h-screen p-6">
-                        <div className="glass-panel w-full max-w-md p-12 rounded-3xl text-center animate-fade-in relative">
-                            <h2 className="text-3xl font-bold text-gray-900 mb-2">Quiz Complete</h2>
-                            
-                            <div className="text-7xl font-bold text-gray-800 my-8 tracking-tighter">
-                                {Math.round((score / questions.length) * 100)}<span className="text-2xl text-gray-400 font-normal">%</span>
-                            </div>
-                            
-                            <div className="flex justify-center gap-6 mb-10 text-sm font-medium text-gray-500 uppercase tracking-widest">
-                                <div className="flex flex-col">
-                                    <span className="text-green-600 font-bold text-lg">{correctCount}</span>
-                                    <span>Right</span>
-                                </div>
-                                <div className="flex flex-col">
-                                    <span className="text-red-500 font-bold text-lg">{wrongCount}</span>
-                                    <span>Wrong</span>
-                                </div>
-                                <div className="flex flex-col">
-                                    <span className="text-amber-500 font-bold text-lg">{skippedCount}</span>
-                                    <span>Skipped</span>
-                                </div>
-                            </div>
-                            
-                            <div className="space-y-3 mb-8">
-                                {hasMistakes && (
-                                    <button 
-                                        onClick={startRetry}
-                                        className="smooth-btn w-full bg-gray-900 text-white font-medium py-4 rounded-xl shadow-lg hover:shadow-xl transition flex items-center justify-center gap-2"
-                                    >
-                                        <i className="fas fa-undo"></i> Retry {skippedCount + wrongCount} Mistakes
-                                    </button>
-                                )}
-
-                                <button 
-                                    onClick={() => setView('setup')}
-                                    className="smooth-btn w-full bg-white border border-gray-200 text-gray-900 font-medium py-4 rounded-xl hover:bg-gray-50 transition shadow-sm"
-                                >
-                                    Start New Quiz
-                                </button>
-                            </div>
-
-                            {/* Add More Section with Liquid Slider */}
-                            <div className="mt-4 pt-5 border-t border-gray-100/50 text-left">
-                                <div className="mb-3">
-                                    <div className="flex justify-between text-[10px] font-semibold text-gray-400 mb-2 uppercase tracking-widest">
-                                        <span>Add More</span>
-                                        <span>{Math.round(moreQuestions)} Questions</span>
-                                    </div>
-                                    <GlassSlider
-                                        min={1}
-                                        max={50}
-                                        value={moreQuestions}
-                                        onChange={setMoreQuestions}
-                                    />
-                                </div>
-                                <button
-                                    onClick={handleAddMoreQuestions}
-                                    disabled={addingMore}
-                                    className="smooth-btn w-full bg-gray-900 text-white font-medium py-3 rounded-xl shadow-lg hover:shadow-xl disabled:opacity-50 disabled:cursor-not-allowed flex items-center justify-center gap-2"
-                                >
-                                    {addingMore ? (
-                                        <>
-                                            <i className="fas fa-circle-notch fa-spin"></i>
-                                            Generating...
-                                        </>
-                                    ) : (
-                                        <>
-                                            <i className="fas fa-plus-circle"></i>
-                                            Add Questions
-                                        </>
-                                    )}
-                                </button>
-                            </div>
-                        </div>
-                    </div>
-                );
-            }
-        }
-
-        const root = ReactDOM.createRoot(document.getElementById('root'));
-        root.render(<App />);
-    </script>
-</body>
-</html>
-"""
-
-@app.get("/")
-async def get_index():
-    return HTMLResponse(content=html_content)
-
-@app.post("/generate-quiz")
-async def generate_quiz(
-        topic: str = Form(""),
-        num_questions: int = Form(...),
-        file: UploadFile = File(None)
-):
-    # Safety clamp
-    if num_questions < 1: num_questions = 1
-    if num_questions > 50: num_questions = 50
-
-    if not topic.strip() and not file:
-        raise HTTPException(status_code=400, detail="Please enter a topic or upload a file.")
-
-    url = "https://openrouter.ai/api/v1/chat/completions"
-
-    system_msg = """
-    You are a strict JSON Quiz Generator.
-    Task: Create a multiple choice quiz.
-    Use only the provided CONTEXT text (from the uploaded file or text topic) as your source of truth.
-    Do not invent facts that are not present in the CONTEXT.
-    OUTPUT RULES:
-    1. Return ONLY valid JSON. No markdown.
-    2. Structure: [{"text": "Question?", "options": ["A", "B", "C", "D"], "correct": 0, "rationale": "Why?"}]
-    """
-
-    # UNIFIED MODEL: QWEN 2.5 VL 72B (Vision + Text)
-    model = "qwen/qwen2.5-vl-72b-instruct"
-
-    # PROMPT
-    if topic.strip():
-        user_content = f"Generate {num_questions} questions about: {topic}"
-    else:
-        user_content = f"Generate {num_questions} questions based ENTIRELY on the file content below. Do not simply copy and paste the text from the file, but make the quiz based on concepts within the text."
-
-    messages = [{"role": "system", "content": system_msg}]
-
-    if file:
-        content = await file.read()
-        mime = file.content_type or ""
-        filename = (file.filename or "").lower()
-
-        # IMAGE
-        if "image" in mime:
-            b64 = base64.b64encode(content).decode('utf-8')
-            messages.append({
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": user_content},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:{mime};base64,{b64}"}
-                    }
-                ]
-            })
-
-        # PDF
-        elif "pdf" in mime or filename.endswith(".pdf"):
-            try:
-                reader = PdfReader(BytesIO(content))
-                text_content = "\n".join(page.extract_text() or "" for page in reader.pages)
-                messages.append({"role": "user", "content": f"{user_content}\n\nCONTEXT (PDF):\n{text_content[:25000]}"})
-            except Exception as e:
-                raise HTTPException(400, f"Error reading PDF: {str(e)}")
-
-        # DOCX (Simple parsing via regex/xml fallback)
-        elif "word" in mime or filename.endswith(".docx"):
-            try:
-                with ZipFile(BytesIO(content)) as docx_zip:
-                    with docx_zip.open("word/document.xml") as doc_xml:
-                        xml_content = doc_xml.read()
-                root = etree.fromstring(xml_content)
-                ns = {"w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main"}
-                text_nodes = root.xpath("//w:t/text()", namespaces=ns)
-                docx_text = "\n".join(text_nodes)
-                messages.append({"role": "user", "content": f"{user_content}\n\nCONTEXT (DOCX):\n{docx_text[:25000]}"})
-            except:
-                try:
-                    # Fallback to UTF-8
-                    text = content.decode('utf-8', errors='ignore')
-                    messages.append({"role": "user", "content": f"{user_content}\n\nCONTEXT (RAW):\n{text[:25000]}"})
-                except:
-                    raise HTTPException(400, "DOCX parsing failed. Try PDF or Text.")
-
-        # TEXT
-        else:
-            text = content.decode('utf-8', errors='ignore')
-            messages.append({"role": "user", "content": f"{user_content}\n\nCONTEXT:\n{text[:25000]}"})
-    else:
-        messages.append({"role": "user", "content": user_content})
-
-    try:
-        response = requests.post(
-            url,
-            # AUTH HEADERS - USES GLOBAL ENV VAR NOW
-            headers={
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "Content-Type": "application/json",
-                "Referer": "http://localhost:8000",
-                "X-Title": "QuizGen"
-            },
-            json={
-                "model": model,
-                "messages": messages,
-                "temperature": 0.7
-            },
-            timeout=180
-        )
-
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
-
-        result = response.json()
-        content_str = result['choices'][0]['message']['content']
-
-        # ROBUST REGEX JSON PARSING
-        json_match = re.search(r'\[.*\]', content_str, flags=re.DOTALL)
-        if json_match:
-            clean = json_match.group(0)
-        else:
-            clean = content_str.replace("```json", "").replace("```", "").strip()
-
-        data = json.loads(clean)
-
-        if isinstance(data, dict) and "questions" in data: data = data["questions"]
-
-        # CRASH-PROOF SHUFFLING
-        final_questions = []
-        for q in data:
-            if (
-                    "options" not in q or
-                    "correct" not in q or
-                    not isinstance(q["options"], list)
-            ):
-                continue
-
-            if q["correct"] >= len(q["options"]) or q["correct"] < 0:
-                continue
-
-            opts = q['options']
-            correct_txt = opts[q['correct']]
-            random.shuffle(opts)
-
-            try:
-                new_idx = opts.index(correct_txt)
-                q['options'] = opts
-                q['correct'] = new_idx
-                final_questions.append(q)
-            except ValueError:
-                continue
-
-        if not final_questions:
-            raise HTTPException(500, "Failed to generate valid questions. Try again.")
-
-        return final_questions
-
-    except Exception as e:
-        print(f"Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import httpx
+import json
+import base64
+import io
+import uvicorn
+import random
+import re
+import time
+import asyncio
+import hashlib
+import secrets
+import shutil
+import sqlite3
+import tempfile
+import gzip
+import mimetypes
+import copy
+import math
+import mmap
+import multiprocessing
+import contextvars
+from contextlib import contextmanager
+from collections import Counter, OrderedDict, deque
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PyPDF2 import PdfReader
+from zipfile import ZipFile
+from lxml import etree
+from starlette.background import BackgroundTask
+from starlette.middleware import Middleware
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# --- ENV VAR CHECK ---
+# Checked when the server starts (ENTRY POINT, open_http_client) rather than on
+# import, so extraction workers and the bench scripts can import this module.
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+MISSING_KEY_MESSAGE = "OPENROUTER_API_KEY is not set. Please define it as an environment variable."
+
+# Server processes on this machine. The entry point sets it for its workers; the
+# per-process pools and limits below default to each worker's share.
+WORKERS = max(1, int(os.getenv("WORKERS", "1")))
+
+# --- UPSTREAM CONFIG ---
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "1") == "1"
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "180"))
+
+app = FastAPI()
+
+# --- CORS MIDDLEWARE ---
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["X-Quiz-Warning"],
+)
+
+# --- FRONTEND (React Single File) ---
+html_content = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>QuizGen</title>
+    
+    <script src="https://unpkg.com/react@18/umd/react.development.js"></script>
+    <script src="https://unpkg.com/react-dom@18/umd/react-dom.development.js"></script>
+    <script src="https://unpkg.com/@babel/standalone/babel.min.js"></script>
+    <script src="https://cdn.tailwindcss.com"></script>
+    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
+    <link rel="icon" type="image/svg+xml" href="data:image/svg+xml,%3Csvg width='64' height='64' viewBox='0 0 64 64' xmlns='http://www.w3.org/2000/svg'%3E%3Crect x='8' y='8' width='48' height='48' rx='12' ry='12' fill='%23111827'/%3E%3Cpath d='M34 14L22 32h8l-2 18 12-18h-8z' fill='%23ffffff'/%3E%3C/svg%3E">
+
+    <style>
+        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600&display=swap');
+
+        body {
+            margin: 0;
+            font-family: 'Inter', sans-serif;
+            background: radial-gradient(circle at 50% -20%, #f3f4f6, #e5e7eb);
+            height: 100vh;
+            overflow: hidden;
+            color: #1f2937;
+        }
+
+        .glass-panel {
+            background: rgba(255, 255, 255, 0.65);
+            backdrop-filter: blur(20px);
+            -webkit-backdrop-filter: blur(20px);
+            border: 1px solid rgba(255, 255, 255, 0.8);
+            box-shadow: 0 10px 40px -10px rgba(0, 0, 0, 0.05);
+        }
+
+        .smooth-input {
+            transition: all 0.3s ease;
+            border: 1px solid transparent;
+            background: rgba(255, 255, 255, 0.6);
+        }
+        .smooth-input:focus {
+            background: rgba(255, 255, 255, 0.95);
+            box-shadow: 0 4px 20px rgba(0, 0, 0, 0.03);
+            outline: none;
+        }
+
+        /* --- MAXUIUX SLIDER CSS --- */
+        .slider-container {
+            position: relative;
+            width: 100%;
+            height: 10px;
+            background: #D6D6DA;
+            border-radius: 999px;
+            cursor: pointer;
+            margin: 15px 0;
+        }
+
+        .slider-progress {
+            position: absolute;
+            height: 100%;
+            background: linear-gradient(117deg, #1f2937 0%, #4b5563 100%);
+            border-radius: 999px;
+            width: 0%;
+            z-index: 1;
+            pointer-events: none;
+        }
+
+        .slider-thumb-glass {
+            position: absolute;
+            top: 50%;
+            transform: translate(-50%, -50%);
+            width: 30px;
+            height: 20px;
+            border-radius: 999px;
+            cursor: grab;
+            z-index: 2;
+            background-color: #fff;
+            box-shadow: 0 1px 8px 0 rgba(0, 30, 63, 0.1), 0 0 2px 0 rgba(0, 9, 20, 0.1);
+            overflow: hidden;
+            transition: transform 0.15s ease, height 0.15s ease;
+        }
+
+        .slider-thumb-glass-filter {
+            position: absolute;
+            inset: 0;
+            z-index: 0;
+            backdrop-filter: blur(0.6px);
+            -webkit-backdrop-filter: blur(0.6px);
+            filter: url(#mini-liquid-lens);
+        }
+
+        .slider-thumb-glass-overlay {
+            position: absolute;
+            inset: 0;
+            z-index: 1;
+            background-color: rgba(255, 255, 255, 0.1);
+        }
+
+        .slider-thumb-glass-specular {
+            position: absolute;
+            inset: 0;
+            z-index: 2;
+            border-radius: inherit;
+            box-shadow:
+                inset 1px 1px 0 rgba(69, 168, 243, 0.2),
+                inset 1px 3px 0 rgba(28, 63, 90, 0.05),
+                inset 0 0 22px rgb(255 255 255 / 60%),
+                inset -1px -1px 0 rgba(69, 168, 243, 0.12);
+        }
+
+        .slider-thumb-glass-filter,
+        .slider-thumb-glass-overlay,
+        .slider-thumb-glass-specular {
+            opacity: 0;
+            transition: opacity 0.2s ease;
+        }
+
+        /* Active State (Dragging) */
+        .slider-thumb-glass.active {
+            background-color: transparent;
+            box-shadow: none;
+            cursor: grabbing;
+        }
+
+        .slider-thumb-glass.active .slider-thumb-glass-filter,
+        .slider-thumb-glass.active .slider-thumb-glass-overlay,
+        .slider-thumb-glass.active .slider-thumb-glass-specular {
+            opacity: 1;
+        }
+
+        .slider-thumb-glass:active {
+            transform: translate(-50%, -50%) scaleY(0.98) scaleX(1.1);
+        }
+
+        /* Hover State */
+        .slider-container:hover .slider-thumb-glass-filter,
+        .slider-container:hover .slider-thumb-glass-overlay,
+        .slider-container:hover .slider-thumb-glass-specular {
+            opacity: 0.5;
+        }
+
+        /* --- BUTTONS --- */
+        .smooth-btn {
+            transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1);
+        }
+        .smooth-btn:hover {
+            transform: translateY(-2px);
+            box-shadow: 0 10px 25px -5px rgba(0, 0, 0, 0.1);
+        }
+        .smooth-btn:active {
+            transform: translateY(0px);
+        }
+
+        .animate-fade-in {
+            animation: fadeIn 0.5s ease-out forwards;
+        }
+        @keyframes fadeIn {
+            from { opacity: 0; transform: translateY(10px); }
+            to { opacity: 1; transform: translateY(0); }
+        }
+    </style>
+</head>
+<body>
+    <svg width="0" height="0" style="position: absolute; z-index: -1;">
+        <filter id="mini-liquid-lens" x="-50%" y="-50%" width="200%" height="200%">
+            <feImage x="0" y="0" result="normalMap" xlink:href="data:image/svg+xml;utf8,
+            <svg xmlns='http://www.w3.org/2000/svg' width='300' height='300'>
+                <radialGradient id='invmap' cx='50%' cy='50%' r='75%'>
+                <stop offset='0%' stop-color='rgb(128,128,255)'/>
+                <stop offset='90%' stop-color='rgb(255,255,255)'/>
+                </radialGradient>
+                <rect width='100%' height='100%' fill='url(#invmap)'/>
+            </svg>" />
+            <feDisplacementMap in="SourceGraphic" in2="normalMap" scale="-252" xChannelSelector="R" yChannelSelector="G" result="displaced" />
+            <feMerge>
+                <feMergeNode in="displaced" />
+            </feMerge>
+        </filter>
+    </svg>
+
+    <div id="root"></div>
+
+    <script type="text/babel">
+        const { useState, useEffect, useRef } = React;
+
+        // --- CUSTOM REACT SLIDER COMPONENT ---
+        const GlassSlider = ({ min, max, value, onChange }) => {
+            const sliderRef = useRef(null);
+            const [isDragging, setIsDragging] = useState(false);
+
+            const calculateValue = (clientX) => {
+                if (!sliderRef.current) return;
+                const rect = sliderRef.current.getBoundingClientRect();
+                const offsetX = clientX - rect.left;
+                let percent = offsetX / rect.width;
+                percent = Math.max(0, Math.min(1, percent)); 
+                const newValue = min + percent * (max - min);
+                onChange(newValue);
+            };
+
+            const handleMouseDown = (e) => {
+                setIsDragging(true);
+                calculateValue(e.clientX);
+                document.addEventListener('mousemove', handleMouseMove);
+                document.addEventListener('mouseup', handleMouseUp);
+            };
+
+            const handleMouseMove = (e) => {
+                calculateValue(e.clientX);
+            };
+
+            const handleMouseUp = () => {
+                setIsDragging(false);
+                document.removeEventListener('mousemove', handleMouseMove);
+                document.removeEventListener('mouseup', handleMouseUp);
+            };
+
+            const handleTouchStart = (e) => {
+                setIsDragging(true);
+                calculateValue(e.touches[0].clientX);
+                document.addEventListener('touchmove', handleTouchMove, { passive: false });
+                document.addEventListener('touchend', handleTouchEnd);
+            };
+
+            const handleTouchMove = (e) => {
+                calculateValue(e.touches[0].clientX);
+            };
+
+            const handleTouchEnd = () => {
+                setIsDragging(false);
+                document.removeEventListener('touchmove', handleTouchMove);
+                document.removeEventListener('touchend', handleTouchEnd);
+            };
+
+            const percent = ((value - min) / (max - min)) * 100;
+
+            return (
+                <div 
+                    className="slider-container" 
+                    ref={sliderRef}
+                    onMouseDown={handleMouseDown}
+                    onTouchStart={handleTouchStart}
+                >
+                    <div className="slider-progress" style={{ width: `${percent}%` }}></div>
+                    <div 
+                        className={`slider-thumb-glass ${isDragging ? 'active' : ''}`} 
+                        id="thumb"
+                        style={{ left: `${percent}%` }}
+                    >
+                        <div className="slider-thumb-glass-filter"></div>
+                        <div className="slider-thumb-glass-overlay"></div>
+                        <div className="slider-thumb-glass-specular"></div>
+                    </div>
+                </div>
+            );
+        };
+
+        function App() {
+            const [view, setView] = useState('setup'); 
+            const [topic, setTopic] = useState('');
+            
+            // Slider Value 
+            const [numQuestions, setNumQuestions] = useState(10);
+            
+            const [file, setFile] = useState(null);
+            const [docId, setDocId] = useState(null);
+            const [sessionId, setSessionId] = useState(null);
+            const [loading, setLoading] = useState(false);
+            const [streaming, setStreaming] = useState(false);
+            
+            const [questions, setQuestions] = useState([]);
+            const [currentIdx, setCurrentIdx] = useState(0);
+            const [score, setScore] = useState(0);
+            const [userAnswers, setUserAnswers] = useState({});
+            const [showFeedback, setShowFeedback] = useState(false);
+
+            // Add More Logic
+            const [moreQuestions, setMoreQuestions] = useState(10);
+            const [addingMore, setAddingMore] = useState(false);
+
+            // Anonymous id for the server-side review schedule, kept across reloads
+            const [userId] = useState(() => {
+                let id = localStorage.getItem('quizgen_user');
+                if (!id) {
+                    id = Array.from(crypto.getRandomValues(new Uint8Array(16)), b => b.toString(16).padStart(2, '0')).join('');
+                    localStorage.setItem('quizgen_user', id);
+                }
+                return id;
+            });
+
+            const readError = async (res) => {
+                const errText = await res.text();
+                try {
+                    const errJson = JSON.parse(errText);
+                    if (Array.isArray(errJson.detail)) return new Error(errJson.detail.map(e => e.msg).join(", "));
+                    if (errJson.detail) return new Error(errJson.detail);
+                } catch (e) {}
+                return new Error(errText);
+            };
+
+            // A session holds the extracted document and the questions already served,
+            // so later rounds only send a count. The file is uploaded once; after that
+            // its doc_id is enough unless the server has expired it.
+            const createSession = async () => {
+                const buildForm = (withFile) => {
+                    const formData = new FormData();
+                    formData.append('topic', topic || "");
+                    if (file && withFile) formData.append('file', file);
+                    else if (docId) formData.append('doc_id', docId);
+                    return formData;
+                };
+                let res = await fetch('/sessions', { method: 'POST', body: buildForm(!docId) });
+                if (res.status === 404 && file) {
+                    res = await fetch('/sessions', { method: 'POST', body: buildForm(true) });
+                }
+                if (!res.ok) throw await readError(res);
+                const data = await res.json();
+                setSessionId(data.session_id);
+                if (data.doc_id) setDocId(data.doc_id);
+                return data.session_id;
+            };
+
+            const requestMore = async (id, count, stream) => {
+                const buildForm = () => {
+                    const formData = new FormData();
+                    formData.append('count', Math.round(count));
+                    formData.append('stream', stream ? 'true' : 'false');
+                    return formData;
+                };
+                let res = await fetch(`/sessions/${id}/more`, { method: 'POST', body: buildForm() });
+                if (res.status === 404) {
+                    // Session expired on the server; start a fresh one
+                    res = await fetch(`/sessions/${await createSession()}/more`, { method: 'POST', body: buildForm() });
+                }
+                if (!res.ok) throw await readError(res);
+                return res;
+            };
+
+            const handleGenerate = async () => {
+                if (!topic && !file) return alert("Please enter a topic or upload a file."); 
+                
+                setLoading(true);
+
+                try {
+                    const res = await requestMore(await createSession(), numQuestions, true);
+
+                    // Questions arrive as NDJSON: start the quiz on the first one, append the rest
+                    setStreaming(true);
+                    const reader = res.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffer = '';
+                    let started = false;
+                    while (true) {
+                        const { done, value } = await reader.read();
+                        if (done) break;
+                        buffer += decoder.decode(value, { stream: true });
+                        const lines = buffer.split('\\n');
+                        buffer = lines.pop();
+                        for (const line of lines) {
+                            if (!line.trim()) continue;
+                            const msg = JSON.parse(line);
+                            if (msg.error) throw new Error(msg.error);
+                            if (msg.warning) { alert(msg.warning); continue; }
+                            if (!started) {
+                                started = true;
+                                setQuestions([msg]);
+                                setScore(0);
+                                setCurrentIdx(0);
+                                setUserAnswers({});
+                                setShowFeedback(false);
+                                setView('quiz');
+                                setLoading(false);
+                            } else {
+                                setQuestions(prev => [...prev, msg]);
+                            }
+                        }
+                    }
+                } catch (err) {
+                    alert("Error: " + err.message);
+                } finally {
+                    setLoading(false);
+                    setStreaming(false);
+                }
+            };
+
+            const handleAddMoreQuestions = async () => {
+                setAddingMore(true);
+
+                try {
+                    const res = await requestMore(sessionId || await createSession(), moreQuestions, false);
+                    const data = await res.json();
+                    const warning = res.headers.get('X-Quiz-Warning');
+                    if (warning) alert(warning);
+                    const startIndex = questions.length;
+                    setQuestions(prev => [...prev, ...data]);
+                    setShowFeedback(false);
+                    setCurrentIdx(startIndex);
+                    setView('quiz');
+                } catch (err) {
+                    alert("Error: " + err.message);
+                } finally {
+                    setAddingMore(false);
+                }
+            };
+
+            const logAttempt = (q, answer) => {
+                const formData = new FormData();
+                formData.append('user_id', userId);
+                formData.append('question', JSON.stringify(q));
+                formData.append('answer', answer);
+                fetch('/attempts', { method: 'POST', body: formData }).catch(() => {});
+            };
+
+            const handleAnswer = (index) => {
+                if (showFeedback) return;
+                logAttempt(questions[currentIdx], index);
+                setUserAnswers(prev => ({...prev, [currentIdx]: index}));
+                setShowFeedback(true);
+                if (index === questions[currentIdx].correct) setScore(s => s + 1);
+            };
+
+            const handleSkip = () => {
+                if (showFeedback) return;
+                logAttempt(questions[currentIdx], 'skipped');
+                setUserAnswers(prev => ({...prev, [currentIdx]: 'skipped'}));
+                moveToNext();
+            };
+
+            const moveToNext = () => {
+                if (currentIdx < questions.length - 1) {
+                    setCurrentIdx(c => c + 1);
+                    setShowFeedback(false);
+                } else if (streaming) {
+                    return; // next question is still being generated
+                } else {
+                    setView('results');
+                }
+            };
+
+            // Questions from this and earlier quizzes that the server's schedule says are due
+            const [reviews, setReviews] = useState([]);
+            useEffect(() => {
+                if (view !== 'results') return;
+                fetch(`/reviews?user_id=${userId}&count=20`)
+                    .then(res => res.ok ? res.json() : [])
+                    .then(setReviews)
+                    .catch(() => setReviews([]));
+            }, [view]);
+
+            const replay = (questionsToAsk) => {
+                if (questionsToAsk.length === 0) return;
+                setQuestions(questionsToAsk);
+                setScore(0);
+                setCurrentIdx(0);
+                setUserAnswers({});
+                setShowFeedback(false);
+                setView('quiz');
+            };
+
+            const startRetry = () => replay(questions.filter((q, i) => {
+                const ans = userAnswers[i];
+                return ans === 'skipped' || ans !== q.correct;
+            }));
+
+            const startReview = () => replay(reviews);
+
+            if (view === 'setup') return (
+                <div className="h-screen w-full relative">
+                    <div className="absolute top-8 left-10 z-10">
+                        <div className="flex items-center gap-3">
+                            <div className="bg-gray-900 text-white w-8 h-8 flex items-center justify-center rounded-lg shadow-lg">
+                                <i className="fas fa-bolt text-sm"></i>
+                            </div>
+                            <h1 className="text-xl font-bold tracking-tight text-gray-800">QuizGen</h1>
+                        </div>
+                    </div>
+
+                    <div className="flex items-center justify-center h-full p-4">
+                        <div className="glass-panel w-full max-w-xl p-10 rounded-3xl animate-fade-in relative">
+                            
+                            <div className="mt-6 space-y-8">
+                                <div className="text-center">
+                                    <h2 className="text-2xl font-semibold text-gray-800">What are we learning?</h2>
+                                </div>
+
+                                <div className="relative">
+                                    <textarea 
+                                        className="smooth-input w-full rounded-2xl p-5 text-lg h-40 resize-none text-gray-800 placeholder-gray-400"
+                                        placeholder="Type a topic, subject, or paste notes..."
+                                        value={topic}
+                                        onChange={e => setTopic(e.target.value)}
+                                    ></textarea>
+                                    
+                                    <div className="absolute bottom-3 right-3">
+                                        <label className="cursor-pointer group flex items-center gap-2">
+                                            <input type="file" className="hidden" onChange={e => { setFile(e.target.files[0]); setDocId(null); }} />
+                                            <span className={`text-xs font-medium px-3 py-1.5 rounded-lg transition-all duration-300 ${file ? 'bg-green-100 text-green-700' : 'bg-white shadow-sm text-gray-400 hover:text-gray-700 hover:shadow-md'}`}>
+                                                {file ? file.name : <span><i className="fas fa-plus mr-1"></i> Context</span>}
+                                            </span>
+                                        </label>
+                                    </div>
+                                </div>
+
+                                <div className="px-2">
+                                    <div className="flex justify-between text-xs font-medium text-gray-400 mb-2 uppercase tracking-wide">
+                                        <span>Length</span>
+                                        <span>{Math.round(numQuestions)} Questions</span>
+                                    </div>
+                                    
+                                    {/* --- CUSTOM GLASS SLIDER --- */}
+                                    <GlassSlider 
+                                        min={5} 
+                                        max={100} 
+                                        value={numQuestions} 
+                                        onChange={setNumQuestions} 
+                                    />
+                                </div>
+
+                                <button 
+                                    onClick={handleGenerate}
+                                    disabled={loading}
+                                    className="smooth-btn w-full bg-gray-900 text-white h-14 rounded-2xl font-medium text-lg disabled:opacity-50 disabled:cursor-not-allowed"
+                                >
+                                    {loading ? <i className="fas fa-circle-notch fa-spin"></i> : "Generate Quiz"}
+                                </button>
+                            </div>
+                        </div>
+                    </div>
+                </div>
+            );
+
+            if (view === 'quiz') {
+                const q = questions[currentIdx];
+                const progress = ((currentIdx + 1) / questions.length) * 100;
+                const userAnswer = userAnswers[currentIdx];
+
+                return (
+                    <div className="h-screen flex flex-col items-center justify-center p-6">
+                        <div className="glass-panel w-full max-w-3xl h-[85vh] rounded-3xl flex flex-col overflow-hidden animate-fade-in border-0 shadow-2xl">
+                            
+                            <div className="px-10 py-6 border-b border-gray-100/50 flex justify-between items-center bg-white/40">
+                                <span className="font-mono text-xs font-semibold text-gray-400 uppercase tracking-widest">
+                                    Question {currentIdx + 1} / {questions.length}
+                                </span>
+                                <div className="bg-white/60 px-3 py-1 rounded-lg text-xs font-bold text-gray-700 shadow-sm">
+                                    Score: {score}
+                                </div>
+                            </div>
+                            
+                            <div className="w-full bg-gray-100/50 h-1">
+                                <div className="bg-gray-800 h-1 transition-all duration-700 ease-out" style={{width: `${progress}%`}}></div>
+                            </div>
+
+                            <div className="flex-1 overflow-y-auto p-10 md:p-14">
+                                <h2 className="text-2xl md:text-3xl font-bold text-gray-800 mb-12 leading-tight">{q.text}</h2>
+                                
+                                <div className="space-y-4">
+                                    {q.options.map((opt, i) => {
+                                        let btnClass = "smooth-btn w-full text-left p-5 rounded-2xl border flex items-center gap-5 group relative overflow-hidden ";
+                                        
+                                        if (showFeedback) {
+                                            if (i === q.correct) btnClass += "border-green-500 bg-green-50 text-green-900";
+                                            else if (i === userAnswer && userAnswer !== 'skipped') btnClass += "border-red-500 bg-red-50 text-red-900";
+                                            else btnClass += "border-transparent bg-gray-50/50 opacity-40";
+                                        } else {
+                                            btnClass += "border-transparent bg-white/60 hover:bg-white hover:border-gray-200 hover:shadow-lg text-gray-600";
+                                        }
+
+                                        return (
+                                            <button key={i} onClick={() => handleAnswer(i)} disabled={showFeedback} className={btnClass}>
+                                                <span className={`w-8 h-8 flex-none flex items-center justify-center rounded-lg text-xs font-bold transition-all duration-500 ${showFeedback && i === q.correct ? 'bg-green-200 text-green-800' : 'bg-gray-100 text-gray-400 group-hover:bg-gray-900 group-hover:text-white'}`}>
+                                                    {String.fromCharCode(65 + i)}
+                                                </span>
+                                                <span className="font-medium text-lg">{opt}</span>
+                                            </button>
+                                        );
+                                    })}
+                                </div>
+
+                                {showFeedback && (
+                                    <div className="mt-10 p-6 bg-white/60 rounded-2xl border border-gray-100 shadow-sm animate-fade-in backdrop-blur-md">
+                                        <div className="flex items-start gap-4">
+                                            <div>
+                                                <h4 className={`font-bold text-lg mb-1 ${userAnswer === q.correct ? 'text-green-700' : 'text-red-700'}`}>
+                                                    {userAnswer === q.correct ? 'Correct' : 'Incorrect'}
+                                                </h4>
+                                                <p className="text-gray-600 leading-relaxed">{q.rationale}</p>
+                                            </div>
+                                        </div>
+                                    </div>
+                                )}
+                                <div className="h-24"></div>
+                            </div>
+
+                            <div className="p-6 bg-white/60 border-t border-gray-100/50 absolute bottom-0 w-full flex justify-between items-center backdrop-blur-md">
+                                {!showFeedback ? (
+                                    <button 
+                                        onClick={handleSkip}
+                                        className="text-gray-400 hover:text-gray-600 text-sm font-medium px-4 py-2 transition-colors flex items-center gap-2"
+                                    >
+                                        Skip <i className="fas fa-forward text-xs"></i>
+                                    </button>
+                                ) : <div></div>}
+
+                                <button 
+                                    onClick={moveToNext}
+                                    className={`smooth-btn bg-gray-900 text-white font-medium py-3 px-10 rounded-full shadow-xl hover:shadow-2xl active:scale-95 ${!showFeedback ? 'invisible' : ''}`}
+                                >
+                                    {streaming && currentIdx === questions.length - 1 ? <i className="fas fa-circle-notch fa-spin"></i> : "Continue"}
+                                </button>
+                            </div>
+                        </div>
+                    </div>
+                );
+            }
+
+            if (view === 'results') {
+                const skippedCount = Object.values(userAnswers).filter(a => a === 'skipped').length;
+                const correctCount = score;
+                const wrongCount = questions.length - correctCount - skippedCount;
+                const hasMistakes = (skippedCount + wrongCount) > 0;
+
+                return (
+                    <div className="flex items-center justify-center h-screen p-6">
+                        <div className="glass-panel w-full max-w-md p-12 rounded-3xl text-center animate-fade-in relative">
+                            <h2 className="text-3xl font-bold text-gray-900 mb-2">Quiz Complete</h2>
+                            
+                            <div className="text-7xl font-bold text-gray-800 my-8 tracking-tighter">
+                                {Math.round((score / questions.length) * 100)}<span className="text-2xl text-gray-400 font-normal">%</span>
+                            </div>
+                            
+                            <div className="flex justify-center gap-6 mb-10 text-sm font-medium text-gray-500 uppercase tracking-widest">
+                                <div className="flex flex-col">
+                                    <span className="text-green-600 font-bold text-lg">{correctCount}</span>
+                                    <span>Right</span>
+                                </div>
+                                <div className="flex flex-col">
+                                    <span className="text-red-500 font-bold text-lg">{wrongCount}</span>
+                                    <span>Wrong</span>
+                                </div>
+                                <div className="flex flex-col">
+                                    <span className="text-amber-500 font-bold text-lg">{skippedCount}</span>
+                                    <span>Skipped</span>
+                                </div>
+                            </div>
+                            
+                            <div className="space-y-3 mb-8">
+                                {hasMistakes && (
+                                    <button 
+                                        onClick={startRetry}
+                                        className="smooth-btn w-full bg-gray-900 text-white font-medium py-4 rounded-xl shadow-lg hover:shadow-xl transition flex items-center justify-center gap-2"
+                                    >
+                                        <i className="fas fa-undo"></i> Retry {skippedCount + wrongCount} Mistakes
+                                    </button>
+                                )}
+
+                                {reviews.length > 0 && (
+                                    <button 
+                                        onClick={startReview}
+                                        className="smooth-btn w-full bg-white border border-gray-200 text-gray-900 font-medium py-4 rounded-xl hover:bg-gray-50 transition shadow-sm flex items-center justify-center gap-2"
+                                    >
+                                        <i className="fas fa-history"></i> Review {reviews.length} Due
+                                    </button>
+                                )}
+
+                                <button 
+                                    onClick={() => setView('setup')}
+                                    className="smooth-btn w-full bg-white border border-gray-200 text-gray-900 font-medium py-4 rounded-xl hover:bg-gray-50 transition shadow-sm"
+                                >
+                                    Start New Quiz
+                                </button>
+                            </div>
+
+                            {/* Add More Section with Liquid Slider */}
+                            <div className="mt-4 pt-5 border-t border-gray-100/50 text-left">
+                                <div className="mb-3">
+                                    <div className="flex justify-between text-[10px] font-semibold text-gray-400 mb-2 uppercase tracking-widest">
+                                        <span>Add More</span>
+                                        <span>{Math.round(moreQuestions)} Questions</span>
+                                    </div>
+                                    <GlassSlider
+                                        min={1}
+                                        max={50}
+                                        value={moreQuestions}
+                                        onChange={setMoreQuestions}
+                                    />
+                                </div>
+                                <button
+                                    onClick={handleAddMoreQuestions}
+                                    disabled={addingMore}
+                                    className="smooth-btn w-full bg-gray-900 text-white font-medium py-3 rounded-xl shadow-lg hover:shadow-xl disabled:opacity-50 disabled:cursor-not-allowed flex items-center justify-center gap-2"
+                                >
+                                    {addingMore ? (
+                                        <>
+                                            <i className="fas fa-circle-notch fa-spin"></i>
+                                            Generating...
+                                        </>
+                                    ) : (
+                                        <>
+                                            <i className="fas fa-plus-circle"></i>
+                                            Add Questions
+                                        </>
+                                    )}
+                                </button>
+                            </div>
+                        </div>
+                    </div>
+                );
+            }
+        }
+
+        const root = ReactDOM.createRoot(document.getElementById('root'));
+        root.render(<App />);
+    </script>
+</body>
+</html>
+"""
+
+# --- STATIC ASSETS (precompressed, in memory) ---
+# `python build_frontend.py` writes a minified, content-hashed bundle to static/.
+# Files are loaded once at startup with gzip/brotli variants ready to send;
+# without a build we serve the in-browser Babel page above.
+STATIC_DIR = os.getenv("STATIC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
+
+class StaticAsset:
+    def __init__(self, body, content_type, cache_control):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.digest = hashlib.sha256(body).hexdigest()[:20]
+        self.variants = {"identity": body, "gzip": gzip.compress(body, 9)}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(body, quality=11)
+
+    def etag(self, encoding):
+        # Each encoding is a different byte sequence, so it gets its own strong ETag
+        return f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+
+    def response(self, request):
+        encoding = pick_encoding(request.headers.get("accept-encoding", ""), self.variants)
+        etag = self.etag(encoding)
+        headers = {"ETag": etag, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(self.variants[encoding], media_type=self.content_type, headers=headers)
+
+def pick_encoding(accept_encoding, variants):
+    # Highest q wins (br before gzip on a tie); q=0 means "not acceptable", and an
+    # explicit entry overrides "*"
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, *params = part.split(";")
+        q = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name.strip():
+            weights[name.strip().lower()] = q
+    best, best_q = "identity", 0.0
+    for encoding in ("br", "gzip"):
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if encoding in variants and q > best_q:
+            best, best_q = encoding, q
+    return best
+
+static_assets = {}
+
+def load_static_assets():
+    index_path = os.path.join(STATIC_DIR, "index.html")
+    if not os.path.isfile(index_path):
+        return StaticAsset(html_content.encode("utf-8"), "text/html; charset=utf-8", "no-cache")
+
+    for name in os.listdir(STATIC_DIR):
+        if name == "index.html":
+            continue
+        with open(os.path.join(STATIC_DIR, name), "rb") as f:
+            body = f.read()
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        # Hashed filenames never change content, so browsers may keep them for a year
+        static_assets[name] = StaticAsset(body, content_type, "public, max-age=31536000, immutable")
+
+    with open(index_path, "rb") as f:
+        return StaticAsset(f.read(), "text/html; charset=utf-8", "no-cache")
+
+index_asset = load_static_assets()
+
+# --- METRICS ---
+# Prometheus text format on /metrics, no client library needed. STATS holds the
+# plain counters; STAGE_SECONDS times each step of the pipeline. Stages recorded
+# while handling a request are also echoed back in a Server-Timing header.
+STATS = Counter()
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}  # sorted label items -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in self.series.items():
+            labels = "".join(f'{k}="{v}",' for k, v in key)
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels.rstrip(',')}}} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{{{labels.rstrip(',')}}} {series[-1]}")
+        return lines
+
+STAGE_SECONDS = Histogram("quizgen_stage_seconds", "Time spent in each generation pipeline stage.")
+REQUEST_SECONDS = Histogram("quizgen_request_seconds", "HTTP request latency until response headers.")
+
+# Per-request list of (stage, seconds). Flight tasks copy the context when they're
+# created, so upstream stages still land on the request that started them.
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+def record_stage(name, seconds, **labels):
+    STAGE_SECONDS.observe(seconds, stage=name, **labels)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+@contextmanager
+def stage(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started, **labels)
+
+def record_usage(usage):
+    if usage:
+        STATS["tokens_in"] += usage.get("prompt_tokens") or 0
+        STATS["tokens_out"] += usage.get("completion_tokens") or 0
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    timings = []
+    request_timings.set(timings)
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - started,
+        route=getattr(route, "path", "other"),
+        status=response.status_code,
+    )
+    if timings:
+        response.headers["Server-Timing"] = ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings
+        )
+    return response
+
+def render_metrics():
+    lines = []
+    for name, value in sorted(STATS.items()):
+        lines += [f"# TYPE quizgen_{name}_total counter", f"quizgen_{name}_total {value}"]
+    lines += [
+        "# TYPE quizgen_inflight_generations gauge", f"quizgen_inflight_generations {len(flight_tasks)}",
+        "# TYPE quizgen_extraction_jobs gauge", f"quizgen_extraction_jobs {extract_jobs}",
+    ]
+    lines += STAGE_SECONDS.render()
+    lines += REQUEST_SECONDS.render()
+    return "\n".join(lines) + "\n"
+
+# --- UPSTREAM CLIENT (shared, pooled) ---
+# One AsyncClient per process so connections (and HTTP/2 streams) are reused
+# across requests instead of blocking the event loop on a fresh socket each time.
+http_client = None
+
+@app.on_event("startup")
+async def open_http_client():
+    global http_client
+    if not OPENROUTER_API_KEY:
+        raise RuntimeError(MISSING_KEY_MESSAGE)
+    http_client = httpx.AsyncClient(
+        http2=UPSTREAM_HTTP2,
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+        headers={
+            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+            "Content-Type": "application/json",
+            "Referer": "http://localhost:8000",
+            "X-Title": "QuizGen"
+        },
+    )
+
+@app.on_event("shutdown")
+async def close_http_client():
+    if http_client is not None:
+        await http_client.aclose()
+
+def upstream_error(response, detail):
+    # Keep Retry-After so the retry policy (and, failing that, the client) can honor it
+    retry_after = response.headers.get("retry-after")
+    headers = {"Retry-After": retry_after} if retry_after else None
+    return HTTPException(status_code=response.status_code, detail=detail, headers=headers)
+
+async def call_openrouter(model, messages):
+    response = await http_client.post(
+        OPENROUTER_URL,
+        json={
+            "model": model,
+            "messages": messages,
+            "temperature": 0.7
+        },
+    )
+
+    if response.status_code != 200:
+        raise upstream_error(response, response.text)
+
+    result = response.json()
+    record_usage(result.get("usage"))
+    return result['choices'][0]['message']['content']
+
+async def open_openrouter_stream(model, messages):
+    # Status is checked before any bytes go to the client, so upstream
+    # errors still surface as a normal HTTP error response.
+    request = http_client.build_request(
+        "POST",
+        OPENROUTER_URL,
+        json={
+            "model": model,
+            "messages": messages,
+            "temperature": 0.7,
+            "stream": True
+        },
+    )
+    response = await http_client.send(request, stream=True)
+
+    if response.status_code != 200:
+        detail = (await response.aread()).decode("utf-8", errors="ignore")
+        await response.aclose()
+        raise upstream_error(response, detail)
+
+    return response
+
+async def iter_openrouter_deltas(response):
+    # OpenRouter streams SSE: "data: {...}" lines, ": keep-alive" comments, "data: [DONE]"
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            try:
+                chunk = json.loads(payload)
+            except ValueError:
+                continue
+            # The final chunk carries token usage for the whole completion
+            record_usage(chunk.get("usage"))
+            choices = chunk.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+    finally:
+        await response.aclose()
+
+# --- QUIZ PARSING ---
+class QuestionStreamParser:
+    # Single-pass, incremental salvage parser for model output. Every balanced {...}
+    # is found as it closes (innermost first), with string/escape state tracked so
+    # brackets inside text don't count. Objects with an "options" key are returned as
+    # questions; wrappers like {"questions": [...]} are never parsed as a whole, so
+    # prose around the JSON, a truncated tail or one broken object only costs that object.
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.stack = []  # [start offset, contains a question-like child]
+        self.in_string = False
+        self.escape = False
+        self.salvaged = 0
+        self.broken = 0
+
+    def feed(self, chunk):
+        questions = []
+        self.text += chunk
+        text = self.text
+        for i in range(self.pos, len(text)):
+            ch = text[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                # Strings only matter inside an object; quotes in prose around the JSON don't
+                self.in_string = bool(self.stack)
+            elif ch == "{":
+                self.stack.append([i, False])
+            elif ch == "}" and self.stack:
+                start, has_question_child = self.stack.pop()
+                if has_question_child:
+                    continue  # a wrapper around questions we've already handled
+                span = text[start:i + 1]
+                if '"options"' not in span:
+                    continue
+                if self.stack:
+                    self.stack[-1][1] = True
+                q = self.load(span)
+                if q is None:
+                    self.broken += 1
+                else:
+                    self.salvaged += 1
+                    questions.append(q)
+        self.pos = len(text)
+        return questions
+
+    @staticmethod
+    def load(span):
+        for candidate in (span, repair_json(span)):
+            try:
+                obj = json.loads(candidate, strict=False)
+            except ValueError:
+                continue
+            if isinstance(obj, dict) and "options" in obj:
+                return obj
+        return None
+
+    def finish(self):
+        # Objects still open at the end were cut off mid-generation
+        for start, has_question_child in self.stack:
+            if not has_question_child and '"text"' in self.text[start:]:
+                self.broken += 1
+        self.stack = []
+
+def repair_json(span):
+    # Cheap fixes for the usual model slips: trailing commas, and stray unescaped
+    # quotes inside strings (a quote only closes a string if what follows fits JSON)
+    out = []
+    in_string = False
+    escape = False
+    for i, ch in enumerate(span):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                rest = span[i + 1:i + 20].lstrip()
+                if rest[:1] in (",", ":", "}", "]", ""):
+                    in_string = False
+                else:
+                    out.append("\\")
+        elif ch == '"':
+            in_string = True
+        out.append(ch)
+    return re.sub(r",\s*([}\]])", r"\1", "".join(out))
+
+def shuffle_question(q):
+    # CRASH-PROOF SHUFFLING (single question); returns None if the question is unusable
+    if (
+            not isinstance(q, dict) or
+            "options" not in q or
+            "correct" not in q or
+            not isinstance(q["options"], list)
+    ):
+        return None
+
+    # bool is an int subclass, but "correct": true is not an index
+    if not isinstance(q["correct"], int) or isinstance(q["correct"], bool) or q["correct"] >= len(q["options"]) or q["correct"] < 0:
+        return None
+
+    opts = q['options']
+    correct_txt = opts[q['correct']]
+    random.shuffle(opts)
+
+    try:
+        new_idx = opts.index(correct_txt)
+    except ValueError:
+        return None
+
+    q['options'] = opts
+    q['correct'] = new_idx
+    return q
+
+def validate_questions(raw_questions):
+    # CRASH-PROOF SHUFFLING
+    final_questions = []
+    for q in raw_questions:
+        q = shuffle_question(q)
+        if q is None:
+            STATS["questions_dropped_invalid"] += 1
+        else:
+            final_questions.append(q)
+    return final_questions
+
+def record_salvage(parser):
+    parser.finish()
+    STATS["questions_salvaged"] += parser.salvaged
+    STATS["questions_broken"] += parser.broken
+    if parser.broken:
+        STATS["json_salvage_failures"] += 1
+
+def parse_quiz(content_str):
+    # TOLERANT JSON PARSING: keep every complete question, skip broken ones
+    parser = QuestionStreamParser()
+    with stage("parse"):
+        raw_questions = parser.feed(content_str)
+        record_salvage(parser)
+    with stage("validate"):
+        return validate_questions(raw_questions)
+
+# --- PROMPT BUILDING ---
+SYSTEM_MSG = """
+    You are a strict JSON Quiz Generator.
+    Task: Create a multiple choice quiz.
+    Use only the provided CONTEXT text (from the uploaded file or text topic) as your source of truth.
+    Do not invent facts that are not present in the CONTEXT.
+    OUTPUT RULES:
+    1. Return ONLY valid JSON. No markdown.
+    2. Structure: [{"text": "Question?", "options": ["A", "B", "C", "D"], "correct": 0, "rationale": "Why?"}]
+    """
+
+# UNIFIED MODEL: QWEN 2.5 VL 72B (Vision + Text)
+MODEL = "qwen/qwen2.5-vl-72b-instruct"
+
+def build_messages(topic, num_questions, document, focus=None, avoid=None):
+    # PROMPT
+    if topic.strip():
+        user_content = f"Generate {num_questions} questions about: {topic}"
+    else:
+        user_content = f"Generate {num_questions} questions based ENTIRELY on the file content below. Do not simply copy and paste the text from the file, but make the quiz based on concepts within the text."
+
+    if focus:
+        user_content += f"\n\nFOCUS: {focus}"
+    if avoid:
+        already_asked = "\n".join(f"- {text}" for text in avoid)
+        user_content += f"\n\nDo NOT repeat or rephrase these questions, which were already asked:\n{already_asked}"
+
+    messages = [{"role": "system", "content": SYSTEM_MSG}]
+
+    if document is None:
+        messages.append({"role": "user", "content": user_content})
+    elif document["kind"] in ("image", "scan"):
+        # A scan is a batch of page images from a PDF without a text layer
+        urls = document["pages"] if document["kind"] == "scan" else [document["url"]]
+        messages.append({
+            "role": "user",
+            "content": [{"type": "text", "text": user_content}] + [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": url}
+                }
+                for url in urls
+            ]
+        })
+    else:
+        label = CONTEXT_LABELS[document["kind"]]
+        messages.append({"role": "user", "content": f"{user_content}\n\n{label}:\n{document_context(document)}"})
+
+    return messages
+
+# --- DOCUMENT EXTRACTION ---
+CONTEXT_LABELS = {
+    "pdf": "CONTEXT (PDF)",
+    "docx": "CONTEXT (DOCX)",
+    "raw": "CONTEXT (RAW)",
+    "text": "CONTEXT",
+}
+
+# Upper bound on text pulled out of a document; context packing then picks what fits the prompt
+EXTRACT_MAX_CHARS = int(os.getenv("EXTRACT_MAX_CHARS", "400000"))
+PDF_SAMPLE_PAGES = int(os.getenv("PDF_SAMPLE_PAGES", "20"))
+EXTRACT_MAX_PAGES = int(os.getenv("EXTRACT_MAX_PAGES", "3000"))
+
+class ExtractionError(Exception):
+    # Raised inside extraction workers; turned into a 400 by the caller.
+    # (HTTPException doesn't survive the trip back from a worker process.)
+    pass
+
+class ScannedPdfError(ExtractionError):
+    # A PDF without a text layer that we won't (SCAN_MODE=reject) or can't turn into page images
+    pass
+
+def parse_page_spec(spec, page_count):
+    # "40-55" or "1,3,10-12" (1-based, inclusive) -> sorted 0-based page indices
+    indices = set()
+    for part in spec.replace(" ", "").split(","):
+        if not part:
+            continue
+        match = re.fullmatch(r"(\d+)(?:-(\d+))?", part)
+        if not match:
+            raise ExtractionError(f"Invalid page range: {part}")
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        if start < 1 or end < start:
+            raise ExtractionError(f"Invalid page range: {part}")
+        indices.update(range(start - 1, min(end, page_count)))
+    if not indices:
+        raise ExtractionError(f"Page range {spec} selects no pages; the document has {page_count}.")
+    return sorted(indices)
+
+def sample_page_indices(page_count, samples):
+    # Evenly spaced pages so a quiz covers the whole document without parsing all of it
+    if page_count <= samples:
+        return list(range(page_count))
+    step = page_count / samples
+    return sorted({int(i * step) for i in range(samples)})
+
+def extract_pdf_text(reader, max_chars, pages="", sample_pages=False):
+    page_count = len(reader.pages)
+    if page_count > EXTRACT_MAX_PAGES:
+        raise ExtractionError(f"PDF has {page_count} pages; the limit is {EXTRACT_MAX_PAGES}.")
+    if pages:
+        indices = parse_page_spec(pages, page_count)
+    elif sample_pages:
+        indices = sample_page_indices(page_count, PDF_SAMPLE_PAGES)
+    else:
+        indices = range(page_count)
+
+    # When sampling, every picked page gets an equal share so later pages still make it in
+    per_page = max_chars // max(len(indices), 1) if sample_pages and not pages else max_chars
+
+    parts = []
+    total = 0
+    for i in indices:
+        # Pages are only parsed when reached; stop once the budget is full
+        text = (reader.pages[i].extract_text() or "")[:per_page]
+        parts.append(text)
+        total += len(text) + 1
+        if total >= max_chars:
+            break
+    # Form feeds keep the page boundaries, which header/footer stripping needs
+    return "\f".join(parts)[:max_chars]
+
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+def extract_docx_text(path, max_chars):
+    # Streams word/document.xml straight out of the zip on disk. Finished paragraphs
+    # are cleared as we go, so memory stays flat however long the document is.
+    parts = []
+    runs = []  # w:t runs of the current paragraph; formatting splits a sentence into several
+    total = 0
+    with ZipFile(path) as docx_zip:
+        with docx_zip.open("word/document.xml") as doc_xml:
+            for _, el in etree.iterparse(doc_xml, events=("end",), tag=(f"{W_NS}t", f"{W_NS}p")):
+                if el.tag == f"{W_NS}t":
+                    if el.text:
+                        runs.append(el.text)
+                        total += len(el.text)
+                    if total >= max_chars:
+                        break
+                else:
+                    if runs:
+                        parts.append("".join(runs))
+                        runs = []
+                        total += 1
+                    el.clear()
+                    while el.getprevious() is not None:
+                        del el.getparent()[0]
+    if runs:
+        parts.append("".join(runs))
+    return "\n".join(parts)[:max_chars]
+
+def read_text_prefix(path, max_chars):
+    # UTF-8 is at most 4 bytes per character, so this always covers the budget
+    with open(path, "rb") as f:
+        return f.read(max_chars * 4).decode('utf-8', errors='ignore')[:max_chars]
+
+# --- IMAGE PREPROCESSING ---
+# Phone photos are often 10+ MB; vision models downscale them anyway, so shrink
+# to IMAGE_MAX_EDGE, drop EXIF/ICC metadata and recompress before base64-ing.
+# Without Pillow (or for formats it can't read) the original bytes are sent.
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1568"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "webp").lower()  # webp or jpeg
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+
+def data_url(data, mime):
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+def encode_image(img):
+    # Downscale to IMAGE_MAX_EDGE and save as IMAGE_FORMAT; returns (converted img, bytes, mime)
+    img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+    fmt = "WEBP" if IMAGE_FORMAT == "webp" else "JPEG"
+    if fmt == "JPEG" or img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if fmt == "WEBP" and "A" in img.getbands() else "RGB")
+    out = io.BytesIO()
+    # Saving without exif=/icc_profile= strips the metadata
+    if fmt == "WEBP":
+        img.save(out, fmt, quality=IMAGE_QUALITY, method=4)
+    else:
+        img.save(out, fmt, quality=IMAGE_QUALITY, optimize=True, progressive=True)
+    return img, out.getvalue(), f"image/{fmt.lower()}"
+
+def prepare_image(source, mime):
+    # source is a path or the raw bytes; returns (bytes, mime) ready for a data: URL
+    if isinstance(source, bytes):
+        original = source
+    else:
+        with open(source, "rb") as f:
+            original = f.read()
+    if Image is None:
+        return original, mime
+
+    try:
+        with Image.open(io.BytesIO(original)) as img:
+            # JPEG can decode straight at a reduced scale, much faster than a full decode + resize
+            img.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+            img = ImageOps.exif_transpose(img)
+            resized = max(img.size) > IMAGE_MAX_EDGE
+            img, processed, out_mime = encode_image(img)
+
+            # Clean scans and screenshots compress better losslessly
+            if len(processed) >= len(original):
+                out = io.BytesIO()
+                img.save(out, "PNG", optimize=True)
+                if len(out.getvalue()) < len(processed):
+                    processed, out_mime = out.getvalue(), "image/png"
+    except Exception as e:
+        print(f"Error: {e}")
+        return original, mime
+
+    # A small, already-compressed image can come out bigger; keep whichever is smaller
+    if not resized and len(processed) >= len(original):
+        return original, mime
+    return processed, out_mime
+
+# --- SCANNED PDFS ---
+# A scanned PDF has no text layer: extract_text() comes back empty and the model
+# would invent a quiz from an empty CONTEXT. A few evenly spaced pages are checked
+# for text first (the route is cached per document hash by the caller); scans are
+# sent to the vision model as page images, SCAN_PAGES_PER_CALL per completion, or
+# rejected up front with SCAN_MODE=reject. Pages are rendered with pypdfium2 when
+# it's installed, else the page's own embedded scan image is used.
+SCAN_MODE = os.getenv("SCAN_MODE", "vision")  # vision or reject
+SCAN_CHECK_PAGES = int(os.getenv("SCAN_CHECK_PAGES", "5"))
+SCAN_MIN_CHARS = int(os.getenv("SCAN_MIN_CHARS", "50"))  # per page; fewer means image-only
+SCAN_MAX_PAGES = int(os.getenv("SCAN_MAX_PAGES", "20"))
+SCAN_PAGES_PER_CALL = int(os.getenv("SCAN_PAGES_PER_CALL", "4"))
+SCANNED_PDF_MESSAGE = (
+    "This PDF is a scan without selectable text. Upload a PDF with a text layer, or photos of the pages."
+)
+
+def pdf_route(reader):
+    # "text" unless most sampled pages are (nearly) empty
+    indices = sample_page_indices(len(reader.pages), SCAN_CHECK_PAGES)
+    sparse = sum(1 for i in indices if len((reader.pages[i].extract_text() or "").strip()) < SCAN_MIN_CHARS)
+    return "scan" if sparse * 2 > len(indices) else "text"
+
+def render_pdf_pages(path, reader, indices):
+    # Returns (page numbers, data URLs) for the pages that could be turned into images
+    numbers, urls = [], []
+    if pdfium is not None and Image is not None:
+        pdf = pdfium.PdfDocument(path)
+        try:
+            for i in indices:
+                page = pdf[i]
+                # Page size is in points (1/72 in), so this renders the long edge at IMAGE_MAX_EDGE px
+                bitmap = page.render(scale=IMAGE_MAX_EDGE / max(page.get_size()))
+                _, data, mime = encode_image(bitmap.to_pil())
+                numbers.append(i + 1)
+                urls.append(data_url(data, mime))
+        finally:
+            pdf.close()
+        return numbers, urls
+
+    for i in indices:
+        try:
+            images = reader.pages[i].images
+            if not images:
+                continue
+            # Scanners and phone apps put one full-page image on each page
+            largest = max(images, key=lambda image: len(image.data))
+            data, mime = prepare_image(largest.data, mimetypes.guess_type(largest.name)[0] or "image/jpeg")
+        except Exception as e:
+            print(f"Error: page {i + 1} image: {e}")
+            continue
+        numbers.append(i + 1)
+        urls.append(data_url(data, mime))
+    return numbers, urls
+
+def extract_scanned_pdf(path, reader, pages=""):
+    if SCAN_MODE == "reject":
+        raise ScannedPdfError(SCANNED_PDF_MESSAGE)
+    page_count = len(reader.pages)
+    indices = parse_page_spec(pages, page_count) if pages else list(range(page_count))
+    if len(indices) > SCAN_MAX_PAGES:
+        indices = [indices[i] for i in sample_page_indices(len(indices), SCAN_MAX_PAGES)]
+    numbers, urls = render_pdf_pages(path, reader, indices)
+    if not urls:
+        raise ScannedPdfError(SCANNED_PDF_MESSAGE)
+    return {"kind": "scan", "pages": urls, "page_numbers": numbers}
+
+def extract_document(path, mime, filename, pages="", sample_pages=False, route=None):
+    # IMAGE
+    if "image" in mime:
+        data, mime = prepare_image(path, mime)
+        return {"kind": "image", "url": data_url(data, mime)}
+
+    # PDF (route: "text" or "scan" from an earlier upload of the same file). The
+    # returned document carries the route for the caller to cache.
+    elif "pdf" in mime or filename.endswith(".pdf"):
+        try:
+            with open(path, "rb") as f:
+                reader = PdfReader(f)
+                route = route or pdf_route(reader)
+                if route == "text":
+                    text_content = extract_pdf_text(reader, EXTRACT_MAX_CHARS, pages, sample_pages)
+                    if text_content.strip():
+                        return {"kind": "pdf", "text": text_content, "route": route}
+                    # A text PDF whose selected pages are image-only: try them as a scan,
+                    # but a failure is about these pages, not a scan to turn away for good
+                    try:
+                        return dict(extract_scanned_pdf(path, reader, pages), route=route)
+                    except ScannedPdfError:
+                        raise ExtractionError("The selected pages have no selectable text. Try other pages.")
+                return dict(extract_scanned_pdf(path, reader, pages), route=route)
+        except ExtractionError:
+            raise
+        except Exception as e:
+            raise ExtractionError(f"Error reading PDF: {str(e)}")
+
+    # DOCX (streaming xml parse, raw text fallback)
+    elif "word" in mime or filename.endswith(".docx"):
+        try:
+            return {"kind": "docx", "text": extract_docx_text(path, EXTRACT_MAX_CHARS)}
+        except:
+            try:
+                # Fallback to UTF-8
+                return {"kind": "raw", "text": read_text_prefix(path, EXTRACT_MAX_CHARS)}
+            except:
+                raise ExtractionError("DOCX parsing failed. Try PDF or Text.")
+
+    # TEXT
+    else:
+        return {"kind": "text", "text": read_text_prefix(path, EXTRACT_MAX_CHARS)}
+
+# --- CONTEXT PACKING ---
+# Instead of keeping the first N characters, extracted text is cleaned of repeated
+# header/footer lines, cut into chunks and scored for information density. The
+# best chunks from across the whole document are packed into the model's token
+# budget and kept in document order. MODEL_CONTEXT_TOKENS=model=tokens,... gives
+# models their own budget; context is packed once, before the upstream policy
+# picks a model, so it gets the smallest budget of MODEL and FALLBACK_MODELS.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+MODEL_CONTEXT_TOKENS = {
+    model.strip(): int(tokens)
+    for model, _, tokens in (item.partition("=") for item in os.getenv("MODEL_CONTEXT_TOKENS", "").split(","))
+    if model.strip()
+}
+CONTEXT_CHUNK_CHARS = 1200
+PAGE_EDGE_LINES = 3  # lines at the top and bottom of each PDF page checked for headers/footers
+CHARS_PER_TOKEN = 4  # rough average for English prose
+
+def context_token_budget():
+    return min(MODEL_CONTEXT_TOKENS.get(model, CONTEXT_TOKEN_BUDGET) for model in [MODEL] + FALLBACK_MODELS)
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def line_key(line):
+    # Page numbers and dates differ between otherwise identical headers/footers
+    return re.sub(r"\d+", "#", line.strip().lower())
+
+def page_edges(lines):
+    # Indices of the lines a running header or footer could be on
+    n = min(PAGE_EDGE_LINES, len(lines))
+    return set(range(n)) | set(range(len(lines) - n, len(lines)))
+
+def strip_boilerplate(text):
+    # Headers/footers: short lines at the top or bottom of a page that repeat
+    # (digits aside) on 3+ pages. Only PDF text has pages ("\f"-separated);
+    # lines in the body of a page, and documents without pages, are kept.
+    pages = [[line for line in page.splitlines() if line.strip()] for page in text.split("\f")]
+    counts = Counter()
+    for lines in pages:
+        counts.update({line_key(lines[i]) for i in page_edges(lines) if len(lines[i]) < 120})
+    kept = []
+    for lines in pages:
+        edges = page_edges(lines)
+        kept.extend(
+            line for i, line in enumerate(lines)
+            if not (i in edges and len(line) < 120 and counts[line_key(line)] >= 3)
+        )
+    return "\n".join(kept)
+
+def chunk_text(text, size=CONTEXT_CHUNK_CHARS):
+    chunks = []
+    current = []
+    length = 0
+    for line in text.splitlines():
+        for start in range(0, len(line), size):
+            piece = line[start:start + size]
+            if length + len(piece) > size and current:
+                chunks.append("\n".join(current))
+                current, length = [], 0
+            current.append(piece)
+            length += len(piece) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def chunk_score(chunk):
+    # Many distinct real words per character = dense prose; tables of numbers,
+    # indexes and repeated fragments score low
+    words = re.findall(r"[A-Za-z][A-Za-z'-]+", chunk)
+    if len(words) < 8:
+        return 0.0
+    unique_ratio = len({w.lower() for w in words}) / len(words)
+    alpha_ratio = sum(len(w) for w in words) / len(chunk)
+    return unique_ratio * alpha_ratio * math.log(len(words))
+
+def pack_context(text, token_budget):
+    text = strip_boilerplate(text)
+    budget_chars = token_budget * CHARS_PER_TOKEN
+    if len(text) <= budget_chars:
+        return text
+
+    chunks = chunk_text(text)
+    scores = [chunk_score(c) for c in chunks]
+    chosen = set()
+    used = 0
+
+    def take(i):
+        nonlocal used
+        if i in chosen or scores[i] <= 0 or used + len(chunks[i]) + 2 > budget_chars:
+            return
+        chosen.add(i)
+        used += len(chunks[i]) + 2
+
+    # Coverage: the best chunk from each stretch of the document (about half the budget)...
+    regions = max(1, min(len(chunks), budget_chars // CONTEXT_CHUNK_CHARS // 2))
+    for r in range(regions):
+        lo = r * len(chunks) // regions
+        hi = max((r + 1) * len(chunks) // regions, lo + 1)
+        take(max(range(lo, hi), key=scores.__getitem__))
+
+    # ...then fill the rest with the densest chunks anywhere
+    for i in sorted(range(len(chunks)), key=scores.__getitem__, reverse=True):
+        take(i)
+
+    return "\n\n".join(chunks[i] for i in sorted(chosen))
+
+def document_context(document):
+    # Documents cached before packing existed only have (already short) text
+    return document.get("context", document.get("text", ""))
+
+def extract_and_pack(path, mime, filename, pages="", sample_pages=False, route=None):
+    document = extract_document(path, mime, filename, pages, sample_pages, route)
+    if "text" in document:
+        document["context"] = pack_context(document["text"], context_token_budget())
+    return document
+
+# --- EXTRACTION WORKER POOL ---
+# PDF/DOCX parsing and image recompression are CPU-bound; run them in worker
+# processes so the event loop (and every other request) keeps moving.
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(max(1, (os.cpu_count() or 1) // WORKERS))))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "60"))
+EXTRACT_QUEUE_LIMIT = int(os.getenv("EXTRACT_QUEUE_LIMIT", str(EXTRACT_WORKERS * 4)))
+
+extract_pool = None
+extract_jobs = 0  # submitted jobs that haven't finished in a worker yet
+
+def new_extract_pool():
+    # forkserver, not fork: a forked worker would inherit the server's listening
+    # socket and uvicorn's signal handlers and outlive a killed server
+    context = multiprocessing.get_context("forkserver")
+    return ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=context)
+
+@app.on_event("startup")
+async def open_extract_pool():
+    global extract_pool
+    extract_pool = new_extract_pool()
+
+@app.on_event("shutdown")
+async def close_extract_pool():
+    if extract_pool is not None:
+        # Let a running extraction finish so its worker exits instead of being orphaned
+        await asyncio.to_thread(extract_pool.shutdown, wait=True, cancel_futures=True)
+
+def extract_job_done(future):
+    global extract_jobs
+    extract_jobs -= 1
+    if not future.cancelled():
+        future.exception()  # a timed-out job fails later with no one awaiting it
+
+def recycle_extract_pool():
+    # A job past its timeout may never finish (a parser stuck on a hostile file)
+    # and would pin its worker and queue slot for good, so the workers are killed
+    # and replaced. Other jobs in the old pool fail with BrokenProcessPool, which
+    # releases their slots; run_extraction resubmits them to the new pool.
+    global extract_pool
+    old, extract_pool = extract_pool, new_extract_pool()
+    for process in list((old._processes or {}).values()):
+        process.terminate()
+    old.shutdown(wait=False, cancel_futures=True)
+    STATS["extract_pool_recycles"] += 1
+
+async def run_extraction(path, mime, filename, pages="", sample_pages=False, route=None):
+    global extract_jobs, extract_pool
+    if extract_jobs >= EXTRACT_QUEUE_LIMIT:
+        raise HTTPException(503, "Server is busy processing documents. Try again shortly.", headers={"Retry-After": "5"})
+
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = extract_pool
+        try:
+            future = loop.run_in_executor(pool, extract_and_pack, path, mime, filename, pages, sample_pages, route)
+        except BrokenProcessPool:
+            pool = extract_pool = new_extract_pool()
+            future = loop.run_in_executor(pool, extract_and_pack, path, mime, filename, pages, sample_pages, route)
+        # Counted until the job really ends in its worker (or the worker is killed)
+        extract_jobs += 1
+        future.add_done_callback(extract_job_done)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), EXTRACT_TIMEOUT)
+        except asyncio.TimeoutError:
+            if extract_pool is pool:
+                recycle_extract_pool()
+            raise HTTPException(504, "Document took too long to process. Try a page range or a smaller file.")
+        except ScannedPdfError as e:
+            raise HTTPException(422, str(e))
+        except ExtractionError as e:
+            raise HTTPException(400, str(e))
+        except BrokenProcessPool:
+            # Killed because another job overran: this one gets another go
+            if extract_pool is not pool and attempt == 0:
+                continue
+            raise HTTPException(500, "Document worker crashed. Try again.")
+
+# --- UPLOAD SPOOLING ---
+# Starlette spools each multipart file part to its own temp file while parsing
+# the body; the admission middleware caps the body before that (REQUEST_MAX_BYTES).
+# Uploads are hashed in place, and only written out to a path of their own when
+# an extraction worker actually needs to read them.
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+REQUEST_MAX_BYTES = UPLOAD_MAX_BYTES + 1024 * 1024  # one file plus the form fields
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+SPOOL_CHUNK_BYTES = 1024 * 1024
+
+def upload_too_large():
+    return HTTPException(413, f"File is too large. The limit is {round(UPLOAD_MAX_BYTES / (1024 * 1024), 1):g} MB.")
+
+async def hash_upload(file):
+    # Returns the sha256 hex of an upload, leaving it rewound
+    if file.size is not None and file.size > UPLOAD_MAX_BYTES:
+        raise upload_too_large()
+
+    digest = hashlib.sha256()
+    await file.seek(0)
+    while True:
+        chunk = await file.read(SPOOL_CHUNK_BYTES)
+        if not chunk:
+            break
+        digest.update(chunk)
+    await file.seek(0)
+    return digest.hexdigest()
+
+async def save_upload(file, path=None):
+    # Writes an upload out to path (a new temp file by default) and returns the path
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="quizgen-", dir=UPLOAD_SPOOL_DIR)
+        os.close(fd)
+    try:
+        await file.seek(0)
+        with open(path, "wb") as out:
+            while True:
+                chunk = await file.read(SPOOL_CHUNK_BYTES)
+                if not chunk:
+                    break
+                out.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(SPOOL_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# --- CACHE ---
+class TTLCache:
+    # LRU cache with optional TTL and byte budget. size_of(value) estimates the
+    # bytes a value holds; oldest entries are evicted until both limits fit.
+    def __init__(self, max_items=1024, max_bytes=None, ttl=None, size_of=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_of = size_of or (lambda value: 0)
+        self.entries = OrderedDict()  # key -> (expires_at, size, value)
+        self.bytes = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, size, value = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            self.pop(key)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.pop(key)
+        size = self.size_of(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        ttl = ttl or self.ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        self.entries[key] = (expires_at, size, value)
+        self.bytes += size
+        while len(self.entries) > self.max_items or (
+                self.max_bytes is not None and self.bytes > self.max_bytes
+        ):
+            _, (_, old_size, _) = self.entries.popitem(last=False)
+            self.bytes -= old_size
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.bytes -= entry[1]
+        return entry[2]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def values(self):
+        now = time.monotonic()
+        return [value for expires_at, _, value in self.entries.values() if expires_at is None or expires_at >= now]
+
+    def __len__(self):
+        return len(self.entries)
+
+# --- DOCUMENT CACHE (keyed by SHA-256 of the upload) ---
+DOC_CACHE_ITEMS = int(os.getenv("DOC_CACHE_ITEMS", "256"))
+DOC_CACHE_BYTES = int(os.getenv("DOC_CACHE_BYTES", str(256 * 1024 * 1024)))
+DOC_CACHE_TTL = float(os.getenv("DOC_CACHE_TTL", "3600"))
+DOC_CACHE_DIR = os.getenv("DOC_CACHE_DIR", "")  # optional on-disk tier
+DOC_CACHE_DISK_BYTES = int(os.getenv("DOC_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))
+
+def document_size(document):
+    pages = sum(len(url) for url in document.get("pages", ()))
+    return pages + sum(len(document.get(field) or "") for field in ("text", "context", "url"))
+
+document_cache = TTLCache(DOC_CACHE_ITEMS, DOC_CACHE_BYTES, DOC_CACHE_TTL, document_size)
+# content hash -> "text", "scan" or "reject" for PDFs, so a re-upload (other page
+# range, evicted document) skips the scan check or is turned away without extraction
+pdf_routes = TTLCache(DOC_CACHE_ITEMS * 16, ttl=DOC_CACHE_TTL)
+
+def doc_cache_path(doc_id):
+    return os.path.join(DOC_CACHE_DIR, f"{doc_id}.json")
+
+def read_disk_document(doc_id):
+    if not DOC_CACHE_DIR:
+        return None
+    path = doc_cache_path(doc_id)
+    try:
+        written = os.path.getmtime(path)
+        if time.time() - written > DOC_CACHE_TTL:
+            os.remove(path)
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            document = json.load(f)
+        # mtime stays the write time (for the TTL); atime is the last use (for eviction)
+        os.utime(path, (time.time(), written))
+        return document
+    except (OSError, ValueError):
+        return None
+
+def purge_disk_documents():
+    # Expired files first, then least recently used until the tier fits its budget
+    now = time.time()
+    entries = []
+    for entry in os.scandir(DOC_CACHE_DIR):
+        try:
+            st = entry.stat()
+            if now - st.st_mtime > DOC_CACHE_TTL:
+                os.remove(entry.path)
+            else:
+                entries.append((st.st_atime, st.st_size, entry.path))
+        except OSError:
+            pass  # another worker removed it
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= DOC_CACHE_DISK_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def write_disk_document(doc_id, document):
+    if not DOC_CACHE_DIR:
+        return
+    try:
+        os.makedirs(DOC_CACHE_DIR, exist_ok=True)
+        tmp_path = doc_cache_path(doc_id) + f".{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(document, f)
+        os.replace(tmp_path, doc_cache_path(doc_id))
+        purge_disk_documents()
+    except OSError as e:
+        print(f"Error: {e}")
+
+def get_cached_document(doc_id):
+    document = document_cache.get(doc_id)
+    if document is None:
+        document = read_disk_document(doc_id)
+        if document is not None:
+            document_cache.set(doc_id, document)
+    return document
+
+def valid_doc_id(doc_id):
+    return re.fullmatch(r"[0-9a-f]{64}(-[0-9a-f]{16})?", doc_id) is not None
+
+def make_doc_id(content_hash, pages="", sample_pages=False):
+    # Same bytes extracted with different page options are different cache entries
+    if not pages and not sample_pages:
+        return content_hash
+    options = f"{pages}|{int(sample_pages)}".encode("utf-8")
+    return f"{content_hash}-{hashlib.sha256(options).hexdigest()[:16]}"
+
+async def load_document(file, doc_id="", pages="", sample_pages=False):
+    # Returns (doc_id, document); doc_id is the handle clients can send instead of re-uploading.
+    if doc_id:
+        document = get_cached_document(doc_id) if valid_doc_id(doc_id) else None
+        if document is None:
+            raise HTTPException(404, "Document not found or expired. Please upload the file again.")
+        return doc_id, document
+
+    if not file:
+        return "", None
+
+    with stage("upload"):
+        content_hash = await hash_upload(file)
+    return await extract_cached(
+        file, content_hash, file.content_type or "", (file.filename or "").lower(), pages, sample_pages
+    )
+
+async def extract_cached(source, content_hash, mime, filename, pages="", sample_pages=False):
+    # Returns (doc_id, document) for a file path or an upload, extracting only on
+    # a cache miss (an upload is written to disk only then, for the worker)
+    doc_id = make_doc_id(content_hash, pages, sample_pages)
+    document = get_cached_document(doc_id)
+    if document is None:
+        route = pdf_routes.get(content_hash)
+        if route == "reject":
+            raise HTTPException(422, SCANNED_PDF_MESSAGE)
+        started = time.perf_counter()
+        path = source if isinstance(source, str) else await save_upload(source)
+        try:
+            document = await run_extraction(path, mime, filename, pages, sample_pages, route)
+        except HTTPException as e:
+            # 422 only comes from a file the scan check itself classified as a scan
+            if e.status_code == 422:
+                pdf_routes.set(content_hash, "reject")
+            raise
+        finally:
+            if path is not source:
+                os.remove(path)
+        if "route" in document:
+            pdf_routes.set(content_hash, document.pop("route"))
+        record_stage("extract", time.perf_counter() - started, kind=document["kind"])
+        document_cache.set(doc_id, document)
+        write_disk_document(doc_id, document)
+    else:
+        STATS["document_cache_hits"] += 1
+    return doc_id, document
+
+# --- SHARED KEY/VALUE BACKENDS ---
+# Values are JSON strings. take_token() is an atomic token-bucket step (see
+# ADMISSION CONTROL) so rate limits hold across every process using the backend.
+# STATE_URL picks the backend for rate limits, sessions and quiz indexes (and is
+# the generation cache's default): empty = this process only, sqlite:///path =
+# every worker on this host, redis://... = every host.
+STATE_URL = os.getenv("STATE_URL", "")
+
+class MemoryBackend:
+    # In-process backend: values are JSON strings, so every get() hands back a fresh copy
+    def __init__(self, max_items=1024):
+        self.cache = TTLCache(max_items, size_of=len)
+        self.buckets = TTLCache(max_items)
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    async def take_token(self, key, rate, burst, ttl):
+        bucket = self.buckets.get(key) or TokenBucket(rate, burst)
+        wait = bucket.take()
+        # Re-set on every request so an active client's bucket never expires
+        self.buckets.set(key, bucket, ttl)
+        return wait
+
+    async def close(self):
+        pass
+
+class RedisBackend:
+    # Minimal RESP2 client over asyncio streams, enough for GET/SET EX against Redis
+    # or any compatible local stand-in (KeyDB, Dragonfly, redis-server --port ...).
+    def __init__(self, url, pool_size=10):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self.pool_size = pool_size
+        self.slots = None
+        self.idle = []
+
+    @staticmethod
+    def encode(*args):
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    async def read_reply(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode("utf-8")
+        if kind == b"-":
+            raise RuntimeError(body.decode("utf-8"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length == -1:
+                return None
+            return (await reader.readexactly(length + 2))[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(body)
+            if length == -1:
+                return None
+            return [await self.read_reply(reader) for _ in range(length)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    async def execute(self, conn, *args):
+        reader, writer = conn
+        writer.write(self.encode(*args))
+        await writer.drain()
+        return await self.read_reply(reader)
+
+    async def connect(self):
+        conn = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self.execute(conn, "AUTH", self.password)
+        if self.db:
+            await self.execute(conn, "SELECT", self.db)
+        return conn
+
+    async def command(self, *args):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.pool_size)
+        async with self.slots:
+            conn = self.idle.pop() if self.idle else await self.connect()
+            try:
+                reply = await self.execute(conn, *args)
+            except Exception:
+                conn[1].close()
+                raise
+            self.idle.append(conn)
+            return reply
+
+    async def get(self, key):
+        return await self.command("GET", key)
+
+    async def set(self, key, value, ttl):
+        await self.command("SET", key, value, "EX", max(int(ttl), 1))
+
+    # Refill and take in one script, on Redis' clock, so hosts never race or disagree
+    TAKE_TOKEN_SCRIPT = """
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1e6
+        local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or burst
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        return tostring(wait)
+    """
+
+    async def take_token(self, key, rate, burst, ttl):
+        return float(await self.command("EVAL", self.TAKE_TOKEN_SCRIPT, 1, key, rate, burst, max(int(ttl), 1)))
+
+    async def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+class SqliteBackend:
+    # One WAL-mode SQLite file shared by the worker processes on a host. Every call
+    # is a single indexed statement and commits don't fsync (synchronous=NORMAL),
+    # so they run inline on the event loop like the batch job queries do.
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.writes = 0
+
+    def conn(self):
+        # Opened on first use, inside the worker process that uses it
+        if self.db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires)")
+            self.db = db
+        return self.db
+
+    async def get(self, key):
+        row = self.conn().execute("SELECT value FROM kv WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    async def set(self, key, value, ttl):
+        db = self.conn()
+        db.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)", (key, value, time.time() + ttl))
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            db.execute("DELETE FROM kv WHERE expires <= ?", (time.time(),))
+
+    async def take_token(self, key, rate, burst, ttl):
+        db = self.conn()
+        bucket = TokenBucket(rate, burst)
+        with db:
+            # IMMEDIATE takes the write lock up front, so two workers can't both
+            # read the same token count
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT value FROM kv WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+            if row:
+                bucket.tokens, bucket.updated = json.loads(row[0])
+            wait = bucket.take()
+            db.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps([bucket.tokens, bucket.updated]), time.time() + ttl),
+            )
+        return wait
+
+    async def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+def make_backend(url, max_items=1024):
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBackend(url)
+    if url.startswith("sqlite://"):
+        return SqliteBackend(url.removeprefix("sqlite://"))  # sqlite:///abs/path or sqlite://relative/path
+    return MemoryBackend(max_items)
+
+shared_state = make_backend(STATE_URL) if STATE_URL else None
+
+@app.on_event("shutdown")
+async def close_shared_state():
+    if shared_state is not None:
+        await shared_state.close()
+
+# --- GENERATION CACHE ---
+# Identical requests (same model, normalized topic / document, count, prompt)
+# are answered from cache; options are re-shuffled per request on the way out.
+PROMPT_VERSION = "1"
+GEN_CACHE_URL = os.getenv("GEN_CACHE_URL", STATE_URL)  # e.g. redis://127.0.0.1:6379/0; empty = in-memory
+GEN_CACHE_TTL = float(os.getenv("GEN_CACHE_TTL", "900"))
+GEN_CACHE_ITEMS = int(os.getenv("GEN_CACHE_ITEMS", "1024"))
+
+gen_cache = make_backend(GEN_CACHE_URL, GEN_CACHE_ITEMS)
+
+@app.on_event("shutdown")
+async def close_gen_cache():
+    await gen_cache.close()
+
+def normalize_topic(topic):
+    return " ".join(topic.lower().split())
+
+def gen_cache_key(model, topic, doc_id, num_questions):
+    raw = json.dumps([PROMPT_VERSION, model, normalize_topic(topic), doc_id, num_questions])
+    return "quizgen:gen:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+async def get_cached_questions(key):
+    # Cache trouble is never fatal; treat it as a miss
+    try:
+        raw = await gen_cache.get(key)
+    except Exception as e:
+        print(f"Error: {e}")
+        return None
+    if raw is None:
+        return None
+    STATS["cache_hits"] += 1
+    return reshuffle(json.loads(raw)) or None
+
+async def store_cached_questions(key, questions):
+    try:
+        await gen_cache.set(key, json.dumps(questions), GEN_CACHE_TTL)
+    except Exception as e:
+        print(f"Error: {e}")
+
+# --- ADMISSION CONTROL ---
+# A classroom burst shouldn't turn into hundreds of upstream calls that all hit
+# OpenRouter's rate limit and time out together. Each client gets a token bucket
+# (429 when empty), and upstream calls wait in a bounded FIFO for one of
+# UPSTREAM_CONCURRENCY slots (503 when the queue is full or the wait too long).
+# Slots and queue are per worker; buckets live in STATE_URL, so they're shared.
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", str(max(1, 32 // WORKERS))))
+QUEUE_MAX = int(os.getenv("QUEUE_MAX", str(max(1, 200 // WORKERS))))
+QUEUE_MAX_WAIT = float(os.getenv("QUEUE_MAX_WAIT", "20"))
+RATE_LIMIT_PER_MIN = float(os.getenv("RATE_LIMIT_PER_MIN", "60"))  # 0 disables
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "30"))
+RATE_LIMIT_CLIENTS = int(os.getenv("RATE_LIMIT_CLIENTS", "10000"))
+API_KEYS = {k.strip() for k in os.getenv("API_KEYS", "").split(",") if k.strip()}  # issued X-API-Key values
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        # 0 if a token was taken, else seconds until one is available
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + max(0, now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class UpstreamGate:
+    def __init__(self, limit, max_queue, max_wait):
+        self.slots = asyncio.Semaphore(limit)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.waiting = 0
+
+    def full(self):
+        return self.slots.locked() and self.waiting >= self.max_queue
+
+    async def acquire(self):
+        if self.full():
+            STATS["rejected_queue_full"] += 1
+            raise server_busy()
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            STATS["rejected_queue_timeout"] += 1
+            raise server_busy()
+        finally:
+            self.waiting -= 1
+            record_stage("queue_wait", time.perf_counter() - started)
+
+    def release(self):
+        self.slots.release()
+
+def server_busy():
+    return HTTPException(503, "Too many quizzes are being generated right now. Try again shortly.", headers={"Retry-After": "5"})
+
+upstream_gate = UpstreamGate(UPSTREAM_CONCURRENCY, QUEUE_MAX, QUEUE_MAX_WAIT)
+rate_limits = shared_state or MemoryBackend(RATE_LIMIT_CLIENTS)
+request_client = contextvars.ContextVar("request_client", default=None)  # client_key of the current request
+
+def client_key(request):
+    # An issued API key identifies a client better than an IP, which a whole
+    # classroom behind one NAT shares. Any other key is ignored: it's made up by
+    # the client, and a fresh one per request would dodge the limit.
+    key = request.headers.get("x-api-key", "")
+    if key in API_KEYS:
+        return "key:" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+async def admit(request, upstream=True):
+    if RATE_LIMIT_PER_MIN > 0:
+        # An idle client's bucket is dropped once it would have refilled anyway
+        try:
+            wait = await rate_limits.take_token(
+                "quizgen:rate:" + client_key(request),
+                RATE_LIMIT_PER_MIN / 60,
+                RATE_LIMIT_BURST,
+                RATE_LIMIT_BURST * 60 / RATE_LIMIT_PER_MIN,
+            )
+        except Exception as e:
+            # A limiter outage shouldn't take the whole service down with it
+            print(f"Error: {e}")
+            wait = 0
+        if wait:
+            STATS["rejected_rate_limited"] += 1
+            raise HTTPException(429, "Too many requests. Slow down a little.", headers={"Retry-After": str(math.ceil(wait))})
+    if upstream and upstream_gate.full():
+        STATS["rejected_queue_full"] += 1
+        raise server_busy()
+
+# POST routes that take uploads or start generations -> whether they need an upstream slot
+ADMITTED_ROUTES = [
+    (re.compile(r"/generate-quiz(/stream)?"), True),
+    (re.compile(r"/sessions/[^/]+/more"), True),
+    (re.compile(r"/batches"), True),
+    (re.compile(r"/documents|/sessions"), False),
+]
+
+class Admission:
+    # Plain ASGI middleware rather than BaseHTTPMiddleware, so it can meter the
+    # request body as it streams in. It runs before the route parses (and
+    # spools) the multipart body: a rejected client, or an upload over
+    # REQUEST_MAX_BYTES, costs no more than the bytes already received.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self.app(scope, receive, send)
+        request = Request(scope)
+        for pattern, upstream in ADMITTED_ROUTES:
+            if pattern.fullmatch(request.url.path):
+                break
+        else:
+            return await self.app(scope, receive, send)
+
+        request_client.set(client_key(request))
+        try:
+            length = request.headers.get("content-length", "")
+            if re.fullmatch(r"[0-9]+", length) and int(length) > REQUEST_MAX_BYTES:
+                raise upload_too_large()
+            await admit(request, upstream)
+        except HTTPException as e:
+            response = JSONResponse({"detail": e.detail}, e.status_code, headers=e.headers)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def metered_receive():
+            # Chunked uploads have no Content-Length to check up front
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > REQUEST_MAX_BYTES:
+                raise upload_too_large()
+            return message
+
+        await self.app(scope, metered_receive, send)
+
+# Innermost (inside CORS), so rejections still carry CORS headers
+app.user_middleware.append(Middleware(Admission))
+
+# --- UPSTREAM POLICY ---
+# Transient failures (timeouts, 429, 5xx) are retried with jittered exponential
+# backoff. A non-streaming call that runs past the model's recent p95 latency gets
+# a second, hedged copy (only if an upstream slot is free) and the first success
+# wins. With FALLBACK_MODELS set, BREAKER_FAILURES transient failures in a row
+# open a model's circuit and calls go to the fallbacks until BREAKER_COOLDOWN has
+# passed. Without fallbacks there are no circuits: an open one would only turn a
+# short upstream glitch into an outage. Rate limiting (429, or any response with
+# Retry-After) is upstream asking us to slow down, not a broken model, so it is
+# retried but never counted against the circuit.
+# Streams are retried/failed over only while opening; once questions have been
+# published a broken stream just ends. Fallbacks should be vision-capable if
+# images are uploaded.
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1") == "1"
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "20"))  # until there are enough latency samples
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "2"))
+HEDGE_MIN_SAMPLES = 20
+FALLBACK_MODELS = [m.strip() for m in os.getenv("FALLBACK_MODELS", "").split(",") if m.strip()]
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504, 520, 522, 524, 529}
+
+def retryable(e):
+    if isinstance(e, HTTPException):
+        return e.status_code in RETRYABLE_STATUSES
+    return isinstance(e, httpx.TransportError)  # timeouts, resets, refused connections
+
+def retry_delay(attempt, error):
+    # Full jitter; a longer Retry-After from upstream wins (up to RETRY_MAX_DELAY)
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+    retry_after = (getattr(error, "headers", None) or {}).get("Retry-After", "")
+    if re.fullmatch(r"[0-9]+", retry_after):
+        delay = max(delay, min(float(retry_after), RETRY_MAX_DELAY))
+    return delay
+
+class CircuitBreaker:
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        # Half-open: one trial call per cooldown period
+        if time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURES:
+            if self.opened_at is None:
+                STATS["circuit_opened"] += 1
+                print(f"Error: circuit opened after {self.failures} upstream failures")
+            self.opened_at = time.monotonic()
+
+def trips_breaker(e):
+    if isinstance(e, HTTPException) and (e.status_code == 429 or "Retry-After" in (e.headers or {})):
+        return False
+    return True
+
+breakers = {}  # only filled in when there are FALLBACK_MODELS
+model_latencies = {}  # model -> recent successful non-streaming call durations
+
+def upstream_models():
+    if not FALLBACK_MODELS:
+        return [MODEL]
+    models = [m for m in [MODEL] + FALLBACK_MODELS if breakers.setdefault(m, CircuitBreaker()).allow()]
+    if not models:
+        raise HTTPException(503, "The quiz model is unavailable right now. Try again shortly.",
+                            headers={"Retry-After": str(math.ceil(BREAKER_COOLDOWN))})
+    return models
+
+def hedge_delay(model):
+    samples = sorted(model_latencies.get(model, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DELAY
+    return max(HEDGE_MIN_DELAY, samples[int(0.95 * (len(samples) - 1))])
+
+async def hedged_call(model, messages):
+    started = time.perf_counter()
+    tasks = {asyncio.create_task(call_openrouter(model, messages))}
+    hedged = False
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay(model) if HEDGE_ENABLED else None)
+        # Hedging only uses spare capacity; under load it would just add to the queue
+        if not done and not upstream_gate.slots.locked():
+            await upstream_gate.slots.acquire()
+            hedged = True
+            STATS["upstream_hedges"] += 1
+            hedge = asyncio.create_task(call_openrouter(model, messages))
+            tasks.add(hedge)
+
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if hedged and task is hedge:
+                        STATS["upstream_hedge_wins"] += 1
+                    model_latencies.setdefault(model, deque(maxlen=200)).append(time.perf_counter() - started)
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+        if hedged:
+            upstream_gate.release()
+
+async def with_policy(call):
+    # call(model) is tried on each available model in turn, with retries
+    error = None
+    for model in upstream_models():
+        breaker = breakers.get(model)
+        for attempt in range(UPSTREAM_RETRIES + 1):
+            if attempt:
+                if breaker is not None and breaker.is_open():
+                    break
+                STATS["upstream_retries"] += 1
+                await asyncio.sleep(retry_delay(attempt, error))
+            try:
+                result = await call(model)
+            except Exception as e:
+                if not retryable(e):
+                    raise
+                print(f"Error: {model}: {getattr(e, 'detail', e)}")
+                error = e
+                if breaker is not None and trips_breaker(e):
+                    breaker.failure()
+                continue
+            if breaker is not None:
+                breaker.success()
+            if model != MODEL:
+                STATS["upstream_fallbacks"] += 1
+            return result
+    raise error
+
+async def complete(messages):
+    return await with_policy(lambda model: hedged_call(model, messages))
+
+async def open_stream(messages):
+    return await with_policy(lambda model: open_openrouter_stream(model, messages))
+
+# --- SINGLE-FLIGHT GENERATION ---
+# Concurrent identical requests share one upstream call. The call runs as its own
+# task and publishes questions to every waiting request (streaming or not), so a
+# client disconnecting doesn't cancel it for the others.
+inflight = {}
+flight_tasks = set()
+
+class QuestionFlight:
+    def __init__(self):
+        self.questions = []
+        self.error = None
+        self.done = False
+        self.requested = 0
+        self.failed_batches = 0
+        self.changed = asyncio.Event()
+        self.opened = asyncio.Event()  # upstream accepted the request (or the flight failed)
+
+    def publish(self, question):
+        self.questions.append(question)
+        self.notify()
+
+    def finish(self, error=None):
+        self.error = error
+        self.done = True
+        self.opened.set()
+        self.notify()
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def follow(self):
+        i = 0
+        while True:
+            if i < len(self.questions):
+                yield self.questions[i]
+                i += 1
+            elif self.done:
+                return
+            else:
+                await self.changed.wait()
+
+    def complete(self):
+        return not self.failed_batches and len(self.questions) >= self.requested
+
+    def warning(self):
+        # For a flight that finished short of what was asked; None when complete
+        if self.complete():
+            return None
+        reason = "part of the request failed upstream" if self.failed_batches else "the model returned too few"
+        return f"Only {len(self.questions)} of {self.requested} questions could be generated ({reason})."
+
+    async def result(self):
+        while not self.done:
+            await self.changed.wait()
+        if self.error is not None:
+            raise self.error
+        return self.questions
+
+def join_flight(key, no_cache=False):
+    # no_cache asks for a fresh generation, so it never piggybacks on another request
+    flight = None if no_cache else inflight.get(key)
+    if flight is not None:
+        STATS["coalesced_requests"] += 1
+    return flight
+
+def start_flight(key, producer, coalesce=True, store=True):
+    flight = QuestionFlight()
+    if coalesce:
+        inflight[key] = flight
+
+    async def run():
+        try:
+            await producer(flight)
+            # A short result would be served to every identical request for GEN_CACHE_TTL
+            if store and flight.questions and flight.complete():
+                await store_cached_questions(key, flight.questions)
+            flight.finish()
+        except Exception as e:
+            print(f"Error: {e}")
+            flight.finish(e)
+        finally:
+            if inflight.get(key) is flight:
+                del inflight[key]
+
+    task = asyncio.create_task(run())
+    flight_tasks.add(task)
+    task.add_done_callback(flight_tasks.discard)
+    return flight
+
+async def run_batch(messages, stream, publish, on_open):
+    await upstream_gate.acquire()
+    try:
+        await call_upstream(messages, stream, publish, on_open)
+    finally:
+        upstream_gate.release()
+
+async def call_upstream(messages, stream, publish, on_open):
+    STATS["upstream_calls"] += 1
+    started = time.perf_counter()
+    if not stream:
+        content_str = await complete(messages)
+        record_stage("upstream", time.perf_counter() - started)
+        on_open()
+        for q in parse_quiz(content_str):
+            publish(q)
+        return
+
+    response = await open_stream(messages)
+    on_open()
+    parser = QuestionStreamParser()
+    parse_s = validate_s = 0.0
+    first_token = True
+    try:
+        async for delta in iter_openrouter_deltas(response):
+            if first_token:
+                record_stage("ttft", time.perf_counter() - started)
+                first_token = False
+            t0 = time.perf_counter()
+            raw_questions = parser.feed(delta)
+            t1 = time.perf_counter()
+            questions = validate_questions(raw_questions)
+            parse_s += t1 - t0
+            validate_s += time.perf_counter() - t1
+            for q in questions:
+                publish(q)
+    finally:
+        record_salvage(parser)
+        record_stage("upstream", time.perf_counter() - started)
+        record_stage("parse", parse_s)
+        record_stage("validate", validate_s)
+
+async def produce_planned(flight, plans, num_questions, stream):
+    # Runs every planned sub-request concurrently; questions are de-duplicated
+    # and published as they arrive, up to num_questions in total.
+    seen = QuestionIndex()
+    errors = []
+    limit = asyncio.Semaphore(GEN_MAX_PARALLEL)
+    flight.requested = num_questions
+
+    def publish(q):
+        if len(flight.questions) >= num_questions or not seen.add(q):
+            return
+        flight.publish(q)
+
+    async def run(messages):
+        async with limit:
+            try:
+                await run_batch(messages, stream, publish, flight.opened.set)
+            except Exception as e:
+                print(f"Error: {e}")
+                errors.append(e)
+
+    await asyncio.gather(*(run(messages) for messages in plans))
+    flight.failed_batches = len(errors)
+    if errors and not flight.questions:
+        raise errors[0]
+
+def reshuffle(questions):
+    # Every caller gets its own copy with a fresh option order
+    return [q for q in (shuffle_question(copy.deepcopy(q)) for q in questions) if q is not None]
+
+# --- GENERATION PLANNER ---
+# Big quizzes are split into several smaller completions that run concurrently:
+# shorter decodes finish sooner and a JSON glitch only costs one batch. Each batch
+# gets its own slice of the document (or a distinct subtopic hint for topics/images).
+MAX_QUESTIONS = int(os.getenv("MAX_QUESTIONS", "100"))
+GEN_BATCH_SIZE = int(os.getenv("GEN_BATCH_SIZE", "10"))
+GEN_MAX_PARALLEL = int(os.getenv("GEN_MAX_PARALLEL", "8"))
+
+def plan_batches(num_questions, batch_size=None):
+    batch_size = batch_size or GEN_BATCH_SIZE
+    batches = max(1, math.ceil(num_questions / batch_size))
+    base, extra = divmod(num_questions, batches)
+    return [base + (1 if i < extra else 0) for i in range(batches)]
+
+def split_sections(text, parts):
+    # Roughly equal slices, cut on line breaks where possible
+    sections = []
+    start = 0
+    for i in range(1, parts):
+        target = len(text) * i // parts
+        cut = text.rfind("\n", start, target)
+        if cut <= start:
+            cut = target
+        sections.append(text[start:cut])
+        start = cut
+    sections.append(text[start:])
+    return sections
+
+def plan_scan_messages(topic, num_questions, document, avoid=None):
+    # Page images go SCAN_PAGES_PER_CALL to a completion (more calls than the
+    # question batches alone would need if there are many pages); each call asks
+    # for its share of the questions about its own pages. A quiz with fewer
+    # questions than that needs calls gets an evenly spaced sample of the pages.
+    pages = document["pages"]
+    calls = max(len(plan_batches(num_questions)), math.ceil(len(pages) / SCAN_PAGES_PER_CALL))
+    counts = plan_batches(num_questions, math.ceil(num_questions / min(calls, num_questions)))
+    pages = [pages[i] for i in sample_page_indices(len(pages), len(counts) * SCAN_PAGES_PER_CALL)]
+    plans = []
+    for i, count in enumerate(counts):
+        lo = len(pages) * i // len(counts)
+        hi = max(lo + 1, len(pages) * (i + 1) // len(counts))
+        focus = None
+        if len(counts) > len(pages):
+            # Several calls share a page; keep them from asking the same things
+            focus = f"This is part {i + 1} of {len(counts)} of a larger quiz. Cover aspect {i + 1} of {len(counts)} so the parts don't overlap."
+        plans.append(build_messages(topic, count, dict(document, pages=pages[lo:hi]), focus, avoid))
+    return plans
+
+def plan_messages(topic, num_questions, document, avoid=None):
+    if document is not None and document["kind"] == "scan":
+        return plan_scan_messages(topic, num_questions, document, avoid)
+    counts = plan_batches(num_questions)
+    if len(counts) == 1:
+        return [build_messages(topic, num_questions, document, avoid=avoid)]
+
+    sections = None
+    if document is not None and document_context(document):
+        sections = split_sections(document_context(document), len(counts))
+
+    plans = []
+    for i, count in enumerate(counts):
+        if sections:
+            plans.append(build_messages(topic, count, dict(document, context=sections[i]), avoid=avoid))
+        else:
+            focus = (
+                f"This is part {i + 1} of {len(counts)} of a larger quiz. Cover aspect {i + 1} "
+                f"of {len(counts)} of the subject so the parts don't overlap."
+            )
+            plans.append(build_messages(topic, count, document, focus, avoid))
+    return plans
+
+# --- QUESTION DE-DUPLICATION ---
+# Near-duplicates are found by MinHash/LSH over the set of normalized content
+# words (plus operators) in the question stem: DEDUP_BANDS bands of DEDUP_ROWS
+# hashes each, so a lookup is one dict probe per band, and only questions sharing
+# a band are compared exactly. A candidate is a repeat when the stems' Jaccard
+# similarity reaches DEDUP_THRESHOLD, their numbers and operators match exactly
+# ("7 + 5" vs "7 - 5" are different questions), and the correct answers match
+# (or, without one, at least half the options are shared). The options are only
+# a tie-breaker, so the same stem with one new distractor is still a repeat, but
+# a generic stem ("Which statement is true?") with a new answer isn't.
+QUIZ_INDEX_ITEMS = int(os.getenv("QUIZ_INDEX_ITEMS", "10000"))
+QUIZ_INDEX_TTL = float(os.getenv("QUIZ_INDEX_TTL", str(6 * 3600)))
+AVOID_PROMPT_ITEMS = int(os.getenv("AVOID_PROMPT_ITEMS", "40"))
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.6"))
+DEDUP_BANDS = 16
+DEDUP_ROWS = 2  # P(candidate) at Jaccard 0.5 is 1 - (1 - 0.5**2)**16 = 99%
+MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(20240611)  # fixed, so every worker hashes alike
+MINHASH_PERMS = [
+    (_minhash_rng.randrange(1, MINHASH_PRIME), _minhash_rng.randrange(MINHASH_PRIME))
+    for _ in range(DEDUP_BANDS * DEDUP_ROWS)
+]
+OPERATOR_PATTERN = r"(?<![a-z])[-+*/=<>^%\u00d7\u00f7](?![a-z])"  # not hyphens in words
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can does did do for from has have how in is it its of on or "
+    "that the this to was were what when where which who whom whose why will with would "
+    "following".split()
+)
+
+def content_words(text):
+    for word in re.findall(r"[a-z0-9]+", str(text).lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        yield word
+
+def word_set(text):
+    text = str(text).lower()
+    return frozenset(content_words(text)) | frozenset(re.findall(OPERATOR_PATTERN, text))
+
+def question_features(q):
+    # (stem words, numbers and operators in order, correct answer, option set);
+    # option order is shuffled per caller, so options are compared as a set
+    text = str(q.get("text", ""))
+    stem = word_set(text) or frozenset([text.strip().lower()])
+    math = tuple(re.findall(r"(?<![a-z])[0-9]+(?:\.[0-9]+)?|" + OPERATOR_PATTERN, text.lower()))
+    options = [" ".join(sorted(word_set(o))) for o in q.get("options") or ()]
+    correct = q.get("correct")
+    answer = options[correct] if isinstance(correct, int) and 0 <= correct < len(options) else ""
+    return stem, math, answer, frozenset(options)
+
+def minhash_bands(stem):
+    hashes = [term_hash(word) for word in stem]
+    signature = [min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_PERMS]
+    return [(band, tuple(signature[band * DEDUP_ROWS:(band + 1) * DEDUP_ROWS])) for band in range(DEDUP_BANDS)]
+
+def near_duplicate(a, b):
+    stem_a, math_a, answer_a, options_a = a
+    stem_b, math_b, answer_b, options_b = b
+    if math_a != math_b or len(stem_a & stem_b) < DEDUP_THRESHOLD * len(stem_a | stem_b):
+        return False
+    if answer_a and answer_b:
+        return answer_a == answer_b
+    return 2 * len(options_a & options_b) >= len(options_a | options_b)
+
+class QuestionIndex:
+    def __init__(self):
+        self.entries = []  # question_features of every question added
+        self.buckets = {}  # (band, band hashes) -> positions in entries
+        self.recent = deque(maxlen=AVOID_PROMPT_ITEMS)
+
+    def find(self, features, bands=None):
+        # True if a near-duplicate of these features is already in the index
+        checked = set()
+        for key in bands or minhash_bands(features[0]):
+            for i in self.buckets.get(key, ()):
+                if i not in checked:
+                    checked.add(i)
+                    if near_duplicate(features, self.entries[i]):
+                        return True
+        return False
+
+    def insert(self, features):
+        bands = minhash_bands(features[0])
+        if self.find(features, bands):
+            return False
+        for key in bands:
+            self.buckets.setdefault(key, []).append(len(self.entries))
+        self.entries.append(features)
+        return True
+
+    def add(self, q):
+        # True if the question is new (and now recorded), False for a repeat
+        if not self.insert(question_features(q)):
+            return False
+        self.recent.append(str(q.get("text", ""))[:120])
+        return True
+
+    def summary(self):
+        # Compact "avoid these" list for the prompt
+        return list(self.recent)
+
+    def dump(self):
+        # Band hashes are cheap to recompute, so only the features are stored
+        return {
+            "questions": [[sorted(stem), list(math), answer, sorted(options)] for stem, math, answer, options in self.entries],
+            "recent": list(self.recent),
+        }
+
+    @classmethod
+    def load(cls, data):
+        index = cls()
+        for stem, math, answer, options in data.get("questions", []):
+            index.insert((frozenset(stem), tuple(math), answer, frozenset(options)))
+        index.recent.extend(data["recent"])
+        return index
+
+# In-process unless STATE_URL is set; then indexes are loaded per request and
+# saved back once the response has gone out, so any worker can serve the quiz.
+quiz_indexes = TTLCache(QUIZ_INDEX_ITEMS, ttl=QUIZ_INDEX_TTL)
+
+async def get_quiz_index(quiz_id):
+    if not quiz_id:
+        return None
+    if len(quiz_id) > 64:
+        raise HTTPException(400, "quiz_id is too long.")
+    if shared_state is not None:
+        raw = await shared_state.get("quizgen:quiz:" + quiz_id)
+        return QuestionIndex.load(json.loads(raw)) if raw else QuestionIndex()
+    index = quiz_indexes.get(quiz_id)
+    if index is None:
+        index = QuestionIndex()
+        quiz_indexes.set(quiz_id, index)
+    return index
+
+async def save_quiz_index(quiz_id, index):
+    if shared_state is not None and index is not None:
+        await shared_state.set("quizgen:quiz:" + quiz_id, json.dumps(index.dump()), QUIZ_INDEX_TTL)
+
+# --- RETRIEVAL INDEX ---
+# When a long document comes with a topic, CONTEXT is the chunks that best match
+# the topic (BM25 over the same chunks context packing uses) rather than a sample
+# of the whole document. The index is built once per doc_id in an extraction
+# worker and saved as flat .npy arrays that later requests (and other workers)
+# memory-map instead of parsing: sorted term hashes, CSR postings, chunk lengths,
+# and the chunk text with its byte offsets. Needs NumPy; without it documents
+# fall back to the packed context.
+INDEX_DIR = os.path.abspath(os.getenv("INDEX_DIR", "doc_index"))
+INDEX_TTL = float(os.getenv("INDEX_TTL", str(7 * 86400)))  # unused indexes are purged after this
+INDEX_CACHE_ITEMS = int(os.getenv("INDEX_CACHE_ITEMS", "64"))
+INDEX_FORMAT = 2  # bump when the on-disk layout or chunking changes
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+def term_hash(word):
+    return int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+
+def index_path(doc_id):
+    return os.path.join(INDEX_DIR, f"v{INDEX_FORMAT}", doc_id)
+
+def purge_indexes(root):
+    cutoff = time.time() - INDEX_TTL
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path)
+        except OSError:
+            pass
+
+def build_chunk_index(path, text):
+    # Runs in an extraction worker
+    chunks = chunk_text(strip_boilerplate(text))
+    postings = {}  # word -> [(chunk, term frequency)]
+    lengths = []
+    for i, chunk in enumerate(chunks):
+        words = list(content_words(chunk))
+        lengths.append(len(words))
+        for word, tf in Counter(words).items():
+            postings.setdefault(word, []).append((i, tf))
+
+    hashes = {word: term_hash(word) for word in postings}
+    order = sorted(postings, key=hashes.__getitem__)
+    entries = [entry for word in order for entry in postings[word]]
+    encoded = [chunk.encode("utf-8") for chunk in chunks]
+    arrays = {
+        "terms": np.array([hashes[word] for word in order], dtype=np.uint64),
+        "ptr": np.concatenate(([0], np.cumsum([len(postings[word]) for word in order]))).astype(np.int64),
+        "post_chunk": np.array([i for i, _ in entries], dtype=np.int32),
+        "post_tf": np.array([tf for _, tf in entries], dtype=np.float32),
+        "lengths": np.array(lengths, dtype=np.float32),
+        "offsets": np.concatenate(([0], np.cumsum([len(b) for b in encoded]))).astype(np.int64),
+    }
+
+    # Built next to its final place and renamed in, so readers never see half an index
+    root = os.path.dirname(path)
+    os.makedirs(root, exist_ok=True)
+    purge_indexes(root)
+    tmp_path = tempfile.mkdtemp(dir=root, prefix=".build-")
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+        with open(os.path.join(tmp_path, "chunks.txt"), "wb") as f:
+            f.write(b"".join(encoded))
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another worker got there first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+    return len(chunks)
+
+class ChunkIndex:
+    def __init__(self, path):
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        self.terms = load("terms")
+        self.ptr = load("ptr")
+        self.post_chunk = load("post_chunk")
+        self.post_tf = load("post_tf")
+        self.lengths = load("lengths")
+        self.offsets = load("offsets")
+        with open(os.path.join(path, "chunks.txt"), "rb") as f:
+            self.text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.avg_length = float(self.lengths.mean()) if len(self.lengths) else 0.0
+        os.utime(path)  # in use, so not purged
+
+    def chunk(self, i):
+        return self.text[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def scores(self, query):
+        n = len(self.lengths)
+        scores = np.zeros(n, dtype=np.float32)
+        if not n or not self.avg_length:
+            return scores
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths / self.avg_length)
+        for word in set(content_words(query)):
+            h = np.uint64(term_hash(word))
+            t = int(np.searchsorted(self.terms, h))
+            if t == len(self.terms) or self.terms[t] != h:
+                continue
+            lo, hi = self.ptr[t], self.ptr[t + 1]
+            chunks = self.post_chunk[lo:hi]
+            tf = self.post_tf[lo:hi]
+            idf = math.log(1 + (n - (hi - lo) + 0.5) / (hi - lo + 0.5))
+            scores[chunks] += idf * tf * (BM25_K1 + 1) / (tf + norm[chunks])
+        return scores
+
+    def retrieve(self, query, budget_chars):
+        # Best matches first, each followed by the chunk after it (a heading's
+        # section usually runs on); output in document order
+        scores = self.scores(query)
+        ranked = [int(i) for i in np.argsort(-scores, kind="stable") if scores[i] > 0]
+        chosen = {}
+        used = 0
+        for i in ranked:
+            for j in (i, i + 1):
+                if j in chosen or j >= len(self.lengths):
+                    continue
+                chunk = self.chunk(j)
+                if used + len(chunk) + 2 > budget_chars:
+                    continue
+                chosen[j] = chunk
+                used += len(chunk) + 2
+        return "\n\n".join(chosen[i] for i in sorted(chosen))
+
+chunk_indexes = TTLCache(INDEX_CACHE_ITEMS)
+index_builds = {}  # doc_id -> future of a build in progress
+
+async def get_chunk_index(doc_id, text):
+    index = chunk_indexes.get(doc_id)
+    if index is not None:
+        return index
+    path = index_path(doc_id)
+    if not os.path.isdir(path):
+        build = index_builds.get(doc_id)
+        if build is None:
+            loop = asyncio.get_running_loop()
+            build = loop.run_in_executor(extract_pool, build_chunk_index, path, text)
+            index_builds[doc_id] = build
+            build.add_done_callback(lambda _: index_builds.pop(doc_id, None))
+        with stage("index_build"):
+            await asyncio.shield(build)
+        STATS["index_builds"] += 1
+    index = ChunkIndex(path)
+    chunk_indexes.set(doc_id, index)
+    return index
+
+async def focus_document(topic, doc_id, document):
+    # The document with its CONTEXT narrowed to the topic, or unchanged when
+    # there's no topic, the text fits the budget anyway, or nothing matches
+    budget_chars = context_token_budget() * CHARS_PER_TOKEN
+    text = (document or {}).get("text", "")
+    if np is None or not topic.strip() or not doc_id or len(text) <= budget_chars:
+        return document
+    try:
+        index = await get_chunk_index(doc_id, text)
+        with stage("retrieve"):
+            context = index.retrieve(topic, budget_chars)
+    except Exception as e:
+        print(f"Error: retrieval failed: {e}")
+        return document
+    if not context:
+        return document
+    STATS["retrieved_contexts"] += 1
+    return dict(document, context=context)
+
+# --- QUIZ SESSIONS ---
+# A session keeps what a quiz needs for follow-up rounds: the topic, the extracted
+# and packed document and the index of questions already served. "More" rounds
+# then go straight to the upstream call with no upload or extraction. With
+# STATE_URL set, sessions live there (the document by doc_id) so any worker can
+# serve the next round.
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(2 * 3600)))
+SESSION_MAX_ITEMS = int(os.getenv("SESSION_MAX_ITEMS", "5000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+
+class QuizSession:
+    def __init__(self, topic, doc_id, document):
+        self.topic = topic
+        self.doc_id = doc_id
+        self.document = document
+        self.index = QuestionIndex()
+
+    def dump(self):
+        # The document itself stays in the (disk-backed) document cache
+        return {"topic": self.topic, "doc_id": self.doc_id, "index": self.index.dump()}
+
+    @classmethod
+    def load(cls, data):
+        document = get_cached_document(data["doc_id"]) if data["doc_id"] else None
+        if data["doc_id"] and document is None:
+            return None
+        session = cls(data["topic"], data["doc_id"], document)
+        session.index = QuestionIndex.load(data["index"])
+        return session
+
+def session_size(session):
+    # The document is usually shared with the document cache, but count it anyway
+    document = document_size(session.document) if session.document else 0
+    return len(session.topic) + document + 1000 * len(session.index.entries)
+
+sessions = TTLCache(SESSION_MAX_ITEMS, SESSION_MAX_BYTES, SESSION_TTL, session_size)
+
+async def get_session(session_id):
+    if shared_state is not None:
+        raw = await shared_state.get("quizgen:session:" + session_id)
+        session = QuizSession.load(json.loads(raw)) if raw else None
+    else:
+        session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(404, "Quiz session not found or expired. Please start the quiz again.")
+    return session
+
+async def save_session(session_id, session):
+    # Also refreshes an active session's TTL and size
+    if shared_state is not None:
+        await shared_state.set("quizgen:session:" + session_id, json.dumps(session.dump()), SESSION_TTL)
+    else:
+        sessions.set(session_id, session)
+
+# --- QUESTION POOLS ---
+# Hot topics/documents (asked for by POOL_HOT_REQUESTS distinct clients within
+# POOL_HOT_WINDOW, or warmed/pinned by an admin) get a pool of already-validated
+# questions. Automatic pools are opt-in: each one costs about POOL_TARGET /
+# POOL_REFILL_BATCH upstream calls up front, in every worker. Requests the pool
+# can cover are answered instantly with a random sample that is removed from the
+# pool (and skips anything the quiz has already served); a background worker tops
+# pools back up to POOL_TARGET once they drop below POOL_LOW_WATER, yielding to
+# interactive requests whenever they are queued for upstream slots.
+POOL_HOT_REQUESTS = int(os.getenv("POOL_HOT_REQUESTS", "0"))  # 0 disables automatic pools
+POOL_HOT_WINDOW = float(os.getenv("POOL_HOT_WINDOW", "600"))
+POOL_TARGET = int(os.getenv("POOL_TARGET", "100"))
+POOL_LOW_WATER = int(os.getenv("POOL_LOW_WATER", "30"))
+POOL_REFILL_BATCH = int(os.getenv("POOL_REFILL_BATCH", "20"))
+POOL_MAX_ITEMS = int(os.getenv("POOL_MAX_ITEMS", "200"))
+POOL_IDLE_TTL = float(os.getenv("POOL_IDLE_TTL", str(24 * 3600)))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # admin endpoints are disabled without one
+
+class QuestionPool:
+    def __init__(self, key, topic, doc_id, document):
+        self.key = key
+        self.topic = topic
+        self.doc_id = doc_id
+        # Only what prompts need; the full extracted text stays in the document cache
+        self.document = {k: v for k, v in document.items() if k != "text"} if document else None
+        self.questions = []  # compact JSON strings
+        self.features = []  # question_features of each entry in questions
+        self.index = QuestionIndex()  # everything ever added, so refills don't repeat themselves
+        self.pinned = False
+        self.served = 0
+        self.refills = 0
+
+    def add(self, q):
+        if not self.index.add(q):
+            return False
+        self.questions.append(json.dumps(q, separators=(",", ":")))
+        self.features.append(self.index.entries[-1])
+        return True
+
+    def take(self, n, exclude=None):
+        # n random questions (removed from the pool), or None if it can't cover n.
+        # exclude: a QuestionIndex of questions the caller has already seen.
+        order = random.sample(range(len(self.questions)), len(self.questions))
+        picked = [i for i in order if exclude is None or not exclude.find(self.features[i])][:n]
+        if len(picked) < n:
+            return None
+        taken = [json.loads(self.questions[i]) for i in picked]
+        # Swap-remove, highest index first so the moved tail entry is never a picked one
+        for i in sorted(picked, reverse=True):
+            self.questions[i] = self.questions[-1]
+            self.features[i] = self.features[-1]
+            self.questions.pop()
+            self.features.pop()
+        return taken
+
+pools = TTLCache(POOL_MAX_ITEMS, ttl=POOL_IDLE_TTL)
+pinned_pools = {}
+pool_demand = TTLCache(10000, ttl=POOL_HOT_WINDOW)
+refill_queue = deque()
+refill_keys = set()
+refill_wakeup = asyncio.Event()
+refill_task = None
+
+def pool_key(topic, doc_id):
+    return json.dumps([normalize_topic(topic), doc_id])
+
+def find_pool(key):
+    pool = pinned_pools.get(key)
+    if pool is None:
+        pool = pools.get(key)
+        if pool is not None:
+            pools.set(key, pool)  # still in use; restart its idle TTL
+    return pool
+
+def create_pool(key, topic, doc_id, document):
+    pool = QuestionPool(key, topic, doc_id, document)
+    pools.set(key, pool)
+    schedule_refill(pool)
+    return pool
+
+def note_demand(topic, doc_id, document):
+    # Returns the pool for this topic/document, creating it once it's hot
+    key = pool_key(topic, doc_id)
+    pool = find_pool(key)
+    if pool is None and POOL_HOT_REQUESTS > 0:
+        # Clients, not requests: one client's burst of identical requests is a
+        # single coalesced flight, not a hot topic
+        clients = pool_demand.get(key) or set()
+        clients.add(request_client.get() or "")
+        pool_demand.set(key, clients)
+        if len(clients) >= POOL_HOT_REQUESTS:
+            pool_demand.pop(key)
+            pool = create_pool(key, topic, doc_id, document)
+    return pool
+
+def serve_from_pool(pool, num_questions, quiz_index):
+    questions = pool.take(num_questions, quiz_index)
+    if len(pool.questions) < POOL_LOW_WATER:
+        schedule_refill(pool)
+    if questions is None:
+        return None
+    STATS["pool_hits"] += 1
+    pool.served += len(questions)
+    return reshuffle(questions)
+
+def schedule_refill(pool):
+    if pool.key not in refill_keys:
+        refill_keys.add(pool.key)
+        refill_queue.append(pool)
+        refill_wakeup.set()
+
+async def refill_pool(pool):
+    document = pool.document
+    if pool.doc_id:
+        # The pool keeps no text, but an index built for an earlier request needs none
+        document = await focus_document(pool.topic, pool.doc_id, get_cached_document(pool.doc_id) or document)
+    empty_rounds = 0
+    while len(pool.questions) < POOL_TARGET and empty_rounds < 3:
+        while upstream_gate.waiting:
+            await asyncio.sleep(1)
+        count = min(POOL_REFILL_BATCH, POOL_TARGET - len(pool.questions))
+        plans = plan_messages(pool.topic, count, document, pool.index.summary())
+        flight = QuestionFlight()
+        await produce_planned(flight, plans, count, False)
+        added = sum(pool.add(q) for q in flight.questions)
+        pool.refills += 1
+        STATS["pool_refill_questions"] += added
+        empty_rounds = 0 if added else empty_rounds + 1
+
+async def pool_refiller():
+    while True:
+        await refill_wakeup.wait()
+        refill_wakeup.clear()
+        while refill_queue:
+            pool = refill_queue.popleft()
+            try:
+                await refill_pool(pool)
+            except Exception as e:
+                print(f"Error: pool refill failed: {e}")
+            finally:
+                refill_keys.discard(pool.key)
+
+@app.on_event("startup")
+async def start_pool_refiller():
+    global refill_task
+    refill_task = asyncio.create_task(pool_refiller())
+
+@app.on_event("shutdown")
+async def stop_pool_refiller():
+    if refill_task is not None:
+        refill_task.cancel()
+
+def require_admin(request):
+    token = request.headers.get("x-admin-token") or request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+    if not ADMIN_TOKEN or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(403, "Admin token required.")
+
+def pool_info(pool):
+    return {
+        "topic": pool.topic,
+        "doc_id": pool.doc_id,
+        "size": len(pool.questions),
+        "pinned": pool.pinned,
+        "served": pool.served,
+        "refills": pool.refills,
+        "refilling": pool.key in refill_keys,
+    }
+
+# --- BATCH JOBS ---
+# Whole-course generation: a job holds many items (topics and/or documents, ZIP
+# archives expanded into their files). Items go through extraction and generation
+# with at most BATCH_CONCURRENCY in flight across all jobs, which keeps the
+# upstream busy while leaving slots for interactive users. Jobs, items and results
+# live in SQLite and the files under BATCH_DIR, so a restart resumes where it left off.
+# Each job is run by the worker process that owns it; workers take over jobs
+# whose owner is gone, and follow other workers' jobs by polling.
+BATCH_DIR = os.path.abspath(os.getenv("BATCH_DIR", "batch_jobs"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", str(max(1, UPSTREAM_CONCURRENCY // 2))))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_ITEM_RETRIES = int(os.getenv("BATCH_ITEM_RETRIES", "5"))
+BATCH_RETENTION = float(os.getenv("BATCH_RETENTION", str(7 * 24 * 3600)))
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "2"))
+BATCH_EXTENSIONS = (".pdf", ".docx", ".txt", ".md", ".png", ".jpg", ".jpeg", ".webp", ".gif")
+
+batch_db = None
+batch_slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+batch_tasks = set()
+batch_changed = {}  # job_id -> Event, set (and replaced) whenever one of its items finishes
+
+def open_batch_db():
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    db = sqlite3.connect(os.path.join(BATCH_DIR, "jobs.sqlite3"), isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "id TEXT PRIMARY KEY, created REAL, num_questions INTEGER, status TEXT, owner INTEGER)"
+    )
+    try:
+        db.execute("ALTER TABLE jobs ADD COLUMN owner INTEGER")  # databases from before owners
+    except sqlite3.OperationalError:
+        pass
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS items ("
+        "job_id TEXT, idx INTEGER, name TEXT, topic TEXT, path TEXT, mime TEXT, "
+        "status TEXT, result TEXT, error TEXT, PRIMARY KEY (job_id, idx))"
+    )
+    return db
+
+def process_alive(pid):
+    if not pid or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+@app.on_event("startup")
+async def resume_batches():
+    global batch_db
+    batch_db = open_batch_db()
+    with batch_db:
+        # IMMEDIATE so workers starting together claim each job exactly once
+        batch_db.execute("BEGIN IMMEDIATE")
+        for (job_id,) in batch_db.execute("SELECT id FROM jobs WHERE created < ?", (time.time() - BATCH_RETENTION,)).fetchall():
+            delete_batch(job_id)
+        orphaned = [
+            job_id for job_id, owner in batch_db.execute("SELECT id, owner FROM jobs WHERE status != 'done'").fetchall()
+            if not process_alive(owner)
+        ]
+        for job_id in orphaned:
+            # Items that were mid-flight when the owner died start over
+            batch_db.execute("UPDATE jobs SET owner = ? WHERE id = ?", (os.getpid(), job_id))
+            batch_db.execute("UPDATE items SET status = 'pending' WHERE job_id = ? AND status = 'running'", (job_id,))
+    for job_id in orphaned:
+        start_batch(job_id)
+
+@app.on_event("shutdown")
+async def close_batch_db():
+    if batch_db is not None:
+        batch_db.close()
+
+def delete_batch(job_id):
+    batch_db.execute("DELETE FROM items WHERE job_id = ?", (job_id,))
+    batch_db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+    shutil.rmtree(os.path.join(BATCH_DIR, job_id), ignore_errors=True)
+
+def notify_batch(job_id):
+    event = batch_changed.pop(job_id, None)
+    if event is not None:
+        event.set()
+
+def batch_file_name(idx, name):
+    # Keep the extension (extraction looks at it), drop anything path-like
+    return f"{idx:04d}-" + re.sub(r"[^A-Za-z0-9._-]", "_", os.path.basename(name))[-100:]
+
+def expand_zip(zip_file, job_dir, items):
+    with ZipFile(zip_file) as archive:
+        for info in archive.infolist():
+            name = info.filename
+            if info.is_dir() or not name.lower().endswith(BATCH_EXTENSIONS) or "__MACOSX" in name:
+                continue
+            if info.file_size > UPLOAD_MAX_BYTES:
+                raise upload_too_large()
+            if len(items) >= BATCH_MAX_ITEMS:
+                raise HTTPException(400, f"A batch can have at most {BATCH_MAX_ITEMS} items.")
+            path = os.path.join(job_dir, batch_file_name(len(items), name))
+            with archive.open(info) as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst, SPOOL_CHUNK_BYTES)
+            items.append({"name": name, "topic": "", "path": path, "mime": mimetypes.guess_type(name)[0] or ""})
+
+async def generate_batch_item(item, num_questions):
+    doc_id, document = "", None
+    if item["path"]:
+        content_hash = await asyncio.to_thread(file_sha256, item["path"])
+        doc_id, document = await extract_cached(item["path"], content_hash, item["mime"], item["name"].lower())
+    cached, flight = await start_generation(item["topic"], num_questions, document, doc_id, False, None, False)
+    questions = await collect_questions(cached, flight, None)
+    return questions, flight.warning() if flight is not None else None
+
+async def run_batch_item(job_id, item, num_questions):
+    async with batch_slots:
+        batch_db.execute("UPDATE items SET status = 'running' WHERE job_id = ? AND idx = ?", (job_id, item["idx"]))
+        result, error = None, None
+        for attempt in range(BATCH_ITEM_RETRIES + 1):
+            try:
+                questions, error = await generate_batch_item(item, num_questions)
+                result = json.dumps(questions)
+                break
+            except HTTPException as e:
+                # Busy (extraction queue, upstream queue, open circuit): wait our turn
+                if e.status_code in (429, 503) and attempt < BATCH_ITEM_RETRIES:
+                    await asyncio.sleep(retry_delay(attempt + 1, e))
+                    continue
+                error = str(e.detail)
+                break
+            except Exception as e:
+                print(f"Error: {e}")
+                error = str(e)
+                break
+        batch_db.execute(
+            "UPDATE items SET status = ?, result = ?, error = ? WHERE job_id = ? AND idx = ?",
+            ("done" if result else "error", result, error, job_id, item["idx"]),
+        )
+    notify_batch(job_id)
+
+async def run_batch_job(job_id):
+    (num_questions,) = batch_db.execute("SELECT num_questions FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    rows = batch_db.execute(
+        "SELECT idx, name, topic, path, mime FROM items WHERE job_id = ? AND status = 'pending' ORDER BY idx",
+        (job_id,),
+    ).fetchall()
+    batch_db.execute("UPDATE jobs SET status = 'running' WHERE id = ?", (job_id,))
+    items = [dict(zip(("idx", "name", "topic", "path", "mime"), row)) for row in rows]
+    await asyncio.gather(*(run_batch_item(job_id, item, num_questions) for item in items))
+    batch_db.execute("UPDATE jobs SET status = 'done' WHERE id = ?", (job_id,))
+    # Results are in the database; the uploaded files are no longer needed
+    shutil.rmtree(os.path.join(BATCH_DIR, job_id), ignore_errors=True)
+    notify_batch(job_id)
+
+def start_batch(job_id):
+    task = asyncio.create_task(run_batch_job(job_id))
+    batch_tasks.add(task)
+    task.add_done_callback(batch_tasks.discard)
+
+def batch_summary(job_id):
+    job = batch_db.execute("SELECT status, num_questions FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if job is None:
+        raise HTTPException(404, "Batch job not found.")
+    counts = dict(batch_db.execute(
+        "SELECT status, COUNT(*) FROM items WHERE job_id = ? GROUP BY status", (job_id,)
+    ).fetchall())
+    summary = {"job_id": job_id, "status": job[0], "num_questions": job[1], "total": sum(counts.values())}
+    for status in ("pending", "running", "done", "error"):
+        summary[status] = counts.get(status, 0)
+    return summary
+
+async def follow_batch(job_id):
+    # NDJSON: the job summary, then one line per finished item (in completion
+    # order), then a final summary once every item is done or failed.
+    yield json.dumps(batch_summary(job_id)) + "\n"
+    sent = set()
+    while True:
+        changed = batch_changed.setdefault(job_id, asyncio.Event())
+        rows = batch_db.execute(
+            "SELECT idx, name, topic, status, result, error FROM items "
+            "WHERE job_id = ? AND status IN ('done', 'error')",
+            (job_id,),
+        ).fetchall()
+        for idx, name, topic, status, result, error in rows:
+            if idx in sent:
+                continue
+            sent.add(idx)
+            line = {"item": idx, "name": name or topic, "status": status}
+            if status == "done":
+                line["questions"] = json.loads(result)
+                if error:
+                    line["warning"] = error  # done, but short of num_questions
+            else:
+                line["error"] = error
+            yield json.dumps(line) + "\n"
+        summary = batch_summary(job_id)
+        if summary["status"] == "done":
+            yield json.dumps(summary) + "\n"
+            return
+        # Jobs owned by another worker never set our event; poll those
+        try:
+            await asyncio.wait_for(changed.wait(), BATCH_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+# --- REVIEW SCHEDULING (spaced repetition) ---
+# Every answer is appended to `attempts` (never rewritten) and folded into the
+# user's card for that question with SM-2 (repetitions, interval, ease, due).
+# "What's next" is an index seek on cards (user, due), so it never reads the
+# attempt history however long it gets. Questions are stored once, under a hash
+# that ignores option order. Users are anonymous ids kept by the browser.
+REVIEW_DB = os.path.abspath(os.getenv("REVIEW_DB", "reviews.sqlite3"))
+REVIEW_MAX_COUNT = int(os.getenv("REVIEW_MAX_COUNT", "100"))
+REVIEW_RELEARN_DELAY = float(os.getenv("REVIEW_RELEARN_DELAY", "0"))  # seconds until a missed question is due again
+DAY_SECONDS = 24 * 3600
+
+review_db = None
+
+def open_review_db():
+    os.makedirs(os.path.dirname(REVIEW_DB), exist_ok=True)
+    db = sqlite3.connect(REVIEW_DB, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE IF NOT EXISTS questions (hash TEXT PRIMARY KEY, body TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS attempts (user TEXT, hash TEXT, answered REAL, grade INTEGER)")
+    db.execute("CREATE INDEX IF NOT EXISTS attempts_by_question ON attempts (user, hash, answered)")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS cards ("
+        "user TEXT, hash TEXT, reps INTEGER, interval REAL, ease REAL, due REAL, PRIMARY KEY (user, hash))"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS cards_by_due ON cards (user, due)")
+    return db
+
+@app.on_event("startup")
+async def open_reviews():
+    global review_db
+    review_db = open_review_db()
+
+@app.on_event("shutdown")
+async def close_reviews():
+    if review_db is not None:
+        review_db.close()
+
+def check_user_id(user_id):
+    if not re.fullmatch(r"[A-Za-z0-9_-]{8,64}", user_id):
+        raise HTTPException(400, "user_id must be 8-64 letters, digits, '-' or '_'.")
+
+def question_hash(q):
+    # The same question whatever order its options were shuffled into
+    text = " ".join(str(q["text"]).lower().split())
+    raw = json.dumps([text, sorted(str(o) for o in q["options"]), str(q["options"][q["correct"]])])
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+def answer_grade(q, answer):
+    # SM-2 grades: 0 = skipped (blackout), 1 = wrong, 4 = right
+    if answer == "skipped":
+        return 0
+    if re.fullmatch(r"[0-9]+", answer) and int(answer) < len(q["options"]):
+        return 4 if int(answer) == q["correct"] else 1
+    raise HTTPException(400, f"answer must be an option index (0-{len(q['options']) - 1}) or 'skipped'.")
+
+def schedule_card(reps, interval, ease, grade):
+    # SM-2. Returns (reps, interval in days, ease); interval 0 means relearn now.
+    if grade >= 3:
+        interval = 1 if reps == 0 else 6 if reps == 1 else round(interval * ease, 2)
+        reps += 1
+    else:
+        reps, interval = 0, 0
+    ease = max(1.3, ease + 0.1 - (5 - grade) * (0.08 + (5 - grade) * 0.02))
+    return reps, interval, ease
+
+def record_attempt(user, q, grade, now):
+    qhash = question_hash(q)
+    with review_db:
+        review_db.execute("BEGIN IMMEDIATE")
+        review_db.execute("INSERT OR IGNORE INTO questions (hash, body) VALUES (?, ?)", (qhash, json.dumps(q)))
+        review_db.execute("INSERT INTO attempts (user, hash, answered, grade) VALUES (?, ?, ?, ?)", (user, qhash, now, grade))
+        card = review_db.execute(
+            "SELECT reps, interval, ease FROM cards WHERE user = ? AND hash = ?", (user, qhash)
+        ).fetchone()
+        reps, interval, ease = schedule_card(*(card or (0, 0, 2.5)), grade)
+        due = now + (interval * DAY_SECONDS if interval else REVIEW_RELEARN_DELAY)
+        review_db.execute(
+            "INSERT OR REPLACE INTO cards (user, hash, reps, interval, ease, due) VALUES (?, ?, ?, ?, ?, ?)",
+            (user, qhash, reps, interval, ease, due),
+        )
+    return {"question_hash": qhash, "correct": grade >= 3, "interval_days": interval, "due": due}
+
+def next_reviews(user, count, due_only, now):
+    rows = review_db.execute(
+        "SELECT questions.body FROM cards JOIN questions ON questions.hash = cards.hash "
+        "WHERE cards.user = ? AND cards.due <= ? ORDER BY cards.due LIMIT ?",
+        (user, now if due_only else math.inf, count),
+    ).fetchall()
+    return [shuffle_question(json.loads(body)) for (body,) in rows]
+
+# --- LIFECYCLE ---
+# /healthz answers as long as the process is up; /readyz only once startup has
+# warmed the extraction workers, the upstream connection and the shared state.
+# On shutdown uvicorn stops accepting and waits (up to SHUTDOWN_GRACE) for open
+# requests; drain() then stops batch jobs and lets background generations (cache
+# fills, other waiters' flights) finish before the clients and pools they use are
+# closed.
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "30"))
+
+ready = False
+
+@app.on_event("startup")
+async def warm_up():
+    global ready
+    # Registered last, so the pools and clients it warms are already open
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(extract_pool, os.getpid) for _ in range(EXTRACT_WORKERS)))
+    try:
+        await http_client.head(OPENROUTER_URL, timeout=5)  # any reply means DNS, TLS and HTTP/2 are set up
+    except httpx.HTTPError as e:
+        print(f"Error: upstream warm-up failed: {e}")
+    for backend in {gen_cache, rate_limits, shared_state} - {None}:
+        try:
+            await backend.get("quizgen:warmup")
+        except Exception as e:
+            print(f"Error: state backend warm-up failed: {e}")
+    ready = True
+
+async def drain():
+    global ready
+    ready = False
+    # Batch items left running are picked up again on the next start
+    for task in list(batch_tasks):
+        task.cancel()
+    pending = list(flight_tasks)
+    if pending:
+        _, unfinished = await asyncio.wait(pending, timeout=SHUTDOWN_GRACE)
+        for task in unfinished:
+            task.cancel()
+
+# Must run before the other shutdown hooks close what the flights still use
+app.router.on_shutdown.insert(0, drain)
+
+def clamp_questions(num_questions):
+    # Safety clamp
+    if num_questions < 1: num_questions = 1
+    if num_questions > MAX_QUESTIONS: num_questions = MAX_QUESTIONS
+    return num_questions
+
+@app.get("/")
+async def get_index(request: Request):
+    return index_asset.response(request)
+
+@app.get("/static/{name}")
+async def get_static(name: str, request: Request):
+    asset = static_assets.get(name)
+    if asset is None:
+        raise HTTPException(404, "Not found")
+    return asset.response(request)
+
+@app.post("/documents")
+async def upload_document(
+        file: UploadFile = File(...),
+        pages: str = Form(""),
+        sample_pages: bool = Form(False)
+):
+    # Upload once, then pass the returned doc_id to /generate-quiz instead of the file.
+    doc_id, document = await load_document(file, "", pages, sample_pages)
+    return {
+        "doc_id": doc_id,
+        "kind": document["kind"],
+        "chars": len(document.get("text", "")),
+        "context_tokens": estimate_tokens(document_context(document)),
+        "page_images": len(document.get("pages", ())),
+    }
+
+async def start_generation(topic, num_questions, document, doc_id, no_cache, quiz_index, stream):
+    # Returns (cached_questions, None) on a pool or cache hit, else (None, flight).
+    # Follow-up rounds of a quiz carry an "avoid these" list, which makes the
+    # prompt unique to that quiz, so they skip the shared cache and single-flight.
+    if not no_cache:
+        pool = note_demand(topic, doc_id, document)
+        if pool is not None:
+            questions = serve_from_pool(pool, num_questions, quiz_index)
+            if questions:
+                return questions, None
+
+    avoid = quiz_index.summary() if quiz_index is not None else []
+    shared = not avoid
+    cache_key = gen_cache_key(MODEL, topic, doc_id, num_questions)
+
+    if shared and not no_cache:
+        cached = await get_cached_questions(cache_key)
+        if cached:
+            return cached, None
+
+    flight = join_flight(cache_key, no_cache) if shared else None
+    if flight is None:
+        document = await focus_document(topic, doc_id, document)
+        with stage("prompt_build"):
+            plans = plan_messages(topic, num_questions, document, avoid)
+        flight = start_flight(
+            cache_key,
+            lambda f: produce_planned(f, plans, num_questions, stream),
+            coalesce=shared and not no_cache,
+            store=shared,
+        )
+    return None, flight
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    if not ready:
+        raise HTTPException(503, "Not ready: starting up or shutting down.")
+    return {"status": "ready", "pid": os.getpid()}
+
+@app.get("/stats")
+async def get_stats():
+    return dict(STATS)
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+async def collect_questions(cached, flight, quiz_index):
+    try:
+        questions = cached if cached is not None else reshuffle(await flight.result())
+        final_questions = [q for q in questions if quiz_index is None or quiz_index.add(q)]
+
+        if not final_questions:
+            raise HTTPException(500, "Failed to generate valid questions. Try again.")
+
+        return final_questions
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def set_warning(response, flight):
+    warning = flight.warning() if flight is not None else None
+    if warning:
+        response.headers["X-Quiz-Warning"] = warning
+
+async def stream_questions(cached, flight, quiz_index):
+    # NDJSON: one validated, shuffled question per line as soon as the model
+    # finishes writing it; a final {"error": ...} line if nothing usable came back,
+    # or {"warning": ...} if fewer than requested did.
+    if cached is not None:
+        lines = (json.dumps(q) + "\n" for q in cached if quiz_index is None or quiz_index.add(q))
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+
+    # Upstream errors before the first byte still become a normal HTTP error
+    await flight.opened.wait()
+    if flight.error is not None and not flight.questions:
+        if isinstance(flight.error, HTTPException):
+            raise flight.error
+        raise HTTPException(status_code=500, detail=str(flight.error))
+
+    async def question_lines():
+        sent = 0
+        async for q in flight.follow():
+            q = shuffle_question(copy.deepcopy(q))
+            if q is None or (quiz_index is not None and not quiz_index.add(q)):
+                continue
+            sent += 1
+            yield json.dumps(q) + "\n"
+
+        if flight.error is not None:
+            yield json.dumps({"error": str(getattr(flight.error, "detail", flight.error))}) + "\n"
+        elif not sent:
+            yield json.dumps({"error": "Failed to generate valid questions. Try again."}) + "\n"
+        elif flight.warning():
+            yield json.dumps({"warning": flight.warning()}) + "\n"
+
+    return StreamingResponse(question_lines(), media_type="application/x-ndjson")
+
+@app.post("/generate-quiz")
+async def generate_quiz(
+        response: Response,
+        topic: str = Form(""),
+        num_questions: int = Form(...),
+        file: UploadFile = File(None),
+        doc_id: str = Form(""),
+        pages: str = Form(""),
+        sample_pages: bool = Form(False),
+        no_cache: bool = Form(False),
+        quiz_id: str = Form("")
+):
+    num_questions = clamp_questions(num_questions)
+
+    if not topic.strip() and not file and not doc_id:
+        raise HTTPException(status_code=400, detail="Please enter a topic or upload a file.")
+
+    doc_id, document = await load_document(file, doc_id, pages, sample_pages)
+    quiz_index = await get_quiz_index(quiz_id)
+
+    cached, flight = await start_generation(
+        topic, num_questions, document, doc_id, no_cache, quiz_index, False
+    )
+    questions = await collect_questions(cached, flight, quiz_index)
+    set_warning(response, flight)
+    await save_quiz_index(quiz_id, quiz_index)
+    return questions
+
+@app.post("/generate-quiz/stream")
+async def generate_quiz_stream(
+        topic: str = Form(""),
+        num_questions: int = Form(...),
+        file: UploadFile = File(None),
+        doc_id: str = Form(""),
+        pages: str = Form(""),
+        sample_pages: bool = Form(False),
+        no_cache: bool = Form(False),
+        quiz_id: str = Form("")
+):
+    num_questions = clamp_questions(num_questions)
+
+    if not topic.strip() and not file and not doc_id:
+        raise HTTPException(status_code=400, detail="Please enter a topic or upload a file.")
+
+    doc_id, document = await load_document(file, doc_id, pages, sample_pages)
+    quiz_index = await get_quiz_index(quiz_id)
+
+    cached, flight = await start_generation(
+        topic, num_questions, document, doc_id, no_cache, quiz_index, True
+    )
+    response = await stream_questions(cached, flight, quiz_index)
+    response.background = BackgroundTask(save_quiz_index, quiz_id, quiz_index)
+    return response
+
+@app.post("/sessions")
+async def create_session(
+        topic: str = Form(""),
+        file: UploadFile = File(None),
+        doc_id: str = Form(""),
+        pages: str = Form(""),
+        sample_pages: bool = Form(False)
+):
+    # Upload/extract once; every round (the first one included) is then a
+    # POST /sessions/{session_id}/more with just a count.
+    if not topic.strip() and not file and not doc_id:
+        raise HTTPException(status_code=400, detail="Please enter a topic or upload a file.")
+
+    doc_id, document = await load_document(file, doc_id, pages, sample_pages)
+    session_id = secrets.token_urlsafe(16)
+    await save_session(session_id, QuizSession(topic, doc_id, document))
+    return {"session_id": session_id, "doc_id": doc_id, "expires_in": SESSION_TTL}
+
+@app.post("/sessions/{session_id}/more")
+async def more_questions(
+        session_id: str,
+        response: Response,
+        count: int = Form(...),
+        stream: bool = Form(False),
+        no_cache: bool = Form(False)
+):
+    session = await get_session(session_id)
+
+    cached, flight = await start_generation(
+        session.topic, clamp_questions(count), session.document, session.doc_id, no_cache, session.index, stream
+    )
+    if stream:
+        streamed = await stream_questions(cached, flight, session.index)
+        streamed.background = BackgroundTask(save_session, session_id, session)
+        return streamed
+    questions = await collect_questions(cached, flight, session.index)
+    set_warning(response, flight)
+    await save_session(session_id, session)
+    return questions
+
+@app.post("/batches")
+async def create_batch(
+        topics: str = Form(""),
+        num_questions: int = Form(10),
+        files: list[UploadFile] = File(None)
+):
+    # topics: one per line. files: documents and/or ZIP archives of documents.
+    # Responds with the job's NDJSON progress stream; if the connection drops the
+    # job keeps going and GET /batches/{job_id}/results picks the stream back up.
+    job_id = secrets.token_hex(8)
+    job_dir = os.path.join(BATCH_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+
+    items = [{"name": "", "topic": t.strip(), "path": "", "mime": ""} for t in topics.splitlines() if t.strip()]
+    try:
+        for file in files or []:
+            if file.size is not None and file.size > UPLOAD_MAX_BYTES:
+                raise upload_too_large()
+            name = file.filename or "upload"
+            if name.lower().endswith(".zip"):
+                # ZipFile reads the already-spooled upload in place
+                expand_zip(file.file, job_dir, items)
+            else:
+                target = os.path.join(job_dir, batch_file_name(len(items), name))
+                await save_upload(file, target)
+                items.append({"name": name, "topic": "", "path": target, "mime": file.content_type or ""})
+        if not items:
+            raise HTTPException(400, "Please send at least one topic or file.")
+        if len(items) > BATCH_MAX_ITEMS:
+            raise HTTPException(400, f"A batch can have at most {BATCH_MAX_ITEMS} items.")
+    except BaseException:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
+
+    with batch_db:
+        batch_db.execute("BEGIN")
+        batch_db.execute(
+            "INSERT INTO jobs (id, created, num_questions, status, owner) VALUES (?, ?, ?, 'pending', ?)",
+            (job_id, time.time(), clamp_questions(num_questions), os.getpid()),
+        )
+        batch_db.executemany(
+            "INSERT INTO items (job_id, idx, name, topic, path, mime, status) VALUES (?, ?, ?, ?, ?, ?, 'pending')",
+            [(job_id, i, it["name"], it["topic"], it["path"], it["mime"]) for i, it in enumerate(items)],
+        )
+    start_batch(job_id)
+    return StreamingResponse(follow_batch(job_id), media_type="application/x-ndjson")
+
+@app.get("/batches/{job_id}")
+async def get_batch(job_id: str):
+    return batch_summary(job_id)
+
+@app.get("/batches/{job_id}/results")
+async def get_batch_results(job_id: str):
+    batch_summary(job_id)  # 404 before the stream starts
+    return StreamingResponse(follow_batch(job_id), media_type="application/x-ndjson")
+
+@app.post("/attempts")
+async def log_attempt(
+        user_id: str = Form(...),
+        question: str = Form(...),
+        answer: str = Form(...)
+):
+    # question: the question as shown (JSON); answer: the chosen option index or "skipped"
+    check_user_id(user_id)
+    try:
+        q = json.loads(question)
+    except ValueError:
+        q = None
+    if not isinstance(q, dict) or not isinstance(q.get("text"), str) or shuffle_question(copy.deepcopy(q)) is None:
+        raise HTTPException(400, "question must be a quiz question as returned by /generate-quiz.")
+    grade = answer_grade(q, answer)
+    q = {k: q[k] for k in ("text", "options", "correct", "rationale") if k in q}
+    return record_attempt(user_id, q, grade, time.time())
+
+@app.get("/reviews")
+async def get_reviews(user_id: str, count: int = 10, due_only: bool = True):
+    # The user's next questions to review, most overdue first
+    check_user_id(user_id)
+    return next_reviews(user_id, max(1, min(count, REVIEW_MAX_COUNT)), due_only, time.time())
+
+@app.get("/admin/pools")
+async def list_pools(request: Request):
+    require_admin(request)
+    all_pools = list(pinned_pools.values()) + [p for p in pools.values() if p.key not in pinned_pools]
+    return [pool_info(p) for p in all_pools]
+
+@app.get("/admin/pools/inspect")
+async def inspect_pool(request: Request, topic: str = "", doc_id: str = ""):
+    require_admin(request)
+    pool = find_pool(pool_key(topic, doc_id))
+    if pool is None:
+        raise HTTPException(404, "No pool for this topic/document.")
+    return dict(pool_info(pool), questions=[json.loads(q) for q in pool.questions])
+
+@app.post("/admin/pools/warm")
+async def warm_pool(
+        request: Request,
+        topic: str = Form(""),
+        doc_id: str = Form(""),
+        pin: bool = Form(False)
+):
+    # Creates the pool if needed and fills it to POOL_TARGET in the background
+    require_admin(request)
+    if not topic.strip() and not doc_id:
+        raise HTTPException(400, "Please give a topic or a doc_id.")
+    key = pool_key(topic, doc_id)
+    pool = find_pool(key)
+    if pool is None:
+        _, document = await load_document(None, doc_id)
+        pool = create_pool(key, topic, doc_id, document)
+    else:
+        schedule_refill(pool)
+    if pin:
+        pool.pinned = True
+        pinned_pools[key] = pool
+    return pool_info(pool)
+
+@app.post("/admin/pools/pin")
+async def pin_pool(
+        request: Request,
+        topic: str = Form(""),
+        doc_id: str = Form(""),
+        pinned: bool = Form(True)
+):
+    # Pinned pools are never evicted; unpinning hands them back to the idle TTL
+    require_admin(request)
+    key = pool_key(topic, doc_id)
+    pool = find_pool(key)
+    if pool is None:
+        raise HTTPException(404, "No pool for this topic/document. Warm it first.")
+    pool.pinned = pinned
+    if pinned:
+        pinned_pools[key] = pool
+    else:
+        pinned_pools.pop(key, None)
+        pools.set(key, pool)
+    return pool_info(pool)
+
+# --- ENTRY POINT ---
+# `python server.py` runs WORKERS server processes (default: one per CPU core) on
+# one port. With more than one, they share rate limits, sessions, quiz indexes and
+# the generation cache through a SQLite file in STATE_DIR, and extracted documents
+# through the on-disk document cache and retrieval indexes next to it, unless
+# STATE_URL / DOC_CACHE_DIR / INDEX_DIR say otherwise. Stats, metrics and
+# question pools stay per worker.
+if __name__ == "__main__":
+    if not OPENROUTER_API_KEY:
+        raise SystemExit(MISSING_KEY_MESSAGE)
+    workers = int(os.getenv("WORKERS", str(os.cpu_count() or 1)))
+    os.environ["WORKERS"] = str(workers)
+    if workers > 1:
+        state_dir = os.path.abspath(os.getenv("STATE_DIR", "state"))
+        os.environ.setdefault("STATE_URL", "sqlite://" + os.path.join(state_dir, "state.sqlite3"))
+        os.environ.setdefault("DOC_CACHE_DIR", os.path.join(state_dir, "documents"))
+        os.environ.setdefault("INDEX_DIR", os.path.join(state_dir, "index"))
+    uvicorn.run(
+        "server:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=workers,
+        timeout_graceful_shutdown=SHUTDOWN_GRACE,
+    )